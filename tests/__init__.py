@@ -0,0 +1,8 @@
+import os
+import atexit
+import shutil
+import tempfile
+
+# compiled integration plans are cached in a throwaway directory rather than ~/.cache/tofspec
+os.environ['TOFSPEC_CACHE_DIR'] = tempfile.mkdtemp(prefix="tofspec-tests-")
+atexit.register(shutil.rmtree, os.environ['TOFSPEC_CACHE_DIR'], ignore_errors=True)
@@ -0,0 +1,94 @@
+import unittest
+from click.testing import CliRunner
+import os
+import shutil, tempfile
+import importlib.util
+import pandas as pd
+import yaml
+
+from tofspec.cli import build_db
+from tofspec.substructures import build_database
+
+HAS_RDKIT = importlib.util.find_spec("rdkit") is not None
+
+
+@unittest.skipIf(not HAS_RDKIT, "RDKit is not installed")
+class SetupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+        self.database = os.path.join(self.test_dir, "database.feather")
+        pd.DataFrame({
+            "mf": ["C6H6", "C2H6O", "C3H6O", "C7H8O"],
+            "smiles": ["c1ccccc1", "CCO", "CC(C)=O", "Cc1ccccc1O"],
+        }).to_feather(self.database)
+
+        self.substructures = os.path.join(self.test_dir, "substructures.yml")
+        self.write_substructures([
+            {"name": "hydroxyl", "smarts": "[OX2H]"},
+            {"name": "carbonyl", "smarts": "[CX3]=[OX1]"},
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write_substructures(self, substructures):
+        with open(self.substructures, "w") as f:
+            yaml.dump({"name": "substructures", "substructures": substructures}, f)
+
+    def test_build_db(self):
+        runner = CliRunner()
+        result = runner.invoke(build_db,
+                    [
+                        self.database,
+                        "-s",
+                        self.substructures,
+                        "-j",
+                        "2",
+                    ],
+                    catch_exceptions=False
+                )
+
+        # did it succeed?
+        self.assertEqual(result.exit_code, 0)
+        self.assertTrue("Saving file" in result.output)
+
+        # the table is sorted by m/z and labeled
+        df = pd.read_feather(self.database).set_index("smiles")
+        self.assertTrue(df["mz"].is_monotonic_increasing)
+        self.assertEqual(df["hydroxyl"].to_dict(), {"c1ccccc1": 0, "CCO": 1, "CC(C)=O": 0, "Cc1ccccc1O": 1})
+        self.assertEqual(df["carbonyl"].to_dict(), {"c1ccccc1": 0, "CCO": 0, "CC(C)=O": 1, "Cc1ccccc1O": 0})
+        self.assertEqual(df.loc["c1ccccc1", "BTEX"], 1)
+
+        # nothing is left behind but the database
+        self.assertEqual(sorted(os.listdir(self.test_dir)), ["database.feather", "substructures.yml"])
+
+    def test_build_db_incremental(self):
+        self.assertEqual(build_database(self.database, self.substructures), (["hydroxyl", "carbonyl"], 0))
+
+        # a new substructure is the only one matched against the compounds
+        self.write_substructures([
+            {"name": "hydroxyl", "smarts": "[OX2H]"},
+            {"name": "carbonyl", "smarts": "[CX3]=[OX1]"},
+            {"name": "aromatic", "smarts": "[c]"},
+        ])
+        self.assertEqual(build_database(self.database, self.substructures), (["aromatic"], 0))
+
+        # so is a substructure whose SMARTS changed, and new compounds for the others
+        self.write_substructures([
+            {"name": "hydroxyl", "smarts": "[OX2H][CX4]"},
+            {"name": "carbonyl", "smarts": "[CX3]=[OX1]"},
+            {"name": "aromatic", "smarts": "[c]"},
+        ])
+        compounds = os.path.join(self.test_dir, "compounds.csv")
+        pd.DataFrame({"mf": ["C2H4O", "C2H6O"], "smiles": ["CC=O", "CCO"]}).to_csv(compounds, index=False)
+        self.assertEqual(build_database(self.database, self.substructures, add=compounds), (["hydroxyl"], 1))
+
+        df = pd.read_feather(self.database).set_index("smiles")
+        self.assertEqual(df.shape[0], 5)
+        self.assertEqual(df["hydroxyl"].to_dict(), {"c1ccccc1": 0, "CCO": 1, "CC(C)=O": 0, "Cc1ccccc1O": 0, "CC=O": 0})
+        self.assertEqual(df["carbonyl"]["CC=O"], 1)
+        self.assertEqual(df["aromatic"].to_dict(), {"c1ccccc1": 1, "CCO": 0, "CC(C)=O": 0, "Cc1ccccc1O": 1, "CC=O": 0})
+
+        # nothing new
+        self.assertEqual(build_database(self.database, self.substructures), ([], 0))
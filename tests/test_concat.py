@@ -4,9 +4,11 @@ from os import path
 from pathlib import Path
 import os
 import shutil, tempfile
+import numpy as np
 import pandas as pd
 
 from tofspec.cli import concat
+from tofspec.stream import concat_files
 
 
 class SetupTestCase(unittest.TestCase):
@@ -47,4 +49,78 @@ class SetupTestCase(unittest.TestCase):
         df2 = pd.read_csv(os.path.join(self.test_files_dir, "long.csv"))
         df3 = pd.read_csv(os.path.join(self.test_dir, "output.csv")) 
 
-        self.assertEqual(df1.shape[0] + df2.shape[0], df3.shape[0])
\ No newline at end of file
+        self.assertEqual(df1.shape[0] + df2.shape[0], df3.shape[0])
+    def test_concat_overlap_dedupe(self):
+        # two overlapping halves of long.csv, with a column that only one of them has
+        df = pd.read_csv(os.path.join(self.test_files_dir, "long.csv"))
+        first = df.iloc[:200].copy()
+        first["extra"] = 1.0
+        first.to_csv(os.path.join(self.test_dir, "first.csv"), index=False)
+        df.iloc[100:].reset_index(drop=True).to_feather(os.path.join(self.test_dir, "second.feather"))
+
+        runner = CliRunner()
+        result = runner.invoke(concat, 
+                    [
+                        "--dedupe",
+                        "-o",
+                        os.path.join(self.test_dir, "output.feather"),
+                        os.path.join(self.test_dir, "second.feather"),
+                        os.path.join(self.test_dir, "first.csv"),
+                    ],
+                    catch_exceptions=False
+                )
+        self.assertEqual(result.exit_code, 0)
+
+        out = pd.read_feather(os.path.join(self.test_dir, "output.feather"))
+
+        # every timestamp once, in order, with the union of the columns
+        self.assertEqual(out.shape[0], df.shape[0])
+        self.assertTrue(out["timestamp"].is_monotonic_increasing)
+        self.assertEqual(list(out.columns), ["timestamp", "C5H8", "C4H6O", "metadata", "extra"])
+
+        # duplicates come from the first file given
+        self.assertEqual(out["extra"].notna().sum(), 100)
+
+    def test_concat_feather_v1(self):
+        # a Feather V1 file (not an Arrow IPC file) merged with a .csv file
+        df = pd.read_csv(os.path.join(self.test_files_dir, "long.csv"))
+        df.iloc[:100].to_feather(os.path.join(self.test_dir, "first.feather"), version=1)
+        df.iloc[100:].to_csv(os.path.join(self.test_dir, "second.csv"), index=False)
+
+        runner = CliRunner()
+        result = runner.invoke(concat,
+                    [
+                        "-o",
+                        os.path.join(self.test_dir, "output.csv"),
+                        os.path.join(self.test_dir, "second.csv"),
+                        os.path.join(self.test_dir, "first.feather"),
+                    ],
+                    catch_exceptions=False
+                )
+        self.assertEqual(result.exit_code, 0)
+
+        out = pd.read_csv(os.path.join(self.test_dir, "output.csv"))
+        self.assertEqual(out.shape[0], df.shape[0])
+        self.assertTrue(pd.to_datetime(out["timestamp"]).is_monotonic_increasing)
+
+    def test_concat_late_values(self):
+        # columns that are empty or integer in the first block get the type of all of their values
+        n = 5000
+        df = pd.DataFrame({"timestamp": pd.date_range("2022-02-22", periods=n, freq="s"), "c": np.nan, "i": np.arange(n, dtype=float)})
+        df.loc[n - 10:, "c"] = 1.5
+        df.loc[n - 1, "i"] = 0.5
+        df.to_csv(os.path.join(self.test_dir, "late.csv"), index=False)
+
+        rows = concat_files([os.path.join(self.test_dir, "late.csv")], os.path.join(self.test_dir, "output.feather"), block_size=4096)
+        self.assertEqual(rows, n)
+
+        out = pd.read_feather(os.path.join(self.test_dir, "output.feather"))
+        self.assertEqual(out["c"].notna().sum(), 10)
+        np.testing.assert_allclose(out["i"], df["i"])
+
+        # a merge that fails leaves no output behind
+        df.iloc[::-1].to_csv(os.path.join(self.test_dir, "unsorted.csv"), index=False)
+        with self.assertRaises(Exception):
+            concat_files([os.path.join(self.test_dir, "unsorted.csv")], os.path.join(self.test_dir, "failed.csv"), block_size=4096)
+        self.assertEqual(os.listdir(self.test_dir).count("failed.csv"), 0)
+        self.assertFalse(any(f.endswith(".tmp") for f in os.listdir(self.test_dir)))
@@ -6,8 +6,11 @@ import os
 import shutil, tempfile
 import pandas as pd
 import numpy as np
+import h5py
 
 from tofspec.cli import integrate_peaks
+from tofspec.load import load_vocus_data
+from tofspec.cube import write_cube
 
 class SetupTestCase(unittest.TestCase):
     def setUp(self):
@@ -61,4 +64,163 @@ class SetupTestCase(unittest.TestCase):
 
         # make sure the file exists
         p = Path(self.test_dir + "/output.feather")
-        self.assertTrue(p.exists())
\ No newline at end of file
+        self.assertTrue(p.exists())
+
+    def test_integrate_peaks_h5(self):
+        runner = CliRunner()
+        result = runner.invoke(integrate_peaks, 
+                    [
+                        "-o",
+                        os.path.join(self.test_dir, "output.csv"),
+                        "--metadata",
+                        os.path.join(self.test_files_dir, "V3_15s.h5"),
+                    ]
+                )
+
+        # did it succeed?
+        self.assertEqual(result.exit_code, 0)
+
+        # did it output the correct text?
+        self.assertTrue("Saving file" in result.output)
+
+        # make sure the file exists and has one row per spectrum
+        p = Path(self.test_dir + "/output.csv")
+        self.assertTrue(p.exists())
+
+        df = pd.read_csv(p)
+        self.assertEqual(df.shape[0], 15)
+        self.assertTrue("metadata" in df.columns)
+
+    def test_integrate_peaks_drift(self):
+        runner = CliRunner()
+        outputs = []
+        for options in ([], ["-R", "37.0284,55.0390", "--max-shift", "0"], ["-R", "37.0284,55.0390", "--drift", "row"]):
+            outputs.append(os.path.join(self.test_dir, "output-{}.csv".format(len(outputs))))
+            result = runner.invoke(integrate_peaks,
+                        options + [
+                            "-o",
+                            outputs[-1],
+                            os.path.join(self.test_files_dir, "V3_15s.h5"),
+                        ],
+                        catch_exceptions=False
+                    )
+
+            # did it succeed?
+            self.assertEqual(result.exit_code, 0)
+            self.assertTrue("Saving file" in result.output)
+
+        # without drift, the windows of the peak list are where they were
+        fixed, unshifted, corrected = [pd.read_csv(o, index_col=0) for o in outputs]
+        self.assertEqual(corrected.shape, fixed.shape)
+        np.testing.assert_allclose(unshifted.values, fixed.values, rtol=1e-4, atol=1e-4)
+
+        # only raw spectra can be corrected
+        result = runner.invoke(integrate_peaks, ["-R", "37.0284", "-o", outputs[0], os.path.join(self.test_files_dir, "test.csv")])
+        self.assertNotEqual(result.exit_code, 0)
+
+    def test_integrate_peaks_cube(self):
+        timestamps, mass_axis, tof_data, metadata = load_vocus_data(os.path.join(self.test_files_dir, "V3_15s.h5"), metadata=True)
+        write_cube(os.path.join(self.test_dir, "V3_15s.tofcube"), timestamps, mass_axis, tof_data, metadata)
+
+        runner = CliRunner()
+        for f in ("V3_15s.tofcube", "V3_15s.h5"):
+            result = runner.invoke(integrate_peaks, 
+                        [
+                            "-o",
+                            os.path.join(self.test_dir, f + ".csv"),
+                            "--metadata",
+                            os.path.join(self.test_dir if f.endswith("cube") else self.test_files_dir, f),
+                        ]
+                    )
+
+            # did it succeed?
+            self.assertEqual(result.exit_code, 0)
+
+        # integrating the cube gives the same result as integrating the raw file
+        df = pd.read_csv(os.path.join(self.test_dir, "V3_15s.tofcube.csv"))
+        ref = pd.read_csv(os.path.join(self.test_dir, "V3_15s.h5.csv"))
+        pd.testing.assert_frame_equal(df, ref)
+
+    def test_integrate_peaks_incremental(self):
+        def copy(name, hour):
+            # a copy of the test file, acquired at another hour
+            fpath = os.path.join(self.test_dir, name)
+            shutil.copy(os.path.join(self.test_files_dir, "V3_15s.h5"), fpath)
+            with h5py.File(fpath, "r+") as f:
+                log = f['AcquisitionLog/Log'][...]
+                log[0]['timestring'] = "2021-11-17T{:02d}:39:49+00:00".format(hour).encode()
+                f['AcquisitionLog/Log'][...] = log
+
+        copy("a.h5", 10)
+        copy("b.h5", 11)
+        output = os.path.join(self.test_dir, "output.csv")
+
+        runner = CliRunner()
+        args = ["--incremental", "-o", output, os.path.join(self.test_dir, "*.h5")]
+
+        result = runner.invoke(integrate_peaks, args)
+        self.assertEqual(result.exit_code, 0)
+        first = pd.read_csv(output, index_col=0, parse_dates=True)
+
+        # nothing changed
+        result = runner.invoke(integrate_peaks, args)
+        self.assertEqual(result.exit_code, 0)
+        self.assertTrue("up to date" in result.output)
+
+        # a new file is merged in, and a changed file replaces its own rows
+        copy("b.h5", 12)
+        copy("c.h5", 13)
+        result = runner.invoke(integrate_peaks, args)
+        self.assertEqual(result.exit_code, 0)
+
+        df = pd.read_csv(output, index_col=0, parse_dates=True)
+        self.assertEqual(df.shape[0], 3 * first.shape[0] // 2)
+        self.assertEqual(list(df.index.hour.unique()), [10, 12, 13])
+        np.testing.assert_allclose(df.loc[df.index.hour == 10].to_numpy(), first.loc[first.index.hour == 10].to_numpy())
+
+    def test_integrate_peaks_many(self):
+        runner = CliRunner()
+        result = runner.invoke(integrate_peaks, 
+                    [
+                        "-j",
+                        "2",
+                        "-ts",
+                        "timestamp",
+                        "-o",
+                        os.path.join(self.test_dir, "output.csv"),
+                        os.path.join(self.test_files_dir, "test.csv"),
+                        os.path.join(self.test_files_dir, "V3_15s.h5"),
+                    ]
+                )
+
+        # did it succeed?
+        self.assertEqual(result.exit_code, 0)
+
+        # were both inputs combined in time order?
+        df = pd.read_csv(os.path.join(self.test_dir, "output.csv"))
+        self.assertEqual(df.shape[0], 16)
+        self.assertTrue(pd.to_datetime(df['timestamp']).dropna().is_monotonic_increasing)
+
+    def test_integrate_peaks_tables(self):
+        # tables without timestamps are concatenated in the order they are given
+        df = pd.read_csv(os.path.join(self.test_files_dir, "test.csv")).drop(columns="timestamp")
+        for name, scale in (("a.csv", 1), ("b.csv", 2)):
+            pd.concat([df * scale] * 3, ignore_index=True).to_csv(os.path.join(self.test_dir, name), index=False)
+
+        runner = CliRunner()
+        result = runner.invoke(integrate_peaks,
+                    [
+                        "-o",
+                        os.path.join(self.test_dir, "output.csv"),
+                        os.path.join(self.test_dir, "a.csv"),
+                        os.path.join(self.test_dir, "b.csv"),
+                    ],
+                    catch_exceptions=False
+                )
+        self.assertEqual(result.exit_code, 0)
+
+        out = pd.read_csv(os.path.join(self.test_dir, "output.csv"), index_col=0)
+        self.assertEqual(list(out.index), list(range(6)))
+        values = out.to_numpy()
+        np.testing.assert_allclose(values[:3], np.repeat(values[:1], 3, axis=0))
+        np.testing.assert_allclose(values[3:], 2 * values[:3], rtol=1e-5)
@@ -6,8 +6,14 @@ import os
 import shutil, tempfile
 import pandas as pd
 import numpy as np
+import h5py
 
 from tofspec.cli import load
+from tofspec.utils import safe_load, read_mass_axis, df_mass_axis
+from tofspec.load import load_vocus_data, iter_vocus_chunks, resample_blocks
+from tofspec.cube import read_cube
+from tofspec.store import read_store, store_sources
+from tofspec.manifest import Manifest, manifest_path
 
 class SetupTestCase(unittest.TestCase):
     def setUp(self):
@@ -65,4 +71,170 @@ class SetupTestCase(unittest.TestCase):
 
         # make sure the file exists
         p = Path(self.test_dir + "/output.feather")
-        self.assertTrue(p.exists())
\ No newline at end of file
+        self.assertTrue(p.exists())
+
+        # counts keep their dtype and the exact mass axis is stored with them
+        with h5py.File(os.path.join(self.test_files_dir, "V3_15s.h5"), "r") as f:
+            mass_axis = np.array(f['FullSpectra']['MassAxis'])
+
+        df = safe_load(p)
+        self.assertEqual(df.shape, (15, mass_axis.shape[0] + 2))
+        self.assertEqual(df.iloc[:, 0].dtype, np.uint16)
+        self.assertNotIn('index', df.columns)
+        np.testing.assert_array_equal(read_mass_axis(p).to_numpy(), mass_axis)
+        np.testing.assert_array_equal(df_mass_axis(df.drop(['timestamp', 'metadata'], axis=1)), mass_axis)
+
+    def test_load_resample(self):
+        runner = CliRunner()
+        result = runner.invoke(load, 
+                    [
+                        "--resample",
+                        "4s",
+                        "--metadata",
+                        "-o",
+                        os.path.join(self.test_dir, "output.feather"),
+                        os.path.join(self.test_files_dir, "V3_15s.h5"),
+                    ]
+                )
+        self.assertEqual(result.exit_code, 0)
+
+        # the same as averaging every spectrum with pandas, leaving out the empty buffers
+        timestamps, mass_axis, tof_data = load_vocus_data(os.path.join(self.test_files_dir, "V3_15s.h5"))
+        ref = pd.DataFrame(tof_data[:, :1000], index=pd.DatetimeIndex(timestamps), dtype=np.float64)
+        ref = ref[ref.index.notna()].resample("4s").mean().dropna()
+
+        df = safe_load(os.path.join(self.test_dir, "output.feather"))
+        self.assertEqual(df.shape, (ref.shape[0], mass_axis.shape[0] + 2))
+        np.testing.assert_array_equal(df["timestamp"].to_numpy(), ref.index.to_numpy())
+        np.testing.assert_allclose(df.iloc[:, :1000].to_numpy(), ref.to_numpy(), rtol=1e-6)
+
+        # intervals that span two blocks are averaged as a whole
+        blocks = list(iter_vocus_chunks(os.path.join(self.test_files_dir, "V3_15s.h5"), rows=5, average="4s"))
+        self.assertGreater(len(blocks), 1)
+        np.testing.assert_array_equal(np.concatenate([b[1] for b in blocks]), df.iloc[:, :-2].to_numpy())
+
+        # intervals that do not divide a day start at midnight of the first day, like pandas
+        t = pd.date_range("2022-02-22 13:05:17", periods=500, freq="37s").to_numpy()
+        y = np.arange(1000, dtype=np.uint16).reshape(500, 2)
+        ref = pd.DataFrame(y, index=pd.DatetimeIndex(t), dtype=np.float64).resample("7min").mean().dropna()
+        blocks = list(resample_blocks(((t[i:i + 64], y[i:i + 64]) for i in range(0, 500, 64)), "7min"))
+        np.testing.assert_array_equal(np.concatenate([b[0] for b in blocks]), ref.index.to_numpy())
+        np.testing.assert_allclose(np.concatenate([b[1] for b in blocks]), ref.to_numpy(), rtol=1e-6)
+
+    def test_load_cube(self):
+        runner = CliRunner()
+        result = runner.invoke(load, 
+                    [
+                        "--metadata",
+                        "-o",
+                        os.path.join(self.test_dir, "output.tofcube"),
+                        os.path.join(self.test_files_dir, "V3_15s.h5"),
+                    ]
+                )
+
+        # did it succeed?
+        self.assertEqual(result.exit_code, 0)
+
+        # the cube memory-maps the same data that load_vocus_data reads
+        timestamps, mass_axis, tof_data, metadata = load_vocus_data(os.path.join(self.test_files_dir, "V3_15s.h5"), metadata=True)
+        cube = read_cube(os.path.join(self.test_dir, "output.tofcube"), metadata=True)
+
+        self.assertIsInstance(cube[2], np.memmap)
+        np.testing.assert_array_equal(cube[0], timestamps)
+        np.testing.assert_array_equal(cube[1], mass_axis)
+        np.testing.assert_array_equal(cube[2], tof_data)
+        np.testing.assert_array_equal(cube[3], metadata)
+
+    def test_load_append(self):
+        for name in ("a.h5", "b.h5"):
+            shutil.copy(os.path.join(self.test_files_dir, "V3_15s.h5"), os.path.join(self.test_dir, name))
+        store = os.path.join(self.test_dir, "campaign.h5")
+
+        runner = CliRunner()
+        result = runner.invoke(load, ["--metadata", "-o", store, os.path.join(self.test_dir, "a.h5")])
+        self.assertEqual(result.exit_code, 0)
+
+        # a.h5 is already in the store and is skipped
+        result = runner.invoke(load, ["--append", "--metadata", "-o", store, os.path.join(self.test_dir, "*.h5")])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(store_sources(store), ["a.h5", "b.h5"])
+
+        timestamps, mass_axis, tof_data, metadata = load_vocus_data(os.path.join(self.test_files_dir, "V3_15s.h5"), metadata=True)
+        t, m, d, md = read_store(store, metadata=True)
+        np.testing.assert_array_equal(m, mass_axis)
+        np.testing.assert_array_equal(d, np.concatenate([tof_data, tof_data]))
+        np.testing.assert_array_equal(md, np.concatenate([metadata, metadata]))
+
+        # a time window of a few bins is read from both files
+        t, m, d = read_store(store, start=timestamps[3], end=timestamps[7], columns=[5, 10, 100])
+        np.testing.assert_array_equal(m, mass_axis[[5, 10, 100]])
+        np.testing.assert_array_equal(d, np.concatenate([tof_data[3:7], tof_data[3:7]])[:, [5, 10, 100]])
+
+        # the store is never appended to a raw file
+        result = runner.invoke(load, ["--append", "-o", os.path.join(self.test_dir, "b.h5"), os.path.join(self.test_dir, "a.h5")])
+        self.assertNotEqual(result.exit_code, 0)
+
+    def test_load_incremental_store(self):
+        for name in ("a.h5", "b.h5"):
+            shutil.copy(os.path.join(self.test_files_dir, "V3_15s.h5"), os.path.join(self.test_dir, name))
+        store = os.path.join(self.test_dir, "campaign.h5")
+        files = os.path.join(self.test_dir, "*.h5")
+
+        runner = CliRunner()
+        result = runner.invoke(load, ["--incremental", "-o", store, files])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(store_sources(store), ["a.h5", "b.h5"])
+
+        # a file that changed since it was appended is reported once, and the store keeps it as it was
+        with open(os.path.join(self.test_dir, "a.h5"), "ab") as f:
+            f.write(b"\0")
+        result = runner.invoke(load, ["--incremental", "-o", store, os.path.join(self.test_dir, "a.h5"), os.path.join(self.test_dir, "b.h5")])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("keeps the earlier version", result.output)
+        result = runner.invoke(load, ["--incremental", "-o", store, os.path.join(self.test_dir, "a.h5"), os.path.join(self.test_dir, "b.h5")])
+        self.assertIn("is up to date", result.output)
+        self.assertEqual(store_sources(store), ["a.h5", "b.h5"])
+
+        # a file that is gone is changed rather than an error
+        manifest = Manifest(manifest_path(store))
+        os.remove(os.path.join(self.test_dir, "b.h5"))
+        self.assertTrue(manifest.changed(os.path.join(self.test_dir, "b.h5"), manifest.entry(os.path.join(self.test_dir, "a.h5"))['config'], store))
+
+    def test_load_many(self):
+        # two copies of the same file, loaded in parallel
+        for name in ("a.h5", "b.h5"):
+            shutil.copy(os.path.join(self.test_files_dir, "V3_15s.h5"), os.path.join(self.test_dir, name))
+
+        runner = CliRunner()
+        result = runner.invoke(load, 
+                    [
+                        "-j",
+                        "2",
+                        "-o",
+                        os.path.join(self.test_dir, "output.feather"),
+                        os.path.join(self.test_dir, "*.h5"),
+                    ]
+                )
+
+        # did it succeed?
+        self.assertEqual(result.exit_code, 0)
+
+        # were both files combined?
+        df = pd.read_feather(os.path.join(self.test_dir, "output.feather"))
+        self.assertEqual(df.shape[0], 30)
+
+        # one output per file
+        result = runner.invoke(load, 
+                    [
+                        "-j",
+                        "2",
+                        "-d",
+                        os.path.join(self.test_dir, "out"),
+                        os.path.join(self.test_dir, "a.h5"),
+                        os.path.join(self.test_dir, "b.h5"),
+                    ]
+                )
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertTrue(Path(self.test_dir + "/out/a.csv").exists())
+        self.assertTrue(Path(self.test_dir + "/out/b.csv").exists())
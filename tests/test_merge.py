@@ -42,6 +42,30 @@ class SetupTestCase(unittest.TestCase):
         
         # is it a csv?
         self.assertEqual(p.suffix, ".csv")
-      
 
+    def test_merge_files_tolerance(self):
+        t = pd.to_datetime(pd.read_csv(os.path.join(self.test_files_dir, "timeseries.csv"))["timestamp"], errors="coerce").dropna()
+        rows = t.shape[0]
 
+        # a sensor logging every other second, 200 ms after the mass spec, in another timezone
+        t = t.iloc[::2] + pd.Timedelta("200ms")
+        sensor = pd.DataFrame({"time": t.dt.tz_localize("UTC").dt.tz_convert("US/Eastern").astype(str), "temp": 1.0})
+        sensor.to_csv(os.path.join(self.test_dir, "sensor.csv"), index=False)
+
+        runner = CliRunner()
+        result = runner.invoke(merge, 
+                    [
+                        "-ts", "time",
+                        "-t", "500ms",
+                        "-o", os.path.join(self.test_dir, "output.csv"),
+                        os.path.join(self.test_files_dir, "timeseries.csv"),
+                        os.path.join(self.test_dir, "sensor.csv"),
+                    ],
+                    catch_exceptions=False
+                )
+        self.assertEqual(result.exit_code, 0)
+
+        # the rows of the first file, with the sensor joined to the rows within 500 ms
+        out = pd.read_csv(os.path.join(self.test_dir, "output.csv"))
+        self.assertEqual(out.shape[0], rows)
+        self.assertEqual(out["temp"].notna().sum(), sensor.shape[0])
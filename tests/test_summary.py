@@ -0,0 +1,88 @@
+import unittest
+from click.testing import CliRunner
+import os
+import shutil, tempfile
+import numpy as np
+import pandas as pd
+
+from tofspec.cli import summary
+from tofspec.load import load_vocus_data
+from tofspec.summary import SpectrumSummary, summarize_file, summary_path
+
+
+class SetupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.test_files_dir = os.path.join(os.getcwd(), "tests/datafiles")
+
+        # the summaries are saved next to the files
+        for name in ("a.h5", "b.h5"):
+            shutil.copy(os.path.join(self.test_files_dir, "V3_15s.h5"), os.path.join(self.test_dir, name))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_summary(self):
+        runner = CliRunner()
+        result = runner.invoke(summary,
+                    [
+                        os.path.join(self.test_dir, "*.h5"),
+                        "-j",
+                        "2",
+                        "-o",
+                        os.path.join(self.test_dir, "summary.csv"),
+                    ],
+                    catch_exceptions=False
+                )
+
+        # did it succeed?
+        self.assertEqual(result.exit_code, 0)
+        self.assertTrue("Saving file" in result.output)
+
+        # the same as reducing the whole matrix, twice
+        timestamps, mass_axis, tof_data = load_vocus_data(os.path.join(self.test_files_dir, "V3_15s.h5"))
+        tof_data = tof_data[~np.isnat(timestamps)]
+        df = pd.read_csv(os.path.join(self.test_dir, "summary.csv"))
+        self.assertEqual(list(df.columns), ["mass", "mean", "sum", "max", "min", "count"])
+        np.testing.assert_allclose(df["mean"], tof_data.mean(axis=0), rtol=1e-6)
+        np.testing.assert_allclose(df["sum"], 2 * tof_data.sum(axis=0, dtype=np.float64), rtol=1e-6)
+        np.testing.assert_array_equal(df["max"], tof_data.max(axis=0))
+        np.testing.assert_array_equal(df["count"], 2 * tof_data.shape[0])
+
+        # every file got its sidecar
+        self.assertTrue(summary_path(os.path.join(self.test_dir, "a.h5")).exists())
+        self.assertTrue(summary_path(os.path.join(self.test_dir, "b.h5")).exists())
+
+    def test_summary_merge(self):
+        fpath = os.path.join(self.test_dir, "a.h5")
+        timestamps, mass_axis, tof_data = load_vocus_data(fpath)
+        valid = ~np.isnat(timestamps)
+        self.assertFalse(valid.all())
+
+        # block by block, merged in any order
+        first, second = SpectrumSummary(mass_axis), SpectrumSummary(mass_axis)
+        first.update(tof_data[:4], timestamps[:4])
+        second.update(tof_data[4:], timestamps[4:])
+        merged = second + first
+        # spectra without a timestamp (the empty buffers at the end of the file) are left out
+        np.testing.assert_allclose(merged.mean, tof_data[valid].mean(axis=0))
+        np.testing.assert_array_equal(merged.min, tof_data[valid].min(axis=0))
+        self.assertEqual(merged.n_spectra, valid.sum())
+        self.assertEqual(merged.start, pd.Timestamp(timestamps[valid].min()).value)
+        self.assertEqual(merged.end, pd.Timestamp(timestamps[valid].max()).value)
+
+        # the sidecar is read back, and written again once the file changes
+        s = summarize_file(fpath, max_memory=2**20)
+        np.testing.assert_allclose(s.sum, merged.sum)
+        sidecar = summary_path(fpath)
+        mtime = os.stat(sidecar).st_mtime_ns
+        np.testing.assert_array_equal(summarize_file(fpath).sum, s.sum)
+        self.assertEqual(os.stat(sidecar).st_mtime_ns, mtime)
+
+        os.utime(fpath, ns=(mtime + 10**9, mtime + 10**9))
+        summarize_file(fpath)
+        self.assertNotEqual(os.stat(sidecar).st_mtime_ns, mtime)
+
+        # a saved summary is an input like any other
+        s.save(os.path.join(self.test_dir, "campaign.npz"))
+        np.testing.assert_allclose(summarize_file(os.path.join(self.test_dir, "campaign.npz")).mean, s.mean)
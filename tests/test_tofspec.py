@@ -8,6 +8,8 @@ import yaml
 import tofspec
 import pytest
 import unittest
+import os
+import shutil, tempfile
 
 ## Should I eventually replace relative filepaths with Github raw user content links
 
@@ -33,6 +35,51 @@ class TestClass(unittest.TestCase):
         #test timestamps length matches metadata 
         assert len(self.metadata) == len(self.timestamps)
 
+    def test_times(self):
+        #timestamps are typed, and the empty buffers at the end of the file are masked
+        self.assertEqual(self.timestamps.dtype, np.dtype('datetime64[ns]'))
+        with h5py.File(short_data, "r") as f:
+            timestamps, valid = tofspec.get_times(f, mask=True)
+        self.assertEqual(valid.dtype, np.bool_)
+        np.testing.assert_array_equal(valid, ~np.isnat(timestamps))
+        self.assertTrue(valid[0])
+        self.assertFalse(valid[-1])
+
+    def test_iter_chunks(self):
+        #reading block by block gives back the same data as reading the whole file
+        blocks = list(tofspec.iter_vocus_chunks(short_data, rows=5, metadata=True))
+        self.assertGreater(len(blocks), 1)
+        for timestamps, tof_block, metadata in blocks:
+            self.assertLessEqual(tof_block.shape[0], 5)
+            self.assertEqual(tof_block.shape[0], len(timestamps))
+            self.assertEqual(tof_block.shape[0], len(metadata))
+
+        np.testing.assert_array_equal(np.concatenate([b[1] for b in blocks]), self.tof_data)
+        np.testing.assert_array_equal(np.concatenate([b[2] for b in blocks]), self.metadata)
+        self.assertEqual(pd.isnull(np.concatenate([b[0] for b in blocks])).sum(), pd.isnull(self.timestamps).sum())
+
+    def test_projected_load(self):
+        #reading only the bins of the peak list integrates to the same values as reading every bin
+        timestamps, mass_axis, tof_data = tofspec.load_vocus_data(short_data, peak_list="tofspec/config/peak-list.yml")
+        self.assertLess(len(mass_axis), len(self.mass_axis))
+        self.assertEqual(tof_data.shape, (len(timestamps), len(mass_axis)))
+
+        projected = tofspec.time_series_df_from_yaml(tof_data, mass_axis, peak_list="tofspec/config/peak-list.yml", cache=False)
+        full = tofspec.time_series_df_from_yaml(self.tof_data, self.mass_axis, peak_list="tofspec/config/peak-list.yml", cache=False)
+        np.testing.assert_allclose(projected.to_numpy(), full.to_numpy())
+
+        spans = tofspec.get_bin_spans(np.arange(100.), [(10, 12), (11, 15), (16, 17), (50, 60)])
+        np.testing.assert_array_equal(spans, [[9, 19], [49, 62]])
+
+        #a window edge just past the last bin it holds, at the end of the projected mass axis
+        k = 40298
+        window = (self.mass_axis[k - 3], self.mass_axis[k] + 0.4 * (self.mass_axis[k + 1] - self.mass_axis[k]))
+        timestamps, mass_axis, tof_data = tofspec.load_vocus_data(short_data, mass_ranges=[window])
+        projected = tofspec.integrate.integrate_peak(tof_data.astype(np.float64), mass_axis, tofspec.integrate.find_indices(mass_axis, *window))
+        full = tofspec.integrate.integrate_peak(self.tof_data.astype(np.float64), self.mass_axis, tofspec.integrate.find_indices(self.mass_axis, *window))
+        self.assertGreater(full.sum(), 0)
+        np.testing.assert_allclose(projected, full)
+
     def test_config(self):
         #test config file is correct format
         #read in peak-list and check
@@ -48,6 +95,56 @@ class TestClass(unittest.TestCase):
         
         self.assertGreater(len(mf), 0)
 
+    def test_formula(self):
+        self.assertEqual(tofspec.parse_formula("C6H6+H+"), ((('C', 6), ('H', 7)), 1))
+        self.assertEqual(tofspec.format_formula((('Cl', 1), ('H', 5), ('O', 1), ('C', 6))), "C6H5ClO")
+
+        # the neutral formula of every ion, in Hill order
+        ions = ["C6H7+", "C10H15O2+", "HC6H6+", "H3O+", "NO+", "C2H3O2-", "C6H7+", None, "not a formula"]
+        self.assertEqual(list(tofspec.deionize(ions)), ["C6H6", "C10H14O2", "C6H6", "H2O", "NO", "C2H4O2", "C6H6", None, None])
+
+    def test_safe_load(self):
+        #feather files are downcast to float32 and can be projected / filtered while reading
+        test_dir = tempfile.mkdtemp()
+        try:
+            fpath = os.path.join(test_dir, "long.feather")
+            pd.read_csv("tests/datafiles/long.csv").to_feather(fpath)
+
+            df = tofspec.safe_load(fpath)
+            self.assertEqual(df.shape, (264, 4))
+            self.assertEqual(df['C5H8'].dtype, np.float32)
+
+            df = tofspec.safe_load(fpath, columns=['C5H8'], start='2022-02-22 14:13', end='2022-02-22 14:14')
+            self.assertEqual(list(df.columns), ['C5H8'])
+            self.assertEqual(df.shape[0], 60)
+
+            #feather V1 files are not Arrow IPC files, but are read all the same
+            v1 = os.path.join(test_dir, "long_v1.feather")
+            pd.read_csv("tests/datafiles/long.csv").to_feather(v1, version=1)
+            pd.testing.assert_frame_equal(tofspec.safe_load(v1, columns=['C5H8'], start='2022-02-22 14:13', end='2022-02-22 14:14'), df)
+            self.assertEqual(tofspec.safe_load(v1).shape, (264, 4))
+
+            df = tofspec.safe_load("tests/datafiles/long.csv", columns=['timestamp', 'C5H8'], nrows=10)
+            self.assertEqual(df.shape, (10, 2))
+            self.assertEqual(df['C5H8'].dtype, np.float32)
+        finally:
+            shutil.rmtree(test_dir)
+
+    def test_safe_load_arrow(self):
+        #the arrow csv engine must read the same data as pandas
+        for f in ("tests/datafiles/long.csv", "tests/datafiles/test_compounds.csv", "tests/datafiles/test_config_ion.csv"):
+            df = tofspec.safe_load(f)
+            ref = tofspec.safe_load(f, engine='pandas')
+            self.assertEqual(list(df.columns), list(ref.columns))
+            self.assertEqual(df.shape, ref.shape)
+            for c in ref.select_dtypes('float32').columns:
+                self.assertEqual(df[c].dtype, np.float32)
+                np.testing.assert_array_equal(df[c].to_numpy(), ref[c].to_numpy())
+
+        #reading stops as soon as nrows are read, whatever the block size
+        df = tofspec.safe_load("tests/datafiles/long.csv", columns=['C5H8'], nrows=30, block_size=100)
+        self.assertEqual(df.shape, (30, 1))
+
     def test_integration(self):
         #for these two util tests make sure you get the right answer
         #test find indices in sorted array based on value range
@@ -62,7 +159,99 @@ class TestClass(unittest.TestCase):
         self.assertGreaterEqual(integrated_peak, 0.2657)
         self.assertLessEqual(integrated_peak, 0.2659)
 
-    def test_time_series(self):        
+    def test_integrate_peaks(self):
+        #batched integration must match integrating each peak on its own
+        peak_list_dict = tofspec.utils.read_yaml("tofspec/config/peak-list.yml")
+        mf, smiles, min, max = tofspec.utils.peak_list_from_dict(peak_list_dict)
+        indices = [tofspec.integrate.find_indices(self.mass_axis, lo, hi) for lo, hi in zip(min, max)]
+        indices += [[0, 0], [5, 3], [100, 200]]
+
+        tof_data = self.tof_data.astype(np.float32)
+        expected = np.stack([tofspec.integrate.integrate_peak(tof_data, self.mass_axis, i) for i in indices], axis=1)
+        integrated = tofspec.integrate.integrate_peaks(tof_data, self.mass_axis, indices)
+
+        self.assertEqual(integrated.shape, expected.shape)
+        np.testing.assert_allclose(integrated, expected, rtol=1e-4, atol=1e-4)
+
+    def test_integration_plan(self):
+        #a compiled plan integrates the same as the one-shot path and is reused from the disk cache
+        cache_dir = tempfile.mkdtemp()
+        tofspec.plan._plans.clear()
+        try:
+            plan = tofspec.get_integration_plan(self.mass_axis, "tofspec/config/peak-list.yml", cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            tofspec.plan._plans.clear()
+            cached = tofspec.get_integration_plan(self.mass_axis, "tofspec/config/peak-list.yml", cache_dir=cache_dir)
+            np.testing.assert_array_equal(plan.data, cached.data)
+            self.assertEqual(plan.names('mf'), cached.names('mf'))
+
+            tof_data = self.tof_data.astype(np.float32)
+            peak_list_dict = tofspec.utils.read_yaml("tofspec/config/peak-list.yml")
+            mf, smiles, min, max = tofspec.utils.peak_list_from_dict(peak_list_dict)
+            indices = [tofspec.integrate.find_indices(self.mass_axis, lo, hi) for lo, hi in zip(min, max)]
+            expected = tofspec.integrate.integrate_peaks(tof_data, self.mass_axis, indices)
+
+            np.testing.assert_allclose(cached.integrate(tof_data), expected, rtol=1e-4, atol=1e-4)
+            np.testing.assert_allclose(tof_data[:, cached.columns] @ cached.matrix(), expected, rtol=1e-4, atol=1e-4)
+
+            # the in-process memo only keeps the plans used last
+            for i in range(tofspec.plan._MAX_PLANS + 2):
+                tofspec.get_integration_plan(self.mass_axis + (i + 1) * 1e-3, "tofspec/config/peak-list.yml", cache_dir=cache_dir)
+            self.assertEqual(len(tofspec.plan._plans), tofspec.plan._MAX_PLANS)
+            self.assertNotIn(tofspec.plan_key(self.mass_axis, "tofspec/config/peak-list.yml"), tofspec.plan._plans)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_integrate_peaks_shifted(self):
+        #windows moved by a different drift in every spectrum match integrating each of them on its own
+        peak_list_dict = tofspec.utils.read_yaml("tofspec/config/peak-list.yml")
+        mf, smiles, min, max = tofspec.utils.peak_list_from_dict(peak_list_dict)
+        lower, upper = np.array(min), np.array(max)
+
+        tof_data = self.tof_data.astype(np.float64)
+        shift = np.linspace(-80, 80, tof_data.shape[0])
+        expected = np.array([[tofspec.integrate.integrate_peak(tof_data[i:i + 1], self.mass_axis,
+                                tofspec.integrate.find_indices(self.mass_axis, lo * (1 + s * 1e-6), hi * (1 + s * 1e-6)))[0]
+                                for lo, hi in zip(lower, upper)] for i, s in enumerate(shift)])
+        integrated = tofspec.integrate.integrate_peaks_shifted(tof_data, self.mass_axis, lower, upper, shift)
+        np.testing.assert_allclose(integrated, expected, rtol=1e-6, atol=1e-6)
+
+        #without drift, the same as the compiled plan, also from only the bins that it covers
+        plan = tofspec.IntegrationPlan.from_yaml(self.mass_axis, "tofspec/config/peak-list.yml")
+        integrated = tofspec.integrate.integrate_peaks_shifted(tof_data[:, plan.columns], self.mass_axis[plan.columns],
+                                                                lower, upper, 0.0, columns=plan.columns)
+        np.testing.assert_allclose(integrated, plan.integrate(tof_data), rtol=1e-6, atol=1e-6)
+
+    def test_drift_correction(self):
+        #the drift of synthetic spectra is measured from their reference ions
+        reference, analytes = [37.0284, 55.0390], [59.0491, 79.0542]
+        shift = np.linspace(-60, 60, 20)
+        x = self.mass_axis
+        tof_data = np.zeros((shift.shape[0], x.shape[0]))
+        for i, s in enumerate(shift):
+            for m, h in zip(reference + analytes, [5e4, 5e4, 2e3, 2e3]):
+                sigma = m / 5000 / 2.355
+                tof_data[i] += h * np.exp(-0.5 * ((x - m * (1 + s * 1e-6)) / sigma) ** 2)
+
+        measured = tofspec.DriftCorrection(reference, per_row=True).shifts(tof_data, x)
+        np.testing.assert_allclose(measured, shift, atol=1)
+
+        block = tofspec.DriftCorrection(reference).shifts(tof_data, x)
+        np.testing.assert_allclose(block, shift.mean(), atol=1)
+
+        #no reference ion: the last drift is kept
+        np.testing.assert_array_equal(tofspec.DriftCorrection([500.0]).shifts(tof_data, x, fill=7.0), 7.0)
+
+        #the windows follow the drift, reading only the bins that they may cover
+        plan = tofspec.IntegrationPlan(x, np.array(analytes) * (1 - 1e-4), np.array(analytes) * (1 + 1e-4))
+        corrected = tofspec.DriftCorrectedPlan(plan, x, tofspec.DriftCorrection(reference, per_row=True))
+        integrated = corrected.integrate(tof_data[:, corrected.columns])
+        expected = tofspec.integrate.integrate_peaks_shifted(tof_data, x, plan.lower, plan.upper, shift)
+        np.testing.assert_allclose(integrated, expected, rtol=1e-2)
+        np.testing.assert_allclose(corrected.integrate(tof_data), integrated)
+
+    def test_time_series(self):
         #test time series df with user input masses
         user_input_df = tofspec.get_time_series_df(self.tof_data, self.mass_axis, [42, 69, 71], names=['Ethanol', 'Isoprene', 'MVK'])
         self.assertIsInstance(user_input_df, pd.DataFrame)
@@ -89,4 +278,58 @@ class TestClass(unittest.TestCase):
 
     def test_label(self):
         grouped_df = tofspec.group_time_series_df(tofspec.time_series_df_from_yaml(self.tof_data, self.mass_axis, peak_list="tofspec/config/peak-list.yml"), lookup_table="tofspec/db/database.feather")
-        self.assertIsInstance(grouped_df, pd.DataFrame)
\ No newline at end of file
+        self.assertIsInstance(grouped_df, pd.DataFrame)
+    def test_group_sums(self):
+        test_dir = tempfile.mkdtemp()
+
+        # a compound may be listed more than once, and only its columns in the time series count
+        lookup = pd.DataFrame({'mf': ['C2H6O', 'C2H6O', 'C3H6O', 'C4H8O'], 'smiles': ['CCO', 'OCC', 'CC(C)=O', 'CCC(C)=O'],
+                                'alcohol': [1, 0, 0, 0], 'ketone': [0, 0, 1, 1], 'none': [0, 0, 0, 0]})
+        lookup.to_feather(os.path.join(test_dir, "lookup.feather"))
+
+        df = pd.DataFrame({'C2H6O': [1., 2.], 'C3H6O': [10., np.nan], 'C5H8': [100., 200.]})
+        grouped_df = tofspec.group_time_series_df(df, lookup_table=os.path.join(test_dir, "lookup.feather"), columns='mf')
+
+        self.assertEqual(list(grouped_df.columns), ['alcohol', 'ketone', 'none'])
+        np.testing.assert_array_equal(grouped_df.to_numpy(), [[1., 10., 0.], [2., 0., 0.]])
+
+        # columns in no group (e.g. those kept with `label -i`) are left alone, even if they are not numeric
+        df['site'] = ['north', 'south']
+        grouped_df = tofspec.group_time_series_df(df, lookup_table=os.path.join(test_dir, "lookup.feather"), columns='mf')
+        np.testing.assert_array_equal(grouped_df.to_numpy(), [[1., 10., 0.], [2., 0., 0.]])
+
+        shutil.rmtree(test_dir)
+
+    def test_functional_group_db(self):
+        test_dir = tempfile.mkdtemp()
+
+        lookup = pd.DataFrame({'mf': ['C2H6O', 'C2H6O', 'C3H6O'], 'smiles': ['CCO', 'COC', 'CC(C)=O'],
+                                'alcohol': [1, 0, 0], 'ether': [0, 1, 0], 'ketone': [0, 0, 1]})
+        lookup.to_feather(os.path.join(test_dir, "lookup.feather"))
+
+        db = tofspec.get_functional_group_db(os.path.join(test_dir, "lookup.feather"))
+        self.assertIs(db, tofspec.get_functional_group_db(os.path.join(test_dir, "lookup.feather")))
+        self.assertEqual(db.groups, ['alcohol', 'ether', 'ketone'])
+
+        # the groups of every row of a formula, and the first SMILES of a formula
+        np.testing.assert_array_equal(db.membership(['C2H6O', 'C5H8']), [[False] * 3] * 2)
+        np.testing.assert_array_equal(db.membership(['C2H6O', 'C5H8'], 'mf'), [[True, True, False], [False, False, False]])
+        np.testing.assert_array_equal(db.membership(['COC'], 'smiles'), [[False, True, False]])
+        self.assertEqual(list(db.first_smiles(['C3H6O', 'C2H6O', 'C5H8'])), ['CC(C)=O', 'CCO', None])
+
+        shutil.rmtree(test_dir)
+
+    def test_mass_index(self):
+        np.testing.assert_allclose(tofspec.protonated_mz(['C6H6', 'C5H8', 'H2O']), [79.054227, 69.069877, 19.017841], atol=1e-6)
+
+        index = tofspec.MassIndex(tofspec.protonated_mz(['C6H6', 'C5H8', 'C4H4O', 'C6H6']), ['C6H6', 'C5H8', 'C4H4O', 'C6H6'], ['a', 'b', 'c', 'd'])
+
+        # C5H8 and C4H4O are 36 mDa apart, so 10 ppm tells them apart but 1000 ppm does not
+        df = index.query([69.0699, 79.0542, 100.0], ppm=10)
+        self.assertEqual(list(df['query']), [0, 1, 1])
+        self.assertEqual(list(df['smiles']), ['b', 'a', 'd'])
+        self.assertTrue((df['ppm'].abs() < 10).all())
+        self.assertEqual(list(index.count([69.0699, 79.0542, 100.0], ppm=1000)), [2, 2, 0])
+
+        df = index.within([69.0, 79.0], [69.1, 79.1])
+        self.assertEqual(list(df['mf']), ['C4H4O', 'C5H8', 'C6H6', 'C6H6'])
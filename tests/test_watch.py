@@ -0,0 +1,114 @@
+import unittest
+from click.testing import CliRunner
+from pathlib import Path
+import os
+import time
+import shutil, tempfile
+import multiprocessing
+import threading
+from unittest import mock
+import h5py
+import pandas as pd
+import numpy as np
+
+from tofspec.cli import watch, integrate_peaks
+from tofspec.load import load_vocus_data
+from tofspec.watch import follow_vocus_file
+
+def acquire(source, fpath, delay):
+    # stand-in for the instrument: copy the writes of source into fpath one by one, in SWMR mode
+    with h5py.File(source, "r") as src, h5py.File(fpath, "w", libver='latest') as f:
+        f.create_dataset('AcquisitionLog/Log', data=src['AcquisitionLog/Log'][:], maxshape=(None,), chunks=(1,))
+        f.create_dataset('FullSpectra/MassAxis', data=src['FullSpectra/MassAxis'][:])
+        datasets = {}
+        for name in ('FullSpectra/TofData', 'TimingData/BufTimes', 'TPS2/TwData'):
+            ds = src[name]
+            datasets[name] = f.create_dataset(name, shape=(0,) + ds.shape[1:], maxshape=(None,) + ds.shape[1:],
+                                                dtype=ds.dtype, chunks=(1,) + ds.shape[1:])
+        f.swmr_mode = True
+
+        for w in range(src['FullSpectra/TofData'].shape[0]):
+            time.sleep(delay)
+            # the buffer times go last, as they mark the write as complete
+            for name in ('FullSpectra/TofData', 'TPS2/TwData', 'TimingData/BufTimes'):
+                datasets[name].resize(w + 1, axis=0)
+                datasets[name][w] = src[name][w]
+                datasets[name].flush()
+
+class SetupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.test_files_dir = os.path.join(os.getcwd(), "tests/datafiles")
+        self.source = os.path.join(self.test_files_dir, "V3_15s.h5")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def start_writer(self, fpath, delay=0.2):
+        writer = multiprocessing.Process(target=acquire, args=(self.source, fpath, delay))
+        writer.start()
+        # wait until the file can be opened by a reader
+        for _ in range(100):
+            try:
+                with h5py.File(fpath, "r", libver='latest', swmr=True):
+                    break
+            except (OSError, ValueError):
+                time.sleep(0.05)
+        return writer
+
+    def test_follow(self):
+        fpath = os.path.join(self.test_dir, "live.h5")
+        writer = self.start_writer(fpath)
+
+        blocks = list(follow_vocus_file(fpath, metadata=True, poll=0.05, timeout=1))
+        writer.join()
+
+        # the spectra arrive write by write, and add up to the whole file
+        timestamps, mass_axis, tof_data, metadata = load_vocus_data(self.source, metadata=True)
+        self.assertGreater(len(blocks), 1)
+        np.testing.assert_array_equal(np.concatenate([b[0] for b in blocks]), timestamps)
+        np.testing.assert_array_equal(np.concatenate([b[1] for b in blocks]), tof_data)
+        np.testing.assert_array_equal(np.concatenate([b[2] for b in blocks]), metadata)
+
+    def test_follow_reopen(self):
+        fpath = os.path.join(self.test_dir, "live.h5")
+        shutil.copy(self.source, fpath)
+
+        def hide():
+            # the file can not be opened for a few polls, e.g. while the instrument holds it
+            time.sleep(0.2)
+            os.rename(fpath, fpath + ".tmp")
+            time.sleep(0.3)
+            os.rename(fpath + ".tmp", fpath)
+
+        # a file written without SWMR is reopened on every poll
+        with mock.patch("tofspec.watch.open_vocus_swmr", lambda file: (h5py.File(file, "r"), False)):
+            mover = threading.Thread(target=hide)
+            mover.start()
+            blocks = list(follow_vocus_file(fpath, poll=0.05, timeout=1))
+            mover.join()
+
+        timestamps, mass_axis, tof_data = load_vocus_data(self.source)
+        np.testing.assert_array_equal(np.concatenate([b[0] for b in blocks]), timestamps)
+        np.testing.assert_array_equal(np.concatenate([b[1] for b in blocks]), tof_data)
+
+    def test_watch(self):
+        fpath = os.path.join(self.test_dir, "live.h5")
+        writer = self.start_writer(fpath)
+
+        runner = CliRunner()
+        result = runner.invoke(watch, ["--poll", "0.05", "--timeout", "1", "-o", os.path.join(self.test_dir, "live.csv"), fpath])
+        writer.join()
+
+        # did it succeed?
+        self.assertEqual(result.exit_code, 0)
+        self.assertTrue("Appended" in result.output)
+
+        # the same rows as integrating the finished file
+        result = runner.invoke(integrate_peaks, ["-o", os.path.join(self.test_dir, "done.csv"), self.source])
+        self.assertEqual(result.exit_code, 0)
+
+        df = pd.read_csv(os.path.join(self.test_dir, "live.csv"))
+        ref = pd.read_csv(os.path.join(self.test_dir, "done.csv"))
+        self.assertEqual(df.shape, ref.shape)
+        np.testing.assert_allclose(df.iloc[:, 1:].to_numpy(), ref.iloc[:, 1:].to_numpy(), rtol=1e-6)
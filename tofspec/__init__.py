@@ -2,5 +2,15 @@ __version__ = '0.1.0'
 
 from .utils import *
 from .integrate import *
+from .plan import *
 from .load import *
+from .cube import *
+from .store import *
+from .watch import *
+from .drift import *
+from .summary import *
+from .stream import *
+from .formula import *
+from .groups import *
+from .substructures import *
 from .models import *
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import rich_click as click
+from pathlib import Path
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+
+from .utils import write_df
+
+
+def run_batch(func, items, **kwargs):
+    """
+    Apply func to every item, in a pool of worker processes. Results are yielded in the order of
+    items, whatever order the workers finish in, and an exception raised for one item is returned in
+    place of its result rather than stopping the batch. Only about two items per process are submitted
+    ahead of the one being yielded, so that results waiting to be consumed do not pile up in memory.
+
+    :param func: module-level (picklable) function of a single item
+    :type func: callable
+    :param items: inputs of func
+    :type items: list
+
+    Optional Arguments
+    ------------------
+    :param processes: number of worker processes. 1 runs everything in this process,
+                        0 or None uses one process per CPU. (default = 1)
+    :type processes: int
+    :param initializer: called once in every worker before any item, e.g. to load a peak list or lookup table
+    :type initializer: callable
+    :param initargs: arguments of initializer
+    :type initargs: tuple
+
+    :return: generator of (item, result, error) tuples, where error is None on success
+    :rtype: generator
+    """
+    processes = kwargs.pop('processes', 1)
+    initializer = kwargs.pop('initializer', None)
+    initargs = kwargs.pop('initargs', ())
+
+    items = list(items)
+    if not processes:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(items))
+
+    if processes <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for item in items:
+            try:
+                yield item, func(item), None
+            except Exception as e:
+                yield item, None, e
+        return
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=initializer, initargs=initargs) as executor:
+        pending = deque()
+        queue = iter(items)
+        for item in islice(queue, 2 * processes):
+            pending.append((item, executor.submit(func, item)))
+
+        while pending:
+            item, future = pending.popleft()
+            try:
+                result, error = future.result(), None
+            except Exception as e:
+                result, error = None, e
+            del future
+            # keep the pool busy while this result is consumed
+            for nxt in islice(queue, 1):
+                pending.append((nxt, executor.submit(func, nxt)))
+            yield item, result, error
+
+def save_result(func, task):
+    """
+    Write the dataframe that func returns for a file to its output, see `write_df`. To be run by
+    `run_batch` (or `run_outdir`) over (file, output) tasks.
+
+    :param func: module-level (picklable) function of a single file that returns a pd.DataFrame
+    :type func: callable
+    :param task: (file, output) paths
+    :type task: tuple
+
+    :return: the output path
+    :rtype: str
+    """
+    file, output = task
+    write_df(func(file), output)
+    return output
+
+def run_outdir(func, files, outdir, suffix, **kwargs):
+    """
+    Process every file into an output of its own in outdir, named after the file with the given suffix,
+    in a pool of worker processes (see `run_batch`). With a manifest, the files that did not change
+    since the last run are left out and the others are recorded once their output is written.
+
+    :param func: module-level (picklable) function of a (file, output) task that writes the output
+                and returns its path, e.g. `partial(save_result, f)`
+    :type func: callable
+    :param files: input filepaths
+    :type files: list
+    :param outdir: directory of the outputs, created if needed
+    :type outdir: str
+    :param suffix: extension of the outputs, e.g. '.csv'
+    :type suffix: str
+
+    Optional Arguments
+    ------------------
+    :param manifest: record of the files processed so far. (default = None)
+    :type manifest: Manifest
+    :param config: hash of the settings, see `config_hash`. (default = None)
+    :type config: str
+    :param action: verb of the error messages, e.g. 'integrate'. (default = 'process')
+    :type action: str
+
+    The other optional arguments are those of `run_batch`.
+    """
+    manifest = kwargs.pop('manifest', None)
+    config = kwargs.pop('config', None)
+    action = kwargs.pop('action', 'process')
+
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    tasks = [(f, str(outdir / (Path(f).stem + suffix))) for f in files]
+    if manifest is not None:
+        tasks = [t for t in tasks if manifest.changed(t[0], config, t[1])]
+        if not tasks:
+            click.secho("{} is up to date".format(outdir), fg='green')
+            manifest.save()
+            return
+
+    failed = 0
+    for (f, out), _, error in run_batch(func, tasks, **kwargs):
+        if error is not None:
+            failed += 1
+            click.secho("Failed to {} {}: {}".format(action, f, error), fg='red')
+        else:
+            click.secho("Saving file to {}".format(out), fg='green')
+            if manifest is not None:
+                manifest.record(f, out, config)
+
+    if manifest is not None:
+        manifest.save()
+
+    if failed == len(tasks):
+        raise Exception("No data")
@@ -16,11 +16,15 @@ def main(ctx):
 #add concat command
 @click.command("concat", short_help="concatenate files together")
 @click.argument("files", nargs=-1, type=click.Path())
+@click.option("-ts", "--tscol", default="timestamp", help="The column by which to sort the rows", type=str)
+@click.option("--dedupe", is_flag=True, default=False, help="Keep only the first row of every timestamp (in the order of FILES)")
 @click.option("-o", "--output", default="output.csv", help="The filepath where you would like to save the file", type=str)
 def concat(files, output, **kwargs):
     """Concatenate FILES together and save to OUTPUT.
     FILES is the collection or list of files that you are concatenating together. They 
     can be provided as a list or by using a wildcard and providing the path with wildcard.
+    Every file must be sorted by time; they are merged block by block, so that FILES
+    do not need to fit in memory.
     """
     from .commands.concat import concat_command
 
@@ -29,6 +33,7 @@ def concat(files, output, **kwargs):
 @click.command("merge", short_help="merge two files together on their timestamp")
 @click.argument("files", nargs=-1, type=click.Path())
 @click.option("-ts", "--tscol", default="timestamp", help="The column by which to join the files", type=str)
+@click.option("-t", "--tolerance", default=None, help="Join every file onto the timestamps of the first file, to the nearest row within TOLERANCE (e.g. 5s)", type=str)
 @click.option("-o", "--output", default="output.csv", help="The filepath where you would like to save the file", type=str)
 @click.option("-v", "--verbose", is_flag=True, help="Enable verbose mode (debugging)")
 def merge(files, tscol, output, verbose, **kwargs):
@@ -57,49 +62,124 @@ def config(file, output, **kwargs):
 
 #add load command
 @click.command("load", short_help="parse raw mass spec data files")
-@click.argument("file", nargs=1, type=click.Path())
-@click.option("-i", "--instrument", default="vocus", help="The instrument that FILE comes from", type=str)
-@click.option("-f", "--format", default="h5", help="The format/file extension of FILE", type=str)
+@click.argument("files", nargs=-1, required=True, type=click.Path())
+@click.option("-i", "--instrument", default="vocus", help="The instrument that FILES come from", type=str)
+@click.option("-f", "--format", default="h5", help="The format/file extension of FILES", type=str)
 @click.option("-m", "--metadata", is_flag=True, default=False, help="Does the file include metadata?")
+@click.option("-j", "--jobs", default=1, help="Number of files to load in parallel (0 = one per CPU)", type=int)
+@click.option("-d", "--outdir", default=None, help="Save one file per input in this directory (in the format of OUTPUT) instead of combining them", type=click.Path())
+@click.option("-a", "--append", is_flag=True, default=False, help="Append FILES to OUTPUT, a campaign store (.h5), instead of replacing it")
+@click.option("-I", "--incremental", is_flag=True, default=False, help="Only process FILES that are new or changed since the last run (see the manifest next to OUTPUT or in OUTDIR) and add them to OUTDIR or the campaign store")
+@click.option("-r", "--resample", default=None, help="Average the spectra to this cadence (e.g. 10s, 1min) while FILES are read", type=str)
 @click.option("-o", "--output", default="output.csv", help="The filepath where you would like to save the file", type=str)
-def load(file, output, **kwargs):
-    """Parse mass spec FILE and save relevant data to OUTPUT.
-    Read TOF data matrix from FILE. The structure of FILE is determined by the 
+def load(files, output, **kwargs):
+    """Parse mass spec FILES and save relevant data to OUTPUT.
+    Read TOF data matrix from FILES. The structure of FILES is determined by the 
     optional --instrument and --format arguments. Currently, only 'vocus' and 'h5' are accepted.
+    FILES can be one or more files or a wildcard; several files are combined into OUTPUT in the order given,
+    or saved one by one with --outdir. OUTPUT can be a .csv or .feather file, a .tofcube spectral cube
+    that later commands memory-map instead of parsing, or a .h5 campaign store that --append adds FILES to.
     """
     from .commands.load import load_command
 
-    load_command(file, output, **kwargs)
+    load_command(files, output, **kwargs)
 
 #add integrate peaks command
 @click.command("integrate-peaks", short_help="integrate ion peaks in raw mass spec data")
-@click.argument("file", nargs=1, type=click.Path())
+@click.argument("files", nargs=-1, required=True, type=click.Path())
 @click.option("-c", "--config", default=path.join(path.dirname(__file__), '../config/peak-list.yml'), help="The peak list .yml file that guides the integration process", type=click.Path())
 @click.option("-ts", "--tscol", help="Column in FILE which contains timestamps")
 @click.option("-i", "--ignore", help="Names of metadata column(s) which should be ignored in the integration and passed to OUTPUT untouched")
 @click.option("-col", "--columns", type=click.Choice(['smiles', 'mf'], case_sensitive=False),  default='smiles', help="Choose either molecular formula (`mf`) or SMILES string (`smiles`) as the column names of OUTPUT")
+@click.option("-m", "--metadata", is_flag=True, default=False, help="Pass the instrument metadata to OUTPUT (only when FILE is a Vocus .h5 file or a .tofcube)")
+@click.option("-j", "--jobs", default=1, help="Number of files to integrate in parallel (0 = one per CPU)", type=int)
+@click.option("-d", "--outdir", default=None, help="Save one file per input in this directory (in the format of OUTPUT) instead of combining them", type=click.Path())
+@click.option("-I", "--incremental", is_flag=True, default=False, help="Only process FILES that are new or changed since the last run (see the manifest next to OUTPUT or in OUTDIR) and merge their results into OUTPUT")
+@click.option("-r", "--resample", default=None, help="Average the spectra to this cadence (e.g. 10s, 1min) before they are integrated (only when FILES are Vocus .h5 files or campaign stores)", type=str)
+@click.option("-R", "--reference", default=None, help="Comma-separated m/Q of reference ions (e.g. 37.0284,55.0390) whose centroids measure the mass calibration drift that the peak windows then follow (only when FILES are Vocus .h5 files, campaign stores or .tofcube spectral cubes)", type=str)
+@click.option("--drift", type=click.Choice(['block', 'row'], case_sensitive=False), default='block', help="Correct every block of spectra by its mean drift, or every spectrum by its own")
+@click.option("--max-shift", default=100.0, help="Largest drift (ppm) that is corrected", type=float)
 @click.option("-o", "--output", default="output.csv", help="The filepath where you would like to save the file", type=str)
-def integrate_peaks(file, output, **kwargs):
-    """Convert FILE, a matrix of raw PTR-TOF-MS data (TOF bins X timestamps) to a time series of
+def integrate_peaks(files, output, **kwargs):
+    """Convert FILES, matrices of raw PTR-TOF-MS data (TOF bins X timestamps) to a time series of
          integrated ion counts/concentrations for ions specified in the peak list (CONFIG).
+         FILES can also be raw Vocus .h5 files, which are integrated directly without a `load` step,
+         or .tofcube spectral cubes written by `load`, which are memory-mapped rather than read.
+         Several files are combined into OUTPUT in time order, or saved one by one with --outdir.
     """
     from .commands.integrate_peaks import integrate_peaks_command
 
-    integrate_peaks_command(file, output, **kwargs)
+    integrate_peaks_command(files, output, **kwargs)
 
 @click.command("label", short_help="sum compounds counts/concentrations by substructure")
-@click.argument("file", nargs=1, type=click.Path())
+@click.argument("files", nargs=-1, required=True, type=click.Path())
 @click.option("-ts", "--tscol", help="column in FILE which contains timestamps")
 @click.option("-i", "--ignore", help="names of metadata column(s) which should not be included in the integration but should be passed to OUTPUT")
 @click.option("-col", "--columns", type=click.Choice(['smiles', 'mf'], case_sensitive=False),  default='smiles', help="choose either molecular formula (`mf`) or SMILES string (`smiles`) as the column names of FILE")
+@click.option("-j", "--jobs", default=1, help="Number of files to label in parallel (0 = one per CPU)", type=int)
+@click.option("-d", "--outdir", default=None, help="Save one file per input in this directory (in the format of OUTPUT) instead of combining them", type=click.Path())
+@click.option("-I", "--incremental", is_flag=True, default=False, help="Only process FILES that are new or changed since the last run (see the manifest next to OUTPUT or in OUTDIR) and merge their results into OUTPUT")
 @click.option("-o", "--output", default="output.csv", help="The filepath where you would like to save the file", type=str)
-def label(file, output, **kwargs):
-    """Convert FILE, a matrix of compound counts/concentrations, to a time series of integrated
+def label(files, output, **kwargs):
+    """Convert FILES, matrices of compound counts/concentrations, to a time series of integrated
         substructure/functional group concentrations. For more info on how to choose different substructures...
+        Several files are combined into OUTPUT in time order (by TSCOL), or saved one by one with --outdir.
     """
     from .commands.label import label_command
 
-    label_command(file, output, **kwargs)
+    label_command(files, output, **kwargs)
+
+
+#add watch command
+@click.command("watch", short_help="integrate a Vocus file while it is being acquired")
+@click.argument("file", nargs=1, type=click.Path())
+@click.option("-c", "--config", default=path.join(path.dirname(__file__), '../config/peak-list.yml'), help="The peak list .yml file that guides the integration process", type=click.Path())
+@click.option("-col", "--columns", type=click.Choice(['smiles', 'mf'], case_sensitive=False),  default='smiles', help="Choose either molecular formula (`mf`) or SMILES string (`smiles`) as the column names of OUTPUT")
+@click.option("-m", "--metadata", is_flag=True, default=False, help="Pass the instrument metadata to OUTPUT")
+@click.option("-p", "--poll", default=1.0, help="Seconds between two looks at FILE", type=float)
+@click.option("-t", "--timeout", default=None, help="Stop once FILE has not grown for this many seconds (default: run until interrupted)", type=float)
+@click.option("-o", "--output", default="output.csv", help="The .csv filepath that integrated rows are appended to", type=str)
+def watch(file, output, **kwargs):
+    """Follow FILE, a Vocus .h5 file that the instrument is still writing, and integrate the peaks of
+        the peak list (CONFIG) in every new write as soon as it is complete. The integrated rows are
+        appended to OUTPUT, so that it can be read while the acquisition goes on.
+    """
+    from .commands.watch import watch_command
+
+    watch_command(file, output, **kwargs)
+
+#add summary command
+@click.command("summary", short_help="time-averaged mass spectrum of raw mass spec data")
+@click.argument("files", nargs=-1, required=True, type=click.Path())
+@click.option("-j", "--jobs", default=1, help="Number of files to summarize in parallel (0 = one per CPU)", type=int)
+@click.option("--no-cache", "cache", is_flag=True, default=True, flag_value=False, help="Do not read or write the summary saved next to every file")
+@click.option("-o", "--output", default="summary.csv", help="The filepath where you would like to save the summary (.csv, .feather, or .npz to merge it later on)", type=str)
+def summary(files, output, **kwargs):
+    """Summarize the spectra of FILES, Vocus .h5 files, campaign stores or .tofcube spectral cubes, into
+        the mean, sum, max, min and count of every TOF bin. FILES are read block by block in a single pass,
+        and the summary of every file is saved next to it (<file>.summary.npz), so that later runs over
+        the same files only read the new ones.
+    """
+    from .commands.summary import summary_command
+
+    summary_command(files, output, **kwargs)
+
+#add build-db command
+@click.command("build-db", short_help="match substructures against the compound database")
+@click.argument("database", nargs=1, required=False, default=path.join(path.dirname(__file__), '../db/database.feather'), type=click.Path())
+@click.option("-s", "--substructures", default=path.join(path.dirname(__file__), '../db/substructures.yml'), help="The .yml file of substructures (name and SMARTS string) to label compounds with", type=click.Path())
+@click.option("-a", "--add", default=None, help="A .csv or .feather file of compounds (mf and smiles columns) to add to DATABASE", type=click.Path())
+@click.option("--full", is_flag=True, default=False, help="Match every substructure against every compound again, not only the new ones")
+@click.option("-j", "--jobs", default=0, help="Number of processes to match compounds in (0 = one per CPU)", type=int)
+@click.option("-o", "--output", default=None, help="The .feather filepath where you would like to save the database (default: DATABASE)", type=str)
+def build_db(database, **kwargs):
+    """Label every compound of DATABASE, the lookup table that `label` uses, with the substructures
+        of SUBSTRUCTURES, using RDKit. Only what is new is matched: substructures that are not in DATABASE
+        yet or whose SMARTS changed, and compounds that were added. DATABASE is replaced atomically.
+    """
+    from .commands.build_db import build_db_command
+
+    build_db_command(database, **kwargs)
 
 
 #add all commands
@@ -109,3 +189,6 @@ main.add_command(config)
 main.add_command(load)
 main.add_command(integrate_peaks)
 main.add_command(label)
+main.add_command(watch)
+main.add_command(summary)
+main.add_command(build_db)
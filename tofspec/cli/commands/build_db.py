@@ -0,0 +1,21 @@
+from pathlib import Path
+import rich_click as click
+
+from ...exceptions import InvalidFileExtension
+from ...substructures import build_database
+
+
+def build_db_command(database, **kwargs):
+    output = kwargs.pop("output", None) or database
+    jobs = kwargs.pop("jobs", 0)
+
+    # make sure the extension is a feather format
+    if Path(output).suffix != ".feather":
+        raise InvalidFileExtension("Invalid file extension")
+
+    columns, rows = build_database(database, output=output, processes=jobs, **kwargs)
+
+    if columns:
+        click.secho("Matched {} against every compound".format(", ".join(columns)), fg='green')
+    click.secho("Matched {} new compounds".format(rows), fg='green')
+    click.secho("Saving file to {}".format(output), fg='green')
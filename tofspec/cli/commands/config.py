@@ -2,12 +2,15 @@
 # -*- coding: utf-8 -*-
 
 from pathlib import Path
+from os import path
 import pandas as pd
 import numpy as np
 import yaml
 import rich_click as click
 
 from ...utils import *
+from ...groups import get_functional_group_db
+from ...formula import deionize
 from ...exceptions import InvalidFileExtension, InvalidArgument
 
 def config_command(file, output, **kwargs):
@@ -22,7 +25,7 @@ def config_command(file, output, **kwargs):
     author = kwargs.pop('author', None)
 
     #path to lookup table
-    lookup_table = "tofspec/db/database.feather"
+    lookup_table = path.join(path.dirname(__file__), '../../db/database.feather')
 
     # make sure the extension is either a csv or feather format
     file = Path(file)
@@ -50,18 +53,21 @@ def config_command(file, output, **kwargs):
                    'author': author,
                    'peak-list':data}
     else:
-        #load functional group lookup table
-        fx_df = pd.read_feather(lookup_table)
+        #functional group lookup table, indexed once per process
+        db = get_functional_group_db(lookup_table)
         if _ion:
             if 'ion' not in df.columns:
                 raise InvalidArgument("If --ion is passed, then FILE must contain a column named 'ion'")
-            df['mf'] = df['ion'].apply(deionize_regex)
+            # every distinct ion is parsed once
+            df['mf'] = deionize(df['ion'].to_numpy())
         
         df = df.drop_duplicates(subset='mf', keep="last")
 
         # for now use the first SMILES found in the database depending on mf
         # we will also give the user an option to use all of the functional groups that correspond to a single isomer
-        clean_df = df.merge(fx_df, how='inner', on='mf')[['mf','smiles', 'min', 'max']].drop_duplicates(subset='mf', keep="first").reset_index(drop=True)
+        found = db.contains(df['mf'].to_numpy(), 'mf')
+        clean_df = df.loc[found, ['mf', 'min', 'max']].reset_index(drop=True)
+        clean_df.insert(1, 'smiles', db.first_smiles(clean_df['mf'].to_numpy()))
 
         data = clean_df.to_dict('records')
 
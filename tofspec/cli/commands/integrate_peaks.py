@@ -6,15 +6,29 @@ import pandas as pd
 import numpy as np
 import rich_click as click
 from os import path
+from functools import partial
 
 from ...models import *
-from ...utils import safe_load
+from ...load import resample_step
+from ...utils import safe_load, write_df, read_df, expand_files, df_mass_axis
+from ...batch import run_batch, run_outdir, save_result
+from ...cube import is_cube
+from ...drift import DriftCorrection
+from ...manifest import Manifest, manifest_path, config_hash, merge_results, time_range
 from ...exceptions import InvalidFileExtension, InvalidArgument
 
-def integrate_peaks_command(file, output, **kwargs):
+def integrate_peaks_command(files, output, **kwargs):
     tscol = kwargs.pop('tscol', None)
     ignore = kwargs.pop('ignore', None)
     columns = kwargs.pop('columns', 'smiles')
+    metadata_ = kwargs.pop('metadata', False)
+    jobs = kwargs.pop('jobs', 1)
+    outdir = kwargs.pop('outdir', None)
+    incremental = kwargs.pop('incremental', False)
+    average = kwargs.pop('resample', None)
+    reference = kwargs.pop('reference', None)
+    drift_mode = kwargs.pop('drift', 'block')
+    max_shift = kwargs.pop('max_shift', 100.0)
 
     default_config_path = path.join(path.dirname(__file__), '../../config/peak-list.yml')
     # config = kwargs.pop('config', 'tofspec/config/peak-list.yml')
@@ -28,8 +42,110 @@ def integrate_peaks_command(file, output, **kwargs):
     if output.suffix not in (".csv", ".feather"):
         raise InvalidFileExtension("Invalid output file extension")
 
-    save_as_csv = True if output.suffix == ".csv" else False
+    if isinstance(files, (str, Path)):
+        files = [files]
+    files = expand_files(files)
+    if not files:
+        raise InvalidArgument("No input files")
+
+    if average is not None:
+        if any(Path(f).suffix != ".h5" for f in files):
+            raise InvalidArgument("--resample only applies to Vocus .h5 files and campaign stores; resample other FILES with tofspec load")
+        resample_step(average)
+
+    drift = None
+    if reference is not None:
+        if any(Path(f).suffix != ".h5" and not is_cube(f) for f in files):
+            raise InvalidArgument("--reference only applies to Vocus .h5 files, campaign stores and .tofcube spectral cubes")
+        drift = DriftCorrection.from_string(reference, max_shift=max_shift, per_row=drift_mode.lower() == 'row')
+
+    # every worker compiles the peak list once and reuses it for all of its files
+    integrate = partial(integrate_file, config=config, columns=columns, tscol=tscol, ignore=ignore, metadata=metadata_, average=average, drift=drift)
+
+    manifest, config_id = None, None
+    if incremental:
+        # files are integrated again only if they, or the settings, changed since the last run
+        manifest = Manifest(manifest_path(outdir if outdir is not None else output))
+        # the drift options only take part once they are used, so that earlier manifests stay valid
+        drift_options = dict(reference=reference, drift=drift_mode, max_shift=max_shift) if drift is not None else {}
+        config_id = config_hash(config, columns=columns, tscol=tscol, ignore=ignore, metadata=metadata_, resample=average, **drift_options)
+
+    if outdir is not None:
+        # one output per input, named after the input and in the format of OUTPUT
+        run_outdir(partial(save_result, integrate), files, outdir, output.suffix, manifest=manifest, config=config_id,
+                    action='integrate', processes=jobs)
+        return
+
+    if manifest is not None:
+        todo = [f for f in files if manifest.changed(f, config_id, output)]
+        if not todo:
+            click.secho("{} is up to date".format(output), fg='green')
+            manifest.save()
+            return
+        files = todo
+
+    data = []
+    for f, compound_df, error in run_batch(integrate, files, processes=jobs):
+        if error is not None:
+            if len(files) == 1:
+                raise error
+            click.secho("Failed to integrate {}: {}".format(f, error), fg='red')
+        else:
+            data.append((f, compound_df))
+
+    if not data:
+        raise Exception("No data")
+
+    if manifest is not None:
+        if any(not isinstance(df.index, pd.DatetimeIndex) for _, df in data):
+            raise InvalidArgument("--incremental needs timestamps (--tscol) to merge into OUTPUT; use --outdir otherwise")
+
+        existing, stale = None, []
+        if output.exists():
+            # the rows that the files integrated again put in OUTPUT last time are replaced
+            stale = [(e['start'], e['end']) for e in (manifest.entry(f) for f, _ in data) if e is not None and e['start'] is not None]
+            existing = read_df(output)
+            existing.index = pd.to_datetime(existing.index)
+        compound_df = merge_results(existing, [df for _, df in data], stale)
+    elif len(data) == 1:
+        compound_df = data[0][1]
+    elif all(isinstance(df.index, pd.DatetimeIndex) for _, df in data):
+        # several inputs are concatenated in time order
+        compound_df = pd.concat([df for _, df in data]).sort_index(kind='mergesort')
+    else:
+        # without timestamps, in the order they are given
+        compound_df = pd.concat([df for _, df in data], ignore_index=True)
+
+    # save the file
+    click.secho("Saving file to {}".format(output), fg='green')
+
+    write_df(compound_df, output)
+
+    if manifest is not None:
+        for f, df in data:
+            manifest.record(f, output, config_id, *time_range(df))
+        manifest.save()
+
+def integrate_file(file, **kwargs):
+    config = kwargs.pop('config')
+    columns = kwargs.pop('columns', 'smiles')
+    tscol = kwargs.pop('tscol', None)
+    ignore = kwargs.pop('ignore', None)
+    metadata_ = kwargs.pop('metadata', False)
+    average = kwargs.pop('average', None)
+    drift = kwargs.pop('drift', None)
+
+    if Path(file).suffix == ".h5":
+        # integrate straight from the raw Vocus file, block by block
+        return time_series_df_from_h5(file, peak_list=config, columns=columns, metadata=metadata_, average=average, drift=drift)
 
+    if is_cube(file):
+        # only the pages of the cube covered by the peak list are read
+        return time_series_df_from_cube(file, peak_list=config, columns=columns, metadata=metadata_, drift=drift)
+
+    return integrate_table(file, config, columns, tscol, ignore)
+
+def integrate_table(file, config, columns, tscol, ignore):
     df = safe_load(file)
 
     timestamps = None
@@ -44,20 +160,8 @@ def integrate_peaks_command(file, output, **kwargs):
         metadata = df[ignore].to_numpy()
         df.drop(ignore, axis=1, inplace=True)
 
-    mass_axis = df.columns.to_numpy(dtype=np.float32)
+    mass_axis = df_mass_axis(df)
 
     tof_data = df.to_numpy(dtype=np.float32)
 
-    compound_df = time_series_df_from_yaml(tof_data, mass_axis, peak_list=config, columns=columns, timestamps=timestamps, metadata=metadata)
-
-    # save the file
-    click.secho("Saving file to {}".format(output), fg='green')
-
-    if save_as_csv:
-        compound_df.to_csv(output)
-    else:
-        compound_df.columns = compound_df.columns.astype(str)
-        compound_df.reset_index().to_feather(output)
-
-
-
+    return time_series_df_from_yaml(tof_data, mass_axis, peak_list=config, columns=columns, timestamps=timestamps, metadata=metadata)
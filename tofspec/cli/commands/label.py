@@ -6,39 +6,113 @@ import pandas as pd
 import numpy as np
 import rich_click as click
 from os import path
+from functools import partial
 
 from tofspec.models import group_time_series_df
 
 from ...models import *
-from ...utils import safe_load
+from ...groups import get_functional_group_db
+from ...utils import safe_load, write_df, read_df, expand_files
+from ...batch import run_batch, run_outdir, save_result
+from ...manifest import Manifest, manifest_path, config_hash, merge_results, time_range
 from ...exceptions import InvalidFileExtension, InvalidArgument
 
-def label_command(file, output, **kwargs):
+def label_command(files, output, **kwargs):
     tscol = kwargs.pop('tscol', None)
     ignore = kwargs.pop('ignore', None)
     columns = kwargs.pop('columns', 'smiles')
+    jobs = kwargs.pop('jobs', 1)
+    outdir = kwargs.pop('outdir', None)
+    incremental = kwargs.pop('incremental', False)
+
+    lookup_table = path.join(path.dirname(__file__), '../../db/database.feather')
 
     # make sure the extension is either a csv or feather format
     output = Path(output)
     if output.suffix not in (".csv", ".feather"):
         raise InvalidFileExtension("Invalid output file extension")
 
-    save_as_csv = True if output.suffix == ".csv" else False
+    if isinstance(files, (str, Path)):
+        files = [files]
+    files = expand_files(files)
+    if not files:
+        raise InvalidArgument("No input files")
+
+    label = partial(label_file, lookup_table=lookup_table, columns=columns, tscol=tscol, ignore=ignore)
+    # every worker reads the lookup table once, before its first file
+    options = dict(processes=jobs, initializer=get_functional_group_db, initargs=(lookup_table,))
+
+    manifest, config_id = None, None
+    if incremental:
+        # files are labeled again only if they, the lookup table or the settings changed since the last run
+        manifest = Manifest(manifest_path(outdir if outdir is not None else output))
+        config_id = config_hash(lookup_table, columns=columns, tscol=tscol, ignore=ignore)
+
+    if outdir is not None:
+        # one output per input, named after the input and in the format of OUTPUT
+        run_outdir(partial(save_result, label), files, outdir, output.suffix, manifest=manifest, config=config_id,
+                    action='label', **options)
+        return
+
+    if manifest is not None:
+        if tscol is None:
+            raise InvalidArgument("--incremental needs timestamps (--tscol) to merge into OUTPUT; use --outdir otherwise")
+        files = [f for f in files if manifest.changed(f, config_id, output)]
+        if not files:
+            click.secho("{} is up to date".format(output), fg='green')
+            manifest.save()
+            return
+
+    data = []
+    for f, label_df, error in run_batch(label, files, **options):
+        if error is not None:
+            if len(files) == 1:
+                raise error
+            click.secho("Failed to label {}: {}".format(f, error), fg='red')
+        else:
+            data.append((f, label_df))
+
+    if not data:
+        raise Exception("No data")
+
+    label_df = data[0][1]
+    if manifest is not None:
+        existing, stale = None, []
+        if output.exists():
+            # the rows that the files labeled again put in OUTPUT last time are replaced
+            stale = [(e['start'], e['end']) for e in (manifest.entry(f) for f, _ in data) if e is not None and e['start'] is not None]
+            existing = read_df(output).reset_index(drop=True)
+            existing[tscol] = pd.to_datetime(existing[tscol])
+        label_df = merge_results(existing, [df for _, df in data], stale, tscol=tscol)
+    elif len(data) > 1:
+        # several inputs are concatenated in time order
+        label_df = pd.concat([df for _, df in data], ignore_index=True)
+        if tscol is not None:
+            label_df = label_df.sort_values(tscol, kind='mergesort').reset_index(drop=True)
+
+    # save the file
+    click.secho("Saving file to {}".format(output), fg='green')
+
+    write_df(label_df, output)
+
+    if manifest is not None:
+        for f, df in data:
+            manifest.record(f, output, config_id, *time_range(df, tscol))
+        manifest.save()
+
+def label_file(file, **kwargs):
+    lookup_table = kwargs.pop('lookup_table')
+    columns = kwargs.pop('columns', 'smiles')
+    tscol = kwargs.pop('tscol', None)
+    ignore = kwargs.pop('ignore', None)
 
     df = safe_load(file)
 
-    label_df = group_time_series_df(df, lookup_table=path.join(path.dirname(__file__), '../../db/database.feather'), columns=columns)
+    label_df = group_time_series_df(df, lookup_table=lookup_table, columns=columns)
 
     if tscol is not None:
         label_df[tscol] = pd.to_datetime(df[tscol])
     if ignore is not None:
         label_df[ignore] = df[ignore]
 
-    # save the file
-    click.secho("Saving file to {}".format(output), fg='green')
-
-    if save_as_csv:
-        label_df.to_csv(output)
-    else:
-        label_df.columns = label_df.columns.astype(str)
-        label_df.reset_index().to_feather(output)
\ No newline at end of file
+    return label_df
@@ -6,47 +6,183 @@ import pandas as pd
 import numpy as np
 import h5py
 import rich_click as click
+from functools import partial
 
 from ...exceptions import InvalidFileExtension, InvalidArgument
 from ...load import *
+from ...cube import write_cube, CUBE_SUFFIX
+from ...store import append_to_store, store_sources, is_store
+from ...manifest import Manifest, manifest_path, config_hash
+from ...batch import run_batch, run_outdir
+from ...utils import expand_files, write_spectra
 
-def load_command(file, output, **kwargs):
+def load_command(files, output, **kwargs):
     instrument = kwargs.pop('instrument', 'vocus')
     file_format = kwargs.pop('format', 'h5')
     metadata_ = kwargs.pop('metadata', False)
-    
+    jobs = kwargs.pop('jobs', 1)
+    outdir = kwargs.pop('outdir', None)
+    append = kwargs.pop('append', False)
+    incremental = kwargs.pop('incremental', False)
+    average = kwargs.pop('resample', None)
+
     # right now we can only read Vocus files
     if instrument != 'vocus' or file_format != 'h5':
         raise InvalidArgument("There is currently only loading support for .h5 files from the TOFWERK PTR-TOF-MS Vocus instrument")
 
-    # make sure the extension is either a csv or feather format
+    # make sure the extension is either a csv or feather format, a spectral cube or a campaign store
     output = Path(output)
-    if output.suffix not in (".csv", ".feather"):
+    if output.suffix not in (".csv", ".feather", CUBE_SUFFIX, ".h5"):
         raise InvalidFileExtension("Invalid output file extension")
 
-    save_as_csv = True if output.suffix == ".csv" else False
+    files = expand_files(files)
+    if not files:
+        raise InvalidArgument("No input files")
+
+    if average is not None:
+        # fail before anything is read
+        resample_step(average)
+
+    manifest, config_id = None, None
+    if incremental:
+        if outdir is None and output.suffix != ".h5":
+            raise InvalidArgument("--incremental needs --outdir or a campaign store (.h5) OUTPUT")
+        # files are loaded again only if they changed since the last run
+        manifest = Manifest(manifest_path(outdir if outdir is not None else output))
+        config_id = config_hash(metadata=metadata_, resample=average)
+
+    if output.suffix == ".h5" or append:
+        if output.suffix != ".h5" or outdir is not None:
+            raise InvalidArgument("--append needs a campaign store (.h5) OUTPUT and can not be combined with --outdir")
+        append_files(files, output, metadata_, jobs, append or incremental, manifest, config_id, average)
+        return
+
+    if outdir is not None:
+        # one output per input, named after the input and in the format of OUTPUT
+        run_outdir(partial(load_file, metadata=metadata_, average=average), files, outdir, output.suffix,
+                    manifest=manifest, config=config_id, action='load', processes=jobs)
+        return
+
+    #load Vocus data (in parallel and in the order given, if there are several files)
+    data = []
+    for f, result, error in run_batch(read_file, [(f, metadata_, average) for f in files], processes=jobs):
+        if error is not None:
+            click.secho("Failed to load {}: {}".format(f[0], error), fg='red')
+        else:
+            data.append(result)
+
+    if not data:
+        raise Exception("No data")
+
+    mass_axis = data[0][1]
+    if any(not np.array_equal(d[1], mass_axis) for d in data[1:]):
+        raise InvalidArgument("Files with different mass axes can not be combined into one OUTPUT; use --outdir")
+
+    timestamps = np.concatenate([d[0] for d in data])
+    tof_data = np.concatenate([d[2] for d in data])
+    metadata = np.concatenate([d[3] for d in data]) if metadata_ else None
+
+    write_output(output, timestamps, mass_axis, tof_data, metadata)
+
+def append_files(files, store, metadata_, jobs, append, manifest=None, config_id=None, average=None):
+    if store.exists():
+        if not is_store(store):
+            raise InvalidArgument("{} exists and is not a tofspec campaign store".format(store))
+        if not append:
+            store.unlink()
+
+    if manifest is not None:
+        files = [f for f in files if manifest.changed(f, config_id, store)]
+        if not files:
+            click.secho("{} is up to date".format(store), fg='green')
+            manifest.save()
+            return
+
+    # files are appended once, whatever the number of times they are passed; a file that changed
+    # since it was appended can not be replaced in the store
+    stored = set(store_sources(store))
+    done = set(stored)
+    todo = []
+    for f in files:
+        if Path(f).name in done:
+            if manifest is not None and manifest.entry(f) is not None:
+                click.secho("Skipping {}: it changed since it was appended, but {} can not replace it and keeps the earlier version".format(f, store), fg='red')
+            else:
+                click.secho("Skipping {}: already in {}".format(f, store), fg='red')
+            if manifest is not None and Path(f).name in stored and Path(f).exists():
+                # recorded as it is now, so that later runs do not look at it again
+                manifest.record(f, store, config_id)
+        else:
+            todo.append(f)
+            done.add(Path(f).name)
+
+    #load Vocus data in parallel and append it in the order given, one file at a time
+    failed = 0
+    for (f, _, _), result, error in run_batch(read_file, [(f, metadata_, average) for f in todo], processes=jobs):
+        if error is None:
+            timestamps, mass_axis, tof_data, metadata = result
+            try:
+                append_to_store(store, timestamps, mass_axis, tof_data, metadata, source=Path(f).name)
+            except InvalidArgument as e:
+                error = e
+
+        if error is not None:
+            failed += 1
+            click.secho("Failed to append {}: {}".format(f, error), fg='red')
+        else:
+            click.secho("Appending {} to {}".format(f, store), fg='green')
+            if manifest is not None:
+                manifest.record(f, store, config_id, *timestamp_range(timestamps))
+
+    if manifest is not None:
+        manifest.save()
 
-    #load Vocus data
+    if todo and failed == len(todo):
+        raise Exception("No data")
+
+def timestamp_range(timestamps):
+    valid = timestamps[~np.isnat(timestamps)]
+    return (valid.min(), valid.max()) if valid.shape[0] else (None, None)
+
+def read_file(task):
+    file, metadata_, average = task
     if metadata_:
-        timestamps, mass_axis, tof_data, metadata = load_vocus_data(file, metadata=metadata_)
+        return load_vocus_data(file, metadata=True, average=average)
+    return load_vocus_data(file, average=average) + (None,)
+
+def load_file(task, **kwargs):
+    metadata_ = kwargs.pop('metadata', False)
+    average = kwargs.pop('average', None)
+
+    file, output = task
+    timestamps, mass_axis, tof_data, metadata = read_file((file, metadata_, average))
+    write_output(Path(output), timestamps, mass_axis, tof_data, metadata, quiet=True)
+    return output
+
+def write_output(output, timestamps, mass_axis, tof_data, metadata=None, quiet=False):
+    save_as_csv = True if output.suffix == ".csv" else False
+
+    # save the file
+    if not quiet:
+        click.secho("Saving file to {}".format(output), fg='green')
+
+    if output.suffix == CUBE_SUFFIX:
+        write_cube(output, timestamps, mass_axis, tof_data, metadata)
+        return
+
+    if not save_as_csv:
+        # streamed straight from the uint16 (or averaged float32) buffers, with the exact mass axis in the schema metadata
+        write_spectra(output, timestamps, mass_axis, tof_data, metadata)
+        return
+
+    if metadata is not None:
         #assemble dataframe format
         df = pd.DataFrame(tof_data, columns=mass_axis)
         df['timestamp'] = timestamps
         df['metadata'] = metadata
     else:
-        timestamps, mass_axis, tof_data = load_vocus_data(file, metadata=metadata_)
         #assemble dataframe format
         df = pd.DataFrame(tof_data, index=pd.DatetimeIndex(timestamps), columns=mass_axis)
         df['timestamp'] = timestamps
 
-    # save the file
-    click.secho("Saving file to {}".format(output), fg='green')
-
-    if save_as_csv:
-        df.to_csv(output)
-    else:
-        df.columns = df.columns.astype(str)
-        df.reset_index().to_feather(output)
-
-    
-    
\ No newline at end of file
+    df.to_csv(output)
@@ -4,12 +4,13 @@ import numpy as np
 import rich_click as click
 
 from ...exceptions import InvalidFileExtension
-from ...utils import safe_load
+from ...utils import safe_load, utc_timestamps, join_time_series
 
 
 def merge_command(files, output, **kwargs):
     verbose = kwargs.pop("verbose", False)
     tscol   = kwargs.pop("tscol", "timestamp_iso")
+    tolerance = kwargs.pop("tolerance", None)
 
     # create an array of timestamp column names to try
     tscols = [tscol, "timestamp", "timestamp_local"]
@@ -25,40 +26,29 @@ def merge_command(files, output, **kwargs):
     if verbose:
         click.secho("Files to read: {}".format(files), fg='green')
 
-    df = pd.DataFrame()
+    data = []
     with click.progressbar(files, label="Parsing files") as bar:
         for f in bar:
             tmp = safe_load(f)
 
             # check for the column name and set to best guess
-            for c in tscols:
-                if c in tmp.columns:
-                    tscol = c
-                    break
-                
-            if not tscol in tmp.columns:
+            col = next((c for c in tscols if c in tmp.columns), None)
+            if col is None:
                 click.secho("Time tscol was not found in the file; skipping file.", fg='red')
                 continue
-                
-            # convert the timestamp column to a pandas datetime
-            if not pd.core.dtypes.common.is_datetime_or_timedelta_dtype(tmp[tscol]):
-                tmp[tscol] = tmp[tscol].apply(lambda x: pd.to_datetime(x, errors='coerce'))
-            
-            # drop the bad rows
-            tmp = tmp.dropna(how='any', subset=[tscol])
 
-            # re-convert to timestamp in case it's not
-            if not pd.core.dtypes.common.is_datetime_or_timedelta_dtype(tmp[tscol]):
-                tmp[tscol] = tmp[tscol].apply(lambda x: pd.to_datetime(x, errors='raise'))
-            
-            # localize the timezone if needed
-            tmp[tscol] = tmp[tscol].apply(lambda x: x.tz_localize("UTC") if not x.tzinfo else x)
+            # convert the timestamp column to a UTC datetime and drop the bad rows
+            tmp[col] = utc_timestamps(tmp[col])
+            tmp = tmp.loc[tmp[col].notna().to_numpy()]
 
             # set the index
-            tmp.set_index(tscol, inplace=True)
+            tmp = tmp.set_index(col)
+            tmp.index.name = tscol
 
-            # merge with the other files
-            df = pd.merge(df, tmp, left_index=True, right_index=True, how='outer')       
+            data.append(tmp)
+
+    # join all of the files at once
+    df = join_time_series(data, tolerance=tolerance)
 
     # save the file
     if verbose:
@@ -67,4 +57,4 @@ def merge_command(files, output, **kwargs):
     if save_as_csv:
         df.to_csv(output)
     else:
-        df.reset_index().to_feather(output)
\ No newline at end of file
+        df.reset_index().to_feather(output)
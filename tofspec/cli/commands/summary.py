@@ -0,0 +1,36 @@
+from pathlib import Path
+import pandas as pd
+import rich_click as click
+
+from ...exceptions import InvalidFileExtension, InvalidArgument
+from ...summary import summarize_files
+from ...store import NAT
+from ...utils import expand_files, write_df
+
+
+def summary_command(files, output, **kwargs):
+    jobs = kwargs.pop("jobs", 1)
+    cache = kwargs.pop("cache", True)
+
+    # a table of the summary spectrum, or the summary itself to be merged later on
+    output = Path(output)
+    if output.suffix not in (".csv", ".feather", ".npz"):
+        raise InvalidFileExtension("Invalid output file extension")
+
+    files = expand_files(files)
+    if not files:
+        raise InvalidArgument("No input files")
+
+    click.secho("Summarizing {} files".format(len(files)), fg='green')
+    summary, skipped = summarize_files(files, processes=jobs, cache=cache, errors='skip')
+    for f, error in skipped:
+        click.secho("Failed to summarize {}: {}".format(f, error), fg='red')
+
+    if summary.start != NAT:
+        click.secho("{} spectra from {} to {}".format(summary.n_spectra, pd.Timestamp(summary.start), pd.Timestamp(summary.end)), fg='green')
+
+    click.secho("Saving file to {}".format(output), fg='green')
+    if output.suffix == ".npz":
+        summary.save(output)
+    else:
+        write_df(summary.to_frame().set_index('mass'), output)
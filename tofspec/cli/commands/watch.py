@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from pathlib import Path
+import rich_click as click
+from os import path
+
+from ...models import assemble_time_series_df
+from ...plan import get_integration_plan
+from ...load import get_mass_axis
+from ...watch import follow_vocus_file, open_vocus_swmr
+from ...exceptions import InvalidFileExtension
+
+def watch_command(file, output, **kwargs):
+    columns = kwargs.pop('columns', 'smiles')
+    metadata_ = kwargs.pop('metadata', False)
+    poll = kwargs.pop('poll', 1.0)
+    timeout = kwargs.pop('timeout', None)
+
+    default_config_path = path.join(path.dirname(__file__), '../../config/peak-list.yml')
+    config = kwargs.pop('config', default_config_path)
+    if Path(config).suffix not in (".yml", ".yaml"):
+        raise InvalidFileExtension("Invalid YAML file extension")
+
+    # rows are appended as they come in, which only a .csv allows
+    output = Path(output)
+    if output.suffix != ".csv":
+        raise InvalidFileExtension("Invalid output file extension")
+
+    f, _ = open_vocus_swmr(file)
+    with f:
+        mass_axis = get_mass_axis(f)
+
+    plan = get_integration_plan(mass_axis, config)
+
+    click.secho("Watching {} (Ctrl+C to stop)".format(file), fg='green')
+
+    rows = 0
+    try:
+        # only the TOF bins covered by the peak list are read
+        for block in follow_vocus_file(file, columns=plan.columns, metadata=metadata_, poll=poll, timeout=timeout):
+            df = assemble_time_series_df(plan.integrate(block[1]), plan.names(columns), timestamps=block[0],
+                                            metadata=block[2] if metadata_ else None)
+
+            df.to_csv(output, mode='a' if rows else 'w', header=not rows)
+            rows += df.shape[0]
+            click.secho("Appended {} rows to {}".format(df.shape[0], output), fg='green')
+    except KeyboardInterrupt:
+        pass
+
+    click.secho("Saved {} rows to {}".format(rows, output), fg='green')
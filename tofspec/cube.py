@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import numpy as np
+from pathlib import Path
+
+from .exceptions import InvalidFileExtension
+
+## spectral cube: a directory holding the (t x n) matrix of TOF data as a raw .npy file next to the
+## mass axis, timestamps and metadata, so that it can be memory-mapped instead of parsed
+
+CUBE_SUFFIX = ".tofcube"
+CUBE_VERSION = 1
+
+def is_cube(fpath):
+    """
+    Return whether fpath is a spectral cube (.tofcube directory)
+    """
+    return Path(fpath).suffix == CUBE_SUFFIX
+
+def write_cube(output, timestamps, mass_axis, tof_data, metadata=None, **kwargs):
+    """
+    Save a matrix of TOF spectra as a spectral cube, a .tofcube directory that holds:
+
+        header.json     shape, dtype and contents of the cube
+        tof_data.npy    matrix of TOF data, shape = (t,n), in the dtype of tof_data (e.g. uint16)
+        mass_axis.npy   m/Q value of every TOF bin, shape = (n,)
+        timestamps.npy  datetime64[ns] timestamp of every spectrum, shape = (t,)
+        metadata.npy    metadata of every spectrum, shape = (t,) (only if metadata is given)
+
+    The cube is written to a temporary directory and moved into place once complete, replacing any
+    existing cube at output.
+
+    :param output: path of the .tofcube directory
+    :type output: str
+    :param timestamps: timestamp of every spectrum, shape = (t,)
+    :type timestamps: np.ndarray
+    :param mass_axis: m/Q value of every TOF bin, shape = (n,)
+    :type mass_axis: np.ndarray
+    :param tof_data: matrix of TOF mass spec data, shape = (t,n)
+    :type tof_data: np.ndarray
+
+    Optional Arguments
+    ------------------
+    :param metadata: metadata of every spectrum, shape = (t,)
+    :type metadata: np.ndarray
+    :param block_size: max number of bytes of TOF data copied at once. (default = 2**26)
+    :type block_size: int
+    """
+    block_size = kwargs.pop('block_size', 2**26)
+
+    output = Path(output)
+    if not is_cube(output):
+        raise InvalidFileExtension("Invalid spectral cube extension")
+
+    tof_data = np.asarray(tof_data)
+    mass_axis = np.asarray(mass_axis)
+    timestamps = np.asarray(timestamps, dtype='datetime64[ns]')
+
+    tmp = output.with_name(".{}.{}.tmp".format(output.name, os.getpid()))
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    tmp.mkdir(parents=True)
+
+    try:
+        out = np.lib.format.open_memmap(tmp / "tof_data.npy", mode='w+', dtype=tof_data.dtype, shape=tof_data.shape)
+        rows = max(1, block_size // max(tof_data.itemsize * tof_data.shape[1], 1))
+        for i in range(0, tof_data.shape[0], rows):
+            out[i:i + rows] = tof_data[i:i + rows]
+        out.flush()
+        del out
+
+        np.save(tmp / "mass_axis.npy", mass_axis)
+        np.save(tmp / "timestamps.npy", timestamps)
+        if metadata is not None:
+            np.save(tmp / "metadata.npy", np.asarray(metadata))
+
+        header = {'format': 'tofcube',
+                    'version': CUBE_VERSION,
+                    'n_spectra': int(tof_data.shape[0]),
+                    'n_bins': int(tof_data.shape[1]),
+                    'dtype': tof_data.dtype.str,
+                    'metadata': metadata is not None}
+        with open(tmp / "header.json", "w") as f:
+            json.dump(header, f, indent=2)
+
+        if output.exists():
+            shutil.rmtree(output)
+        os.replace(tmp, output)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+def read_cube_header(fpath):
+    """
+    Return the header of a spectral cube as a dict
+    """
+    fpath = Path(fpath)
+    if not is_cube(fpath):
+        raise InvalidFileExtension("Invalid spectral cube extension")
+
+    with open(fpath / "header.json") as f:
+        header = json.load(f)
+
+    if header.get('format') != 'tofcube' or header.get('version', 0) > CUBE_VERSION:
+        raise Exception("Unsupported spectral cube: {}".format(fpath))
+
+    return header
+
+def read_cube(fpath, **kwargs):
+    """
+    Open a spectral cube written by `write_cube`. The matrix of TOF data is memory-mapped rather than
+    read, so only the pages that are actually indexed are loaded from disk.
+
+    :param fpath: path of the .tofcube directory
+    :type fpath: str
+
+    Optional Arguments
+    ------------------
+    :param metadata: also return the metadata of every spectrum (default = False)
+    :type metadata: boolean
+    :param mmap_mode: mode in which the TOF data is memory-mapped, see `np.load`. (default = 'r')
+    :type mmap_mode: str
+
+    :return: timestamps, mass_axis, tof_data (and metadata)
+    :rtype: tuple
+    """
+    metadata_ = kwargs.pop('metadata', False)
+    mmap_mode = kwargs.pop('mmap_mode', 'r')
+
+    fpath = Path(fpath)
+    header = read_cube_header(fpath)
+
+    tof_data = np.load(fpath / "tof_data.npy", mmap_mode=mmap_mode)
+    mass_axis = np.load(fpath / "mass_axis.npy")
+    timestamps = np.load(fpath / "timestamps.npy")
+
+    if not metadata_:
+        return timestamps, mass_axis, tof_data
+
+    if not header['metadata']:
+        raise Exception("The spectral cube {} was saved without metadata".format(fpath))
+
+    return timestamps, mass_axis, tof_data, np.load(fpath / "metadata.npy")
@@ -1,37 +1,10 @@
-from rdkit import Chem
-from rdkit.Chem import PandasTools 
-import pandas as pd
-import yaml
-import numpy as np
+from pathlib import Path
 
-def read_yaml(name):
-    with open(name) as f:
-        data = yaml.load(f, Loader=yaml.SafeLoader)
-    return data
+from tofspec.substructures import build_database
 
-if __name__ == "main":
-    df = pd.read_feather("database.feather")
+# same as `tofspec build-db`: match the new substructures of substructures.yml against database.feather
+if __name__ == "__main__":
+    here = Path(__file__).parent
 
-    PandasTools.AddMoleculeColumnToFrame(df, smilesCol='smiles')
-
-    #add all functional groups into the table
-    substructures = read_yaml('substructures.yml')['substructures']
-
-    for s in substructures:
-        if s['name'] not in df.columns:
-            # RDKit substructure matching
-            df[s['name']] = df['ROMol'].map(lambda x: x.HasSubstructMatch(Chem.MolFromSmarts(s['smarts'])), na_action='ignore')
-            # set to 1s and 0s rather than True / False
-            df[s['name']] = df[s['name']].astype(int)
-        else:
-            pass
-    
-    # add BTEX column based on molecular formulas
-    btex_formulas = ['C6H6', 'C7H8', 'C8H10']
-    df['BTEX'] = np.where(df['mf'].isin(btex_formulas), 1, 0)
-
-    #drop Mol column
-    df = df.drop(['ROMol'], axis=1)
-
-    #to feather
-    df.to_feather("database.feather")
\ No newline at end of file
+    columns, rows = build_database(here / "database.feather", here / "substructures.yml", processes=0)
+    print("Matched {} against every compound and {} new compounds".format(columns or "no substructure", rows))
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from .integrate import nearest_indices, integrate_peaks_shifted
+from .exceptions import InvalidArgument
+
+
+class DriftCorrection(object):
+    """
+    Mass calibration drift of every spectrum, measured from the centroids of reference ions (e.g. the
+    water clusters of the reagent ion or an internal calibrant). The drift is in ppm: a peak of true
+    mass m appears at m * (1 + shift * 1e-6) on the mass axis of the file, and the integration windows
+    are moved by as much (see `integrate_peaks_shifted`).
+
+    The centroid of every reference ion is the intensity-weighted mean m/Q of the bins within `window`
+    ppm of it, found for every spectrum at once from prefix sums. It is found twice: the second time,
+    the window is centred on the first estimate. The shifts of the reference ions are then averaged,
+    weighted by their intensity.
+
+    :param reference: m/Q of the reference ions
+    :type reference: array-like
+
+    Optional Arguments
+    ------------------
+    :param window: half-width in ppm of the window of every reference ion. (default = 250)
+    :type window: float
+    :param max_shift: largest drift in ppm that is corrected; larger drifts are clipped. (default = 100)
+    :type max_shift: float
+    :param per_row: correct every spectrum by its own drift rather than every block of spectra by their
+                    mean drift, which is less noisy. (default = False)
+    :type per_row: boolean
+    :param min_counts: a reference ion with fewer counts in a spectrum has no say in its drift. (default = 1)
+    :type min_counts: float
+    """
+    def __init__(self, reference, **kwargs):
+        self.window = float(kwargs.pop('window', 250.0))
+        self.max_shift = float(kwargs.pop('max_shift', 100.0))
+        self.per_row = kwargs.pop('per_row', False)
+        self.min_counts = float(kwargs.pop('min_counts', 1.0))
+
+        self.reference = np.sort(np.asarray(reference, dtype=np.float64).reshape(-1))
+        if self.reference.shape[0] == 0:
+            raise InvalidArgument("Drift correction needs at least one reference ion")
+
+    @classmethod
+    def from_string(cls, reference, **kwargs):
+        """
+        Parse comma-separated m/Q values, e.g. '37.0284,55.0390'
+        """
+        try:
+            values = [float(v) for v in str(reference).split(',') if v.strip()]
+        except ValueError:
+            raise InvalidArgument("Invalid reference ions: {}".format(reference))
+        return cls(values, **kwargs)
+
+    def columns(self, mass_axis, lower, upper):
+        """
+        Return the (sorted) TOF bins to read for the integration of peaks (lower, upper) with this drift
+        correction: the windows of the peaks at every drift up to max_shift, and those of the reference ions
+
+        :param mass_axis: array of m/Q values that characterize the TOF bins of the mass spec
+        :type mass_axis: array-like
+        :param lower: lower m/Q bound of every peak
+        :type lower: array-like
+        :param upper: upper m/Q bound of every peak
+        :type upper: array-like
+        :rtype: np.ndarray
+        """
+        x = np.asarray(mass_axis)
+        n = x.shape[0]
+        shift = self.max_shift * 1e-6
+        reach = (self.window + self.max_shift) * 1e-6
+
+        start = np.concatenate((nearest_indices(x, np.asarray(lower, dtype=np.float64) * (1 - shift)),
+                                np.searchsorted(x, self.reference * (1 - reach))))
+        stop = np.concatenate((nearest_indices(x, np.asarray(upper, dtype=np.float64) * (1 + shift)) + 1,
+                                np.searchsorted(x, self.reference * (1 + reach), side='right')))
+        start, stop = np.clip(start, 0, n), np.clip(np.maximum(stop, start), 0, n)
+
+        edges = np.bincount(start, minlength=n + 1) - np.bincount(stop, minlength=n + 1)
+        return np.flatnonzero(np.cumsum(edges[:-1]) > 0)
+
+    def _centroids(self, c0, c1, x, center):
+        # intensity and centroid of every reference ion in every spectrum, for windows around center (t, r)
+        w = self.window * 1e-6
+        a = np.searchsorted(x, center * (1 - w))
+        b = np.searchsorted(x, center * (1 + w), side='right')
+        counts = np.take_along_axis(c0, b, axis=1) - np.take_along_axis(c0, a, axis=1)
+        moment = np.take_along_axis(c1, b, axis=1) - np.take_along_axis(c1, a, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return counts, moment / counts
+
+    def _combine(self, counts, shift):
+        # intensity-weighted mean over the reference ions, and over the block unless per_row
+        weight = np.where((counts >= self.min_counts) & np.isfinite(shift), counts, 0.0)
+        shift = np.where(weight > 0, shift, 0.0)
+        if not self.per_row:
+            weight, shift = weight.reshape(1, -1), shift.reshape(1, -1)
+        total = weight.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(total > 0, (weight * shift).sum(axis=1) / total, np.nan)
+
+    def shifts(self, tof_data, mass_axis, **kwargs):
+        """
+        Measure the drift of every spectrum of a block
+
+        :param tof_data: matrix of TOF mass spec data, shape = (t,n)
+        :type tof_data: np.ndarray
+        :param mass_axis: m/Q of the columns of tof_data, shape = (n,). It may only hold some of the bins
+                        of the mass axis, e.g. those of `columns`
+        :type mass_axis: array-like
+
+        Optional Arguments
+        ------------------
+        :param fill: drift of the spectra in which no reference ion is found, e.g. the last drift of the
+                    previous block. (default = 0)
+        :type fill: float
+
+        :return: drift of every spectrum in ppm, shape = (t,)
+        :rtype: np.ndarray
+        """
+        fill = kwargs.pop('fill', 0.0)
+
+        y = np.asarray(tof_data)
+        x = np.asarray(mass_axis, dtype=np.float64)
+        t = y.shape[0]
+        if t == 0:
+            return np.zeros(0, dtype=np.float64)
+
+        # prefix sums of the counts and of m/Q * counts, over the bins near the reference ions only
+        reach = (self.window + self.max_shift) * 1e-6
+        a = np.searchsorted(x, self.reference * (1 - reach))
+        b = np.searchsorted(x, self.reference * (1 + reach), side='right')
+        bins = np.unique(np.concatenate([np.arange(i, j) for i, j in zip(a, b)]))
+        if bins.shape[0] == 0:
+            return np.full(t, fill, dtype=np.float64)
+
+        x = x[bins]
+        y = y[:, bins].astype(np.float64)
+        c0 = np.zeros((t, x.shape[0] + 1))
+        c1 = np.zeros((t, x.shape[0] + 1))
+        np.cumsum(y, axis=1, out=c0[:, 1:])
+        np.cumsum(y * x, axis=1, out=c1[:, 1:])
+
+        reference = np.broadcast_to(self.reference, (t, self.reference.shape[0]))
+        counts, centroid = self._centroids(c0, c1, x, reference)
+        shift = np.clip(self._combine(counts, (centroid - reference) / reference * 1e6), -self.max_shift, self.max_shift)
+
+        # centre the windows on the first estimate, which removes most of the pull of their edges
+        first = np.broadcast_to(np.nan_to_num(shift, nan=0.0).reshape(-1, 1), (t, 1))
+        counts, centroid = self._centroids(c0, c1, x, reference * (1 + first * 1e-6))
+        shift = self._combine(counts, (centroid - reference) / reference * 1e6)
+        shift = np.broadcast_to(shift, (t,))
+
+        # spectra without reference ions keep the last drift that was measured
+        found = np.isfinite(shift)
+        last = np.maximum.accumulate(np.where(found, np.arange(t), -1))
+        shift = np.where(last >= 0, shift[np.maximum(last, 0)], fill)
+
+        return np.clip(shift, -self.max_shift, self.max_shift)
+
+
+class DriftCorrectedPlan(object):
+    """
+    An `IntegrationPlan` whose windows follow the mass calibration drift, measured by a `DriftCorrection`
+    in the very blocks of spectra that are integrated, so that the calibration takes no pass of its own.
+    Blocks are integrated in the order they are read: a block without any reference ion keeps the drift
+    of the block before it.
+
+    :param plan: the compiled peak list
+    :type plan: IntegrationPlan
+    :param mass_axis: array of m/Q values that characterize the TOF bins of the mass spec
+    :type mass_axis: array-like
+    :param drift: how to measure the drift
+    :type drift: DriftCorrection
+    """
+    def __init__(self, plan, mass_axis, drift):
+        self.plan = plan
+        self.drift = drift
+        self.n_bins = plan.n_bins
+        # the TOF bins to read: every window at every drift up to max_shift, and the reference ions
+        self.columns = drift.columns(mass_axis, plan.lower, plan.upper)
+        self.x = np.asarray(mass_axis, dtype=np.float64)[self.columns]
+        self.last = 0.0
+
+    @property
+    def n_peaks(self):
+        return self.plan.n_peaks
+
+    def names(self, columns='smiles'):
+        return self.plan.names(columns)
+
+    def integrate(self, tof_data, **kwargs):
+        """
+        Integrate every peak in a block of spectra, see `IntegrationPlan.integrate`
+
+        :param tof_data: matrix of TOF mass spec data, shape = (t,n). Either every bin of the mass axis
+                        or only `columns`.
+        :type tof_data: np.ndarray
+
+        Optional Arguments
+        ------------------
+        :param block_size: max number of bytes of TOF data gathered at once. (default = 2**26)
+        :type block_size: int
+
+        :return: integrated peaks, shape = (t, n_peaks)
+        :rtype: np.ndarray
+        """
+        block_size = kwargs.pop('block_size', 2**26)
+
+        tof_data = np.asarray(tof_data)
+        if tof_data.shape[1] == self.n_bins:
+            gather = True
+        elif tof_data.shape[1] == self.columns.shape[0]:
+            gather = False
+        else:
+            raise ValueError("tof_data has {} bins but the plan was compiled for {}".format(tof_data.shape[1], self.n_bins))
+
+        out = []
+        rows = max(1, block_size // (tof_data.itemsize * max(self.columns.shape[0], 1)))
+        for i in range(0, tof_data.shape[0], rows):
+            y = tof_data[i:i + rows, self.columns] if gather else tof_data[i:i + rows]
+            shift = self.drift.shifts(y, self.x, fill=self.last)
+            if shift.shape[0]:
+                self.last = shift[-1]
+            out.append(integrate_peaks_shifted(y, self.x, self.plan.lower, self.plan.upper, shift, columns=self.columns))
+
+        if not out:
+            return np.zeros((0, self.n_peaks), dtype=np.result_type(tof_data.dtype, np.float32))
+
+        return np.concatenate(out)
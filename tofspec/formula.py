@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import numpy as np
+import pandas as pd
+from functools import lru_cache
+
+from .exceptions import InvalidArgument
+
+## molecular formulas of neutral compounds and ions, e.g. C6H6O, C6H7+ or C6H6+H+
+
+_FORMULA = re.compile(r'((?:[A-Z][a-z]?\d*)+(?:\+(?:[A-Z][a-z]?\d*)+)*)([+-]*)')
+_ELEMENT = re.compile(r'([A-Z][a-z]?)(\d*)')
+
+@lru_cache(maxsize=2**16)
+def parse_formula(formula):
+    """
+    Parse a molecular formula into its element counts and charge. Elements may appear more than once
+    and their counts are added, so that adducts such as C6H6+H+ are understood; the charge is the
+    number of trailing + signs minus the number of trailing - signs.
+
+    :param formula: molecular formula, e.g. 'C6H6O' or 'C6H7+'
+    :type formula: str
+
+    :return: ((element, count), ...) sorted by element, and the charge
+    :rtype: tuple
+    """
+    m = _FORMULA.fullmatch(re.sub(r'\s', '', str(formula)))
+    if m is None:
+        raise InvalidArgument("Invalid molecular formula {}".format(formula))
+
+    body, signs = m.groups()
+    counts = {}
+    for element, n in _ELEMENT.findall(body):
+        counts[element] = counts.get(element, 0) + (int(n) if n else 1)
+
+    return tuple(sorted(counts.items())), signs.count('+') - signs.count('-')
+
+def hill_order(elements):
+    """
+    Return elements in the order of the Hill system: C then H, then the others alphabetically, or all
+    of them alphabetically if there is no C
+    """
+    elements = sorted(elements)
+    if 'C' not in elements:
+        return elements
+    return ['C'] + (['H'] if 'H' in elements else []) + [e for e in elements if e not in ('C', 'H')]
+
+@lru_cache(maxsize=2**16)
+def format_formula(counts):
+    """
+    Write ((element, count), ...) as a formula in Hill order, leaving out counts of 1 and elements with
+    a count of 0
+    """
+    counts = dict(c for c in counts if c[1] > 0)
+    return "".join(e + (str(counts[e]) if counts[e] != 1 else "") for e in hill_order(counts))
+
+def formula_table(formulas):
+    """
+    Parse formulas into an integer matrix of element counts, one row per formula and one column per
+    element. Every distinct formula is only parsed once.
+
+    :param formulas: molecular formulas
+    :type formulas: array-like
+
+    :return: counts (len(formulas) x elements), the elements of the columns in Hill order, the charges
+            and a boolean mask of the formulas that could be parsed (missing or invalid formulas have
+            no elements)
+    :rtype: tuple
+    """
+    codes, uniques = pd.factorize(np.asarray(formulas, dtype=object))
+
+    parsed = []
+    for f in uniques:
+        try:
+            parsed.append(parse_formula(f))
+        except InvalidArgument:
+            parsed.append(None)
+
+    elements = hill_order({e for p in parsed if p is not None for e, _ in p[0]})
+    column = {e: j for j, e in enumerate(elements)}
+
+    counts = np.zeros((len(uniques), len(elements)), dtype=np.int64)
+    charges = np.zeros(len(uniques), dtype=np.int64)
+    valid = np.zeros(len(uniques), dtype=bool)
+    for i, p in enumerate(parsed):
+        if p is None:
+            continue
+        for e, n in p[0]:
+            counts[i, column[e]] = n
+        charges[i] = p[1]
+        valid[i] = True
+
+    # back to one row per formula; missing values (code -1) are invalid
+    found = codes >= 0
+    rows = np.where(found, codes, 0)
+    if len(uniques) == 0:
+        return np.zeros((len(codes), len(elements)), dtype=np.int64), elements, np.zeros(len(codes), dtype=np.int64), found
+
+    return counts[rows], elements, charges[rows], valid[rows] & found
+
+def format_table(counts, elements, valid=None):
+    """
+    Write every row of a matrix of element counts (see `formula_table`) as a formula in Hill order,
+    or None where valid is False
+    """
+    rows, index = np.unique(counts, axis=0, return_inverse=True)
+    formulas = np.array([format_formula(tuple(zip(elements, map(int, r)))) for r in rows] + [None], dtype=object)
+
+    index = index.reshape(-1)
+    if valid is not None:
+        index = np.where(valid, index, rows.shape[0])
+    return formulas[index]
+
+def deionize(ions):
+    """
+    Return the neutral molecular formula of every ion, in Hill order, e.g. C6H7+ -> C6H6. A positive
+    ion loses one H per charge ([M+H]+) and a negative one gains one H per charge ([M-H]-); ions
+    without a sign are taken to be [M+H]+. Charge transfer ions without enough H (e.g. NO+) keep
+    their formula. Every distinct ion is only parsed once, and the H arithmetic is done on arrays.
+
+    :param ions: ion formulas
+    :type ions: array-like
+
+    :return: neutral formulas, None for missing or invalid ions
+    :rtype: np.ndarray
+    """
+    counts, elements, charges, valid = formula_table(ions)
+
+    if 'H' in elements:
+        h = elements.index('H')
+        protons = np.where(charges == 0, 1, charges)
+        counts[:, h] = np.where(counts[:, h] >= protons, counts[:, h] - protons, counts[:, h])
+
+    return format_table(counts, elements, valid)
+
+## monoisotopic masses
+
+PROTON_MASS = 1.007276466621
+ELECTRON_MASS = 0.000548579909
+
+# mass of the most abundant isotope of the elements found in VOCs and common ions
+MONOISOTOPIC_MASSES = {
+    'H': 1.00782503207, 'B': 11.0093054, 'C': 12.0, 'N': 14.0030740048, 'O': 15.99491461956,
+    'F': 18.99840322, 'Na': 22.9897692809, 'Si': 27.9769265325, 'P': 30.97376163, 'S': 31.97207100,
+    'Cl': 34.96885268, 'K': 38.96370668, 'Fe': 55.9349375, 'Se': 79.9165213, 'Br': 78.9183371,
+    'I': 126.904473,
+}
+
+def monoisotopic_mass(formulas):
+    """
+    Return the monoisotopic mass of every formula, less the mass of the electrons an ion lost (or plus
+    those it gained). NaN for missing or invalid formulas and for elements without a known mass.
+
+    :param formulas: molecular formulas
+    :type formulas: array-like
+    :rtype: np.ndarray
+    """
+    counts, elements, charges, valid = formula_table(formulas)
+
+    masses = np.array([MONOISOTOPIC_MASSES.get(e, np.nan) for e in elements], dtype=np.float64)
+    known = ~np.isnan(masses)
+
+    mass = counts[:, known] @ masses[known] - charges * ELECTRON_MASS
+    mass[~valid | (counts[:, ~known] > 0).any(axis=1)] = np.nan
+    return mass
+
+def protonated_mz(formulas):
+    """
+    Return the m/z of the protonated ion [M+H]+ of every neutral formula, the ion that a PTR
+    instrument detects
+    """
+    return monoisotopic_mass(formulas) + PROTON_MASS
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+from functools import lru_cache
+from pathlib import Path
+
+from .formula import protonated_mz
+
+# columns of the lookup table that are not functional groups
+ID_COLUMNS = ('mf', 'smiles', 'mz')
+
+
+class MassIndex(object):
+    """
+    The compounds of the lookup table sorted by the m/z of their protonated ion, to find every
+    compound within a ppm tolerance of thousands of measured m/z values with two binary searches each.
+
+    :param mz: m/z of every compound
+    :type mz: array-like
+    :param mf: molecular formula of every compound
+    :type mf: array-like
+    :param smiles: SMILES string of every compound
+    :type smiles: array-like
+    """
+    def __init__(self, mz, mf, smiles):
+        mz = np.asarray(mz, dtype=np.float64)
+        # compounds without a mass (unknown elements) can not be found
+        keep = np.flatnonzero(~np.isnan(mz))
+        order = keep[np.argsort(mz[keep], kind='stable')]
+
+        self.mz = mz[order]
+        self.mf = np.asarray(mf, dtype=object)[order]
+        self.smiles = np.asarray(smiles, dtype=object)[order]
+
+    def __len__(self):
+        return self.mz.shape[0]
+
+    def bounds(self, mz, ppm=10.0):
+        """
+        Return the [start, stop) positions in the index of the compounds within ppm of every m/z
+        """
+        mz = np.asarray(mz, dtype=np.float64).reshape(-1)
+        tol = mz * ppm * 1e-6
+        return np.searchsorted(self.mz, mz - tol, side='left'), np.searchsorted(self.mz, mz + tol, side='right')
+
+    def count(self, mz, ppm=10.0):
+        """
+        Return the number of compounds within ppm of every m/z
+        """
+        start, stop = self.bounds(mz, ppm)
+        return stop - start
+
+    def query(self, mz, ppm=10.0):
+        """
+        Find every compound within ppm of every m/z.
+
+        :param mz: measured m/z values
+        :type mz: array-like
+
+        Optional Arguments
+        ------------------
+        :param ppm: tolerance in parts per million of the measured m/z. (default = 10)
+        :type ppm: float
+
+        :return: one row per (query, candidate) pair, with the position of the query in mz ('query'),
+                the measured m/z ('mz'), the candidate's 'mf', 'smiles' and m/z ('mz_exact') and the
+                error in ppm ('ppm'), sorted by query and then by m/z
+        :rtype: pd.DataFrame
+        """
+        mz = np.asarray(mz, dtype=np.float64).reshape(-1)
+        df = self._pairs(*self.bounds(mz, ppm))
+        df.insert(1, 'mz', mz[df['query'].to_numpy()])
+        df['ppm'] = (df['mz'] - df['mz_exact']) / df['mz_exact'] * 1e6
+        return df
+
+    def within(self, lower, upper):
+        """
+        Find every compound whose m/z is within [lower, upper], e.g. to audit the mass ranges of a peak list
+
+        :return: one row per (range, candidate) pair, with the position of the range ('query') and the
+                candidate's 'mf', 'smiles' and m/z ('mz_exact')
+        :rtype: pd.DataFrame
+        """
+        lower = np.asarray(lower, dtype=np.float64).reshape(-1)
+        upper = np.asarray(upper, dtype=np.float64).reshape(-1)
+        return self._pairs(np.searchsorted(self.mz, lower, side='left'), np.searchsorted(self.mz, upper, side='right'))
+
+    def _pairs(self, start, stop):
+        counts = np.maximum(stop - start, 0)
+
+        # positions of the candidates of every query, laid end to end
+        query = np.repeat(np.arange(counts.shape[0]), counts)
+        offsets = np.cumsum(counts) - counts
+        rows = np.repeat(start - offsets, counts) + np.arange(counts.sum())
+
+        return pd.DataFrame({'query': query, 'mf': self.mf[rows], 'smiles': self.smiles[rows], 'mz_exact': self.mz[rows]})
+
+
+class FunctionalGroupDB(object):
+    """
+    The SMILES / functional groups lookup table (db/database.feather), indexed for batch lookups. The
+    table is read once, memory-mapped; the mf and SMILES columns are kept as hash indexes and the group
+    columns as a bit-packed boolean matrix (one bit per compound and group).
+
+    Compounds may be listed more than once (e.g. several isomers of a formula): a compound belongs to a
+    group if any of its rows does.
+
+    :param fpath: path of the lookup table
+    :type fpath: str
+    """
+    def __init__(self, fpath):
+        table = feather.read_table(str(fpath), memory_map=True)
+
+        self.fpath = str(fpath)
+        self.mf = table.column('mf').to_numpy(zero_copy_only=False)
+        self.smiles = table.column('smiles').to_numpy(zero_copy_only=False)
+        self.groups = [c for c in table.column_names if c not in ID_COLUMNS]
+        # m/z of the protonated ions, written by the database build
+        self.mz = table.column('mz').to_numpy() if 'mz' in table.column_names else None
+        self._mass_index = None
+
+        member = np.zeros((table.num_rows, len(self.groups)), dtype=bool)
+        for j, g in enumerate(self.groups):
+            member[:, j] = table.column(g).to_numpy(zero_copy_only=False) == 1
+
+        # per unique mf / SMILES: its first row and the groups of any of its rows
+        self._index, self._first, self._bits = {}, {}, {}
+        for key, values in (('mf', self.mf), ('smiles', self.smiles)):
+            codes, uniques = pd.factorize(values)
+            found = codes >= 0
+            any_member = np.zeros((uniques.shape[0], len(self.groups)), dtype=bool)
+            np.logical_or.at(any_member, codes[found], member[found])
+
+            first = np.full(uniques.shape[0], table.num_rows, dtype=np.int64)
+            np.minimum.at(first, codes[found], np.flatnonzero(found))
+
+            self._index[key] = pd.Index(uniques)
+            self._first[key] = first
+            self._bits[key] = np.packbits(any_member, axis=1)
+
+    def __len__(self):
+        return self.mf.shape[0]
+
+    @property
+    def mass_index(self):
+        """
+        The `MassIndex` of the table, built on first use (from the formulas if the table has no m/z column)
+        """
+        if self._mass_index is None:
+            mz = self.mz if self.mz is not None else protonated_mz(self.mf)
+            self._mass_index = MassIndex(mz, self.mf, self.smiles)
+        return self._mass_index
+
+    def _positions(self, values, columns):
+        if columns not in self._index:
+            raise Exception("Only `mf` and `smiles` are accepted inputs for columns")
+        return self._index[columns].get_indexer(np.asarray(values, dtype=object))
+
+    def contains(self, values, columns='smiles'):
+        """
+        Return whether each of values (molecular formulas or SMILES) is in the table
+        """
+        return self._positions(values, columns) >= 0
+
+    def membership(self, values, columns='smiles'):
+        """
+        Return the boolean (len(values) x groups) matrix of the functional groups of each of values,
+        molecular formulas ('mf') or SMILES ('smiles'). Values that are not in the table belong to no group.
+        """
+        pos = self._positions(values, columns)
+        member = np.zeros((pos.shape[0], len(self.groups)), dtype=bool)
+        found = pos >= 0
+        if found.any():
+            member[found] = np.unpackbits(self._bits[columns][pos[found]], axis=1, count=len(self.groups)).astype(bool)
+        return member
+
+    def first_smiles(self, mf):
+        """
+        Return the SMILES of the first row of every molecular formula of mf, or None for formulas that
+        are not in the table
+        """
+        pos = self._positions(mf, 'mf')
+        smiles = np.full(pos.shape[0], None, dtype=object)
+        found = pos >= 0
+        smiles[found] = self.smiles[self._first['mf'][pos[found]]]
+        return smiles
+
+
+@lru_cache(maxsize=4)
+def _load_functional_group_db(fpath, mtime):
+    return FunctionalGroupDB(fpath)
+
+def get_functional_group_db(lookup_table):
+    """
+    Return the `FunctionalGroupDB` of a lookup table, read once per process and read again only if
+    the file changed. The returned object is shared between calls and must not be modified.
+    """
+    fpath = str(Path(lookup_table).resolve())
+    return _load_functional_group_db(fpath, os.stat(fpath).st_mtime_ns)
+
+def get_mass_index(lookup_table):
+    """
+    Return the `MassIndex` of a lookup table, built once per process (see `get_functional_group_db`)
+    """
+    return get_functional_group_db(lookup_table).mass_index
@@ -5,63 +5,468 @@ import pandas as pd
 import numpy as np
 import h5py
 import pytz
+import warnings
+from pathlib import Path
+from functools import partial
 from datetime import datetime, timedelta
 
+from .batch import run_batch
+from .integrate import find_indices, peak_bounds
+from .utils import read_yaml, peak_list_from_dict, expand_files
+from .exceptions import InvalidArgument
+
 ## methods for wrangling PTR-TOF-MS Vocus hdf5 file data and compiling into some properties
 def load_vocus_data(file, **kwargs):
     """
     extracts useful data from Vocus hdf5 file.
-    :param file: hdf5 filepath
-    :type file: str
+    :param file: hdf5 filepath, glob pattern or list of filepaths. Several files are loaded in
+                parallel (see `load_vocus_files`) and concatenated in the order they are given.
+    :type file: str or list
+
+    Optional Arguments
+    ------------------
+    :param metadata: also return the metadata of each row. (default = False)
+    :type metadata: boolean
+    :param peak_list: path to configuration yml file. only the TOF bins inside its mass ranges are read
+    :type peak_list: str
+    :param mass_ranges: (lower, upper) m/Q ranges. only the TOF bins inside these ranges are read
+    :type mass_ranges: array-like
+    :param average: average the spectra to this cadence while they are read, e.g. '10s' or '1min'
+                    (see `resample_blocks`). The TOF data is then float32. (default = None, every buffer)
+    :type average: str
+
+    When a peak list or mass ranges are given, the returned mass axis and TOF data only hold the
+    columns that were read. They can be passed to the integration functions unchanged.
     """
+    files = expand_files(file)
+    if not isinstance(file, (str, Path)) or len(files) != 1 or files[0] != str(file):
+        return load_vocus_files(files, **kwargs)
+
     metadata_ = kwargs.pop('metadata', False)
+    peak_list = kwargs.pop('peak_list', None)
+    mass_ranges = kwargs.pop('mass_ranges', None)
+    average = kwargs.pop('average', None)
+
+    if peak_list is not None:
+        mf, smiles, min, max = peak_list_from_dict(read_yaml(peak_list))
+        mass_ranges = list(zip(min, max))
 
     with h5py.File(file, "r") as f:
         timestamps = get_times(f)
         mass_axis = get_mass_axis(f)
-        tof_data = get_tof_data(f, len(timestamps), len(mass_axis))
-        if metadata_:
-            metadata = get_metadata(f)
-            
+        columns = None
+        if mass_ranges is not None:
+            columns = spans_to_columns(get_bin_spans(mass_axis, mass_ranges))
+            mass_axis = mass_axis[columns]
+        if average is not None:
+            blocks = list(resample_blocks(_iter_vocus_chunks(f, None, 2**28, metadata_, columns), average, metadata=metadata_))
+            timestamps, tof_data, metadata = concat_blocks(blocks, len(mass_axis), metadata_)
+        else:
+            tof_data = get_tof_data(f, len(timestamps), len(mass_axis), columns=columns)
+            if metadata_:
+                metadata = get_metadata(f)
+
     if metadata_:
         return timestamps, mass_axis, tof_data, metadata
     else:
         return timestamps, mass_axis, tof_data
 
-def get_times(f):
+def load_vocus_files(files, **kwargs):
+    """
+    Load many Vocus hdf5 files in a pool of worker processes and concatenate them in the order they
+    are given. All files must share the same mass axis.
+
+    :param files: hdf5 filepaths or glob patterns
+    :type files: list
+
+    Optional Arguments
+    ------------------
+    :param processes: number of worker processes, 0 for one per CPU. (default = 0)
+    :type processes: int
+    :param errors: 'raise' to stop at the first file that fails to load, 'skip' to leave it out with
+                    a warning. (default = 'raise')
+    :type errors: str
+
+    The other optional arguments are those of `load_vocus_data`.
+    """
+    processes = kwargs.pop('processes', 0)
+    errors = kwargs.pop('errors', 'raise')
+    metadata_ = kwargs.get('metadata', False)
+
+    parts = []
+    for f, result, error in run_batch(partial(load_vocus_data, **kwargs), expand_files(files), processes=processes):
+        if error is not None:
+            if errors == 'raise':
+                raise error
+            warnings.warn("Skipping {}: {}".format(f, error))
+            continue
+        parts.append(result)
+
+    if not parts:
+        raise Exception("No data")
+
+    mass_axis = parts[0][1]
+    for p in parts[1:]:
+        if not np.array_equal(p[1], mass_axis):
+            raise ValueError("Files with different mass axes can not be concatenated")
+
+    timestamps = np.concatenate([p[0] for p in parts])
+    tof_data = np.concatenate([p[2] for p in parts])
+
+    if metadata_:
+        return timestamps, mass_axis, tof_data, np.concatenate([p[3] for p in parts])
+    else:
+        return timestamps, mass_axis, tof_data
+
+def iter_vocus_chunks(file, **kwargs):
     """
-    extracts array of timestamps that match up with ToF data from Vocus file
+    Read a Vocus hdf5 file block by block, so that files larger than memory can be processed.
+    Each block is a hyperslab of whole writes, aligned to the storage chunks of the TOF dataset.
+
+    :param file: hdf5 filepath or open h5py.File
+    :type file: str
+
+    Optional Arguments
+    ------------------
+    :param rows: number of spectra (rows) per block. rounded down to whole storage chunks
+    :type rows: int
+    :param max_memory: max number of bytes of TOF data held in memory per block, used when rows is not
+                        given. (default = 2**28)
+    :type max_memory: int
+    :param metadata: also yield the metadata of each row. (default = False)
+    :type metadata: boolean
+    :param columns: sorted indices of the TOF bins to read, see `get_bin_spans`. (default = all bins)
+    :type columns: array-like
+    :param average: average the spectra to this cadence, see `resample_blocks`. (default = None)
+    :type average: str
+
+    :return: generator of (timestamps, tof_block) or (timestamps, tof_block, metadata) where
+                tof_block has shape (rows, n)
+    :rtype: generator
+    """
+    rows = kwargs.pop('rows', None)
+    max_memory = kwargs.pop('max_memory', 2**28)
+    metadata_ = kwargs.pop('metadata', False)
+    columns = kwargs.pop('columns', None)
+    average = kwargs.pop('average', None)
+
+    if isinstance(file, h5py.File):
+        blocks = _iter_vocus_chunks(file, rows, max_memory, metadata_, columns)
+        yield from blocks if average is None else resample_blocks(blocks, average, metadata=metadata_)
+    else:
+        with h5py.File(file, "r") as f:
+            blocks = _iter_vocus_chunks(f, rows, max_memory, metadata_, columns)
+            yield from blocks if average is None else resample_blocks(blocks, average, metadata=metadata_)
+
+def _iter_vocus_chunks(f, rows, max_memory, metadata_, columns=None):
+    start_time = get_start_time(f)
+    buftimes = f['TimingData']['BufTimes']
+    tof = f['FullSpectra']['TofData']
+    rows_per_write = int(np.prod(tof.shape[1:-1]))
+
+    n = tof.shape[-1] if columns is None else len(columns)
+
+    if rows is None:
+        # the block is read in the file's dtype and then converted to uint16
+        rows = max_memory // (n * (tof.dtype.itemsize + np.dtype(np.uint16).itemsize))
+
+    first = buftimes[0, 0] if buftimes.shape[0] else None
+
+    for w0, w1 in chunk_ranges(tof, max(1, rows // rows_per_write)):
+        yield read_vocus_writes(f, w0, w1, start_time=start_time, first=first, metadata=metadata_, columns=columns)
+
+def read_vocus_writes(f, w0, w1, **kwargs):
+    """
+    Read the spectra of the writes [w0, w1) of an open Vocus hdf5 file
+
+    :param f: open Vocus hdf5 file
+    :type f: h5py.File
+    :param w0: first write
+    :type w0: int
+    :param w1: write after the last one
+    :type w1: int
+
+    Optional Arguments
+    ------------------
+    :param start_time: start time of the file (default = `get_start_time(f)`)
+    :type start_time: datetime
+    :param first: buffer time of the very first buffer of the file (default = read from the file)
+    :type first: float
+    :param metadata: also return the metadata of each row. (default = False)
+    :type metadata: boolean
+    :param columns: sorted indices of the TOF bins to read. (default = all bins)
+    :type columns: array-like
+
+    :return: (timestamps, tof_block) or (timestamps, tof_block, metadata)
+    :rtype: tuple
+    """
+    start_time = kwargs.pop('start_time', None)
+    first = kwargs.pop('first', None)
+    metadata_ = kwargs.pop('metadata', False)
+    columns = kwargs.pop('columns', None)
+
+    buftimes = f['TimingData']['BufTimes']
+    tof = f['FullSpectra']['TofData']
+    rows_per_write = int(np.prod(tof.shape[1:-1]))
+
+    if start_time is None:
+        start_time = get_start_time(f)
+    if first is None:
+        first = buftimes[0, 0]
+
+    # a sorted list of bins is read as one union of column hyperslabs
+    bins = slice(None) if columns is None else np.asarray(columns).tolist()
+    n = tof.shape[-1] if columns is None else len(bins)
+
+    timestamps, _ = timestamps_from_buftimes(start_time, buftimes[w0:w1], first=first, offset=w0 * rows_per_write)
+    tof_block = tof.astype(np.uint16)[w0:w1, ..., bins].reshape(-1, n)
+
+    if metadata_:
+        return timestamps, tof_block, metadata_from_twdata(f['TPS2']['TwData'][w0:w1], buftimes.shape[1])
+    return timestamps, tof_block
+
+def resample_step(average):
+    """
+    Return the length of an averaging interval (e.g. '10s', '1min') in nanoseconds
+    """
+    try:
+        step = pd.Timedelta(average).value
+    except (ValueError, TypeError):
+        raise InvalidArgument("Invalid averaging interval {}: use a fixed duration such as 10s or 1min".format(average))
+    if step <= 0:
+        raise InvalidArgument("Invalid averaging interval {}".format(average))
+    return step
+
+_DAY = pd.Timedelta('1D').value
+
+def resample_blocks(blocks, average, **kwargs):
+    """
+    Average blocks of spectra to a regular cadence while they stream by, so that the full resolution
+    data never has to be held in memory. Every spectrum goes to the interval [t0, t0 + average) that its
+    timestamp falls in, with intervals counted from midnight of the day of the first spectrum (like
+    `pd.DataFrame.resample`, whose origin is 'start_day'), and every interval is labelled with its start. The rows without a timestamp (the empty buffers at the end of
+    a Vocus file) are left out rather than averaged in. An interval that spans two blocks is held back
+    until the next block, so the result does not depend on the block size.
+
+    :param blocks: iterable of (timestamps, tof_block) or (timestamps, tof_block, metadata), in time order
+    :type blocks: iterable
+    :param average: length of the intervals, e.g. '10s' or '1min'
+    :type average: str
+
+    Optional Arguments
+    ------------------
+    :param metadata: the blocks hold metadata; the metadata of an interval is that of its first
+                    spectrum. (default = False)
+    :type metadata: boolean
+
+    :return: generator of (timestamps, mean_block) or (timestamps, mean_block, metadata), where mean_block
+            is float32
+    :rtype: generator
+    """
+    metadata_ = kwargs.pop('metadata', False)
+    step = resample_step(average)
+
+    # sums, count and metadata of the last interval seen, which the next block may add to
+    pending = None
+    # midnight of the day of the first spectrum, that the intervals are counted from
+    origin = None
+
+    for block in blocks:
+        timestamps, tof_block = np.asarray(block[0], dtype='datetime64[ns]'), block[1]
+        valid = ~np.isnat(timestamps)
+        if not valid.any():
+            continue
+        if not valid.all():
+            timestamps, tof_block = timestamps[valid], tof_block[valid]
+
+        t = timestamps.view(np.int64)
+        if origin is None:
+            origin = (t[0] // _DAY) * _DAY
+        bins = origin + ((t - origin) // step) * step
+        starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+
+        keys = bins[starts]
+        sums = np.add.reduceat(tof_block, starts, axis=0, dtype=np.float64)
+        counts = np.diff(np.r_[starts, t.shape[0]])
+        metadata = np.asarray(block[2])[valid][starts] if metadata_ else None
+
+        if pending is not None:
+            if keys[0] == pending[0]:
+                sums[0] += pending[1]
+                counts[0] += pending[2]
+                if metadata_:
+                    metadata[0] = pending[3]
+            else:
+                keys, sums, counts = np.r_[pending[0], keys], np.vstack([pending[1], sums]), np.r_[pending[2], counts]
+                if metadata_:
+                    metadata = np.r_[pending[3], metadata]
+
+        # the last interval may go on in the next block
+        pending = (keys[-1], sums[-1], counts[-1], metadata[-1] if metadata_ else None)
+        if keys.shape[0] > 1:
+            yield _mean_block(keys[:-1], sums[:-1], counts[:-1], metadata[:-1] if metadata_ else None)
+
+    if pending is not None:
+        yield _mean_block(pending[0:1], pending[1][np.newaxis], np.r_[pending[2]],
+                            np.r_[pending[3]] if metadata_ else None)
+
+def _mean_block(keys, sums, counts, metadata=None):
+    block = (np.asarray(keys, dtype=np.int64).view('datetime64[ns]'), (sums / counts[:, np.newaxis]).astype(np.float32))
+    if metadata is not None:
+        block += (metadata,)
+    return block
+
+def concat_blocks(blocks, n, metadata=False):
+    """
+    Concatenate blocks of (timestamps, tof_block[, metadata]) into (timestamps, tof_data, metadata),
+    where tof_data has n columns even if there are no blocks
+    """
+    if not blocks:
+        return np.array([], dtype='datetime64[ns]'), np.zeros((0, n), dtype=np.float32), np.array([]) if metadata else None
+
+    timestamps = np.concatenate([b[0] for b in blocks])
+    tof_data = np.concatenate([b[1] for b in blocks])
+    return timestamps, tof_data, np.concatenate([b[2] for b in blocks]) if metadata else None
+
+def chunk_ranges(dataset, writes):
+    """
+    Split the first axis of an hdf5 dataset into [start, stop) ranges of about `writes` entries,
+    aligned to the dataset's storage chunks.
+    """
+    step = dataset.chunks[0] if dataset.chunks else 1
+    writes = max(step, (writes // step) * step)
+    for w0 in range(0, dataset.shape[0], writes):
+        yield w0, min(w0 + writes, dataset.shape[0])
+
+def get_bin_spans(mass_axis, mass_ranges):
+    """
+    Find the [start, stop) spans of TOF bins needed to integrate a set of m/Q ranges, with
+    overlapping and adjacent spans merged together. Every span holds one more bin on each side, so
+    that `find_indices` finds the same bins on the projected mass axis as on the full one.
+
+    :param mass_axis: array of m/Q values that characterize the TOF bins of the mass spec
+    :type mass_axis: np.ndarray
+    :param mass_ranges: (lower, upper) m/Q ranges
+    :type mass_ranges: array-like
+    :return: merged spans, shape = (k,2)
+    :rtype: np.ndarray
+    """
+    n = len(mass_axis)
+    indices = [find_indices(mass_axis, lo, hi) for lo, hi in mass_ranges]
+    start, stop = peak_bounds(indices, n)
+    keep = stop > start
+    # the bins on either side of every window edge, which find_indices compares the edge against
+    start, stop = np.maximum(start[keep] - 1, 0), np.minimum(stop[keep] + 1, n)
+
+    # merge spans that overlap or touch
+    order = np.argsort(start, kind='stable')
+    start, stop = start[order], np.maximum.accumulate(stop[order])
+    new = np.ones(start.shape[0], dtype=bool)
+    new[1:] = start[1:] > stop[:-1]
+    groups = np.cumsum(new) - 1
+
+    spans = np.zeros((new.sum(), 2), dtype=np.int64)
+    spans[:, 0] = start[new]
+    np.maximum.at(spans[:, 1], groups, stop)
+
+    return spans
+
+def spans_to_columns(spans):
+    """
+    Expand [start, stop) spans of TOF bins into the sorted indices of every bin they hold
+    """
+    if len(spans) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate([np.arange(a, b) for a, b in spans])
+
+def get_start_time(f):
+    """
+    extracts the experiment start time (naive UTC datetime) from the log of a Vocus file
     """
     # get experiment start time from log file and transform string to datetime
     start_time = f['AcquisitionLog']['Log']['timestring'][0]
     start_time = datetime.strptime(start_time.decode('UTF-8'), "%Y-%m-%dT%H:%M:%S%z")
     start_time = start_time.astimezone(pytz.utc)
     start_time = start_time.replace(tzinfo=None)
+    return start_time
+
+def timestamps_from_buftimes(start_time, buftimes, **kwargs):
+    """
+    convert buffer times (second offsets from the start time) to datetime64[ns] timestamps
+
+    Optional Arguments
+    ------------------
+    :param first: buffer time of the very first buffer of the file. (default = first entry of buftimes)
+    :type first: float
+    :param offset: row index of the first entry of buftimes within the file. (default = 0)
+    :type offset: int
+
+    :return: timestamps and a boolean mask that is False for the empty buffers at the end of the file
+    :rtype: tuple
+    """
+    buftimes = np.asarray(buftimes, dtype=np.float64).reshape(-1)
+    first = kwargs.pop('first', buftimes[0] if buftimes.shape[0] else None)
+    offset = kwargs.pop('offset', 0)
+
+    # offsets are rounded to whole microseconds, the resolution of the timestamps written so far
+    offsets = np.round(buftimes * 1e6).astype(np.int64).astype('timedelta64[us]')
+    timestamps = (np.datetime64(start_time, 'us') + offsets).astype('datetime64[ns]')
+
+    # when the Vocus stops recording measurements, it still finishes out its last five second interval,
+    # and records the time of the empty measurements as the start time. This code masks the empty
+    # measurements and sets their times to NaT
+    valid = (buftimes != first)
+    if offset == 0 and valid.shape[0]:
+        valid[0] = True
+
+    timestamps[~valid] = np.datetime64('NaT')
+
+    return timestamps, valid
+
+def get_times(f, **kwargs):
+    """
+    extracts array of timestamps (datetime64[ns]) that match up with ToF data from Vocus file
+
+    Optional Arguments
+    ------------------
+    :param mask: also return a boolean mask that is False for the empty buffers at the end of the
+                file (whose timestamps are NaT). (default = False)
+    :type mask: boolean
+    """
+    mask = kwargs.pop('mask', False)
 
     # times of observation are recorded as second offsets from start time
     buftimes = np.array(f['TimingData']['BufTimes'])
-    
-    timestamps = np.array([start_time + timedelta(seconds=i) for i in buftimes.reshape(-1)])
-    
-    # when the Vocus stops recording measurements, it still finishes out its last five second interval,
-    # and records the time of the empty measurements as the start time. This code sets the empty measurement
-    # times to NaN
-    mask = (timestamps == timestamps[0])
-    mask[0] = False
 
-    timestamps[mask] = np.nan
+    timestamps, valid = timestamps_from_buftimes(get_start_time(f), buftimes)
 
+    if mask:
+        return timestamps, valid
     return timestamps
 
-def get_tof_data(f, t, n):
+def get_tof_data(f, t, n, **kwargs):
     """
     extracts array of ToF data of shape (t, n) where
     t = number of snapshots that were taken during the experiment, or in other words the number of 
     timesteps (typically seconds) that the experiment was running
     n = number of mass bins that the mass spec is equipped to observe
+        (or the number of columns, when only some columns are read)
+
+    Optional Arguments
+    ------------------
+    :param columns: sorted indices of the TOF bins to read. (default = all bins)
+    :type columns: array-like
     """
-    tof_data = np.array(f['FullSpectra']['TofData'], dtype=np.uint16)
-    tof_data = tof_data.reshape(t, n)
+    columns = kwargs.pop('columns', None)
+
+    tof_data = np.empty((t, n), dtype=np.uint16)
+
+    # fill block by block rather than reading the whole (float) dataset at once
+    i = 0
+    for _, tof_block in _iter_vocus_chunks(f, None, 2**28, False, columns):
+        tof_data[i:i + tof_block.shape[0]] = tof_block
+        i += tof_block.shape[0]
+
     return tof_data
 
 def get_metadata(f):
@@ -73,12 +478,17 @@ def get_metadata(f):
     by Jordan
     """
     # times of observation are recorded as second offsets from start time
-    buftimes = np.array(f['TimingData']['BufTimes'])
+    buftimes = f['TimingData']['BufTimes']
 
-    metadata = np.array(f['TPS2']['TwData'])
+    return metadata_from_twdata(np.array(f['TPS2']['TwData']), buftimes.shape[1])
+
+def metadata_from_twdata(metadata, bufs):
+    """
+    select the metadata column from (a block of) TPS2/TwData and repeat it for every buffer of a write
+    """
     try:
         metadata_array = np.array(metadata[:, 87], dtype=np.uint16)
-        return np.repeat(metadata_array, buftimes.shape[1])
+        return np.repeat(metadata_array, bufs)
     except:
         metadata_array = metadata[:,:,85].reshape(-1)
         return metadata_array
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+
+def file_hash(fpath, block_size=2**20):
+    """
+    Return the sha1 hex digest of the contents of a file
+    """
+    h = hashlib.sha1()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def config_hash(*paths, **options):
+    """
+    Return a sha1 hex digest of the contents of the files in paths (e.g. a peak list or lookup table)
+    and of the options they are used with, to tell whether an output was made with the same settings
+    """
+    h = hashlib.sha1()
+    for p in paths:
+        h.update(file_hash(p).encode())
+    h.update(json.dumps(options, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+class Manifest(object):
+    """
+    Record of the input files that a command already processed, saved as a .json file. Every entry
+    holds the size, modification time and sha1 hash of an input, the hash of the configuration it was
+    processed with (see `config_hash`), the output it went to and, optionally, the range of timestamps
+    it contributed to that output. A file whose size and mtime are unchanged is not hashed again.
+
+    :param fpath: path of the manifest .json file, which does not need to exist yet
+    :type fpath: str
+    """
+    version = 1
+
+    def __init__(self, fpath):
+        self.fpath = Path(fpath)
+        self.files = {}
+        if self.fpath.exists():
+            with open(self.fpath) as f:
+                data = json.load(f)
+            if data.get('version') == self.version:
+                self.files = data.get('files', {})
+
+    @staticmethod
+    def key(file):
+        return str(Path(file).resolve())
+
+    def entry(self, file):
+        """Return the entry of file, or None"""
+        return self.files.get(self.key(file))
+
+    def changed(self, file, config=None, output=None):
+        """
+        Return whether file must be processed again: it is new, its contents changed, it was processed
+        with another configuration or its output is gone. A file that is gone itself (deleted or moved)
+        is changed too, so that processing it reports the error.
+        """
+        entry = self.entry(file)
+        if entry is None or entry['config'] != config:
+            return True
+        if output is not None and (entry['output'] != str(output) or not Path(output).exists()):
+            return True
+
+        try:
+            st = os.stat(file)
+        except FileNotFoundError:
+            return True
+        if st.st_size != entry['size']:
+            return True
+        if st.st_mtime_ns == entry['mtime']:
+            return False
+
+        # touched, but maybe not modified
+        if file_hash(file) != entry['sha1']:
+            return True
+        entry['mtime'] = st.st_mtime_ns
+        return False
+
+    def record(self, file, output, config=None, start=None, end=None):
+        """
+        Record that file was processed with config into output, where its rows span [start, end]
+        """
+        st = os.stat(file)
+        self.files[self.key(file)] = {
+            'size': st.st_size,
+            'mtime': st.st_mtime_ns,
+            'sha1': file_hash(file),
+            'config': config,
+            'output': str(output),
+            'start': None if start is None else str(pd.Timestamp(start)),
+            'end': None if end is None else str(pd.Timestamp(end)),
+        }
+
+    def forget(self, file):
+        """Drop the entry of file"""
+        self.files.pop(self.key(file), None)
+
+    def save(self):
+        """Write the manifest, atomically"""
+        self.fpath.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.fpath.with_name(".{}.{}.tmp".format(self.fpath.name, os.getpid()))
+        with open(tmp, 'w') as f:
+            json.dump({'version': self.version, 'files': self.files}, f, indent=2)
+        os.replace(tmp, self.fpath)
+
+
+def manifest_path(output):
+    """
+    Return the default manifest of an output file or directory: OUTPUT.manifest.json next to a file,
+    and .tofspec-manifest.json inside a directory
+    """
+    output = Path(output)
+    if output.is_dir() or output.suffix == "":
+        return output / ".tofspec-manifest.json"
+    return output.with_name(output.name + ".manifest.json")
+
+def time_range(df, tscol=None):
+    """
+    Return the first and last timestamp of the rows of df, from the column tscol or from the index
+    """
+    t = pd.to_datetime(df[tscol] if tscol is not None else df.index.to_series())
+    t = t.dropna()
+    if t.empty:
+        return None, None
+    return t.min(), t.max()
+
+def merge_results(existing, new, stale=(), tscol=None):
+    """
+    Merge the results of newly processed files into an existing output. The rows of the existing
+    output that came from files being processed again, i.e. whose timestamp falls in one of the stale
+    [start, end] ranges, are replaced. Rows without a valid timestamp can not be traced back to a file
+    and are dropped.
+
+    :param existing: existing output, or None
+    :type existing: pd.DataFrame
+    :param new: results of the newly processed files
+    :type new: list of pd.DataFrame
+    :param stale: (start, end) timestamp ranges of the rows to drop from existing
+    :type stale: list
+    :param tscol: column holding the timestamps. (default = None, the index)
+    :type tscol: str
+
+    :return: merged output, sorted by time
+    :rtype: pd.DataFrame
+    """
+    frames = list(new)
+    if existing is not None:
+        t = pd.to_datetime(existing[tscol] if tscol is not None else existing.index.to_series())
+
+        keep = np.ones(existing.shape[0], dtype=bool)
+        for start, end in stale:
+            keep &= ~((t >= pd.Timestamp(start)) & (t <= pd.Timestamp(end))).to_numpy()
+
+        frames.insert(0, existing.loc[keep])
+
+    df = pd.concat(frames, sort=False)
+
+    t = pd.to_datetime(df[tscol] if tscol is not None else df.index.to_series())
+    df = df.loc[t.notna().to_numpy()]
+
+    if tscol is not None:
+        return df.sort_values(tscol, kind='mergesort').reset_index(drop=True)
+    return df.sort_index(kind='mergesort')
@@ -5,13 +5,34 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import yaml
+import h5py
 import rich_click as click
 from itertools import chain
+from pathlib import Path
 
 from .integrate import *
+from .plan import *
+from .drift import DriftCorrectedPlan
+from .load import iter_vocus_chunks, get_mass_axis, resample_blocks
+from .cube import read_cube, is_cube
+from .store import iter_store_chunks, is_store
+from .groups import get_functional_group_db
 from .utils import *
 
 
+def mass_limits(mass, **kwargs):
+    """
+    Return the (lower, upper) m/Q integration limits for a single mass or a mass range tuple.
+    See `get_time_series` for the meaning of the optional arguments.
+    """
+    binsize = kwargs.pop('binsize', 1)
+    mass_range = kwargs.pop('mass_range', False)
+
+    if mass_range == False:
+        return (mass-(binsize/2)), (mass+(binsize/2))
+    else:
+        return mass[0], mass[1]
+
 def get_time_series(tof_data, mass_axis, mass, **kwargs):
     """
     Compute the abundance of a certain m/Q value vs time. If input is a single mass (m/Q) value,
@@ -46,12 +67,7 @@ def get_time_series(tof_data, mass_axis, mass, **kwargs):
     binsize = kwargs.pop('binsize', 1)
     mass_range = kwargs.pop('mass_range', False)
 
-    if mass_range == False:
-        mass_lower = (mass-(binsize/2))
-        mass_upper = (mass+(binsize/2))
-    else:
-        mass_lower = mass[0]
-        mass_upper = mass[1]
+    mass_lower, mass_upper = mass_limits(mass, binsize=binsize, mass_range=mass_range)
 
     indices = find_indices(mass_axis, mass_lower, mass_upper)
 
@@ -105,13 +121,45 @@ def get_time_series_df(tof_data, mass_axis, masses, **kwargs):
     timestamps = kwargs.pop('timestamps', None)
     metadata = kwargs.pop('metadata', None)
 
-    time_series_masses = []
+    # resolve every integration window, then integrate all of them in a single pass
+    indices = []
     for m in masses:
-        time_series_masses.append(get_time_series(tof_data, mass_axis, m, binsize=binsize, mass_range=mass_range))
+        mass_lower, mass_upper = mass_limits(m, binsize=binsize, mass_range=mass_range)
+        indices.append(find_indices(mass_axis, mass_lower, mass_upper))
+
+    time_series_masses = integrate_peaks(tof_data, mass_axis, indices)
 
     if names is None:
-        for m in masses:
-            names.append('m{} abundance'.format(m))
+        names = ['m{} abundance'.format(m) for m in masses]
+
+    return assemble_time_series_df(time_series_masses, names, timestamps=timestamps, metadata=metadata)
+
+
+def assemble_time_series_df(time_series_masses, names, **kwargs):
+    """
+    Build the time series dataframe returned by `get_time_series_df` from a matrix of
+    integrated peaks.
+
+    :param time_series_masses: integrated counts/concentration, shape = (t,p)
+    :type time_series_masses: np.ndarray
+    :param names: identifiers of the p columns
+    :type names: array-like
+
+    Optional Arguments
+    ------------------
+    :param timestamps: datetimes that match each row of time_series_masses
+    :type timestamps: array-like
+    :param metadata: metadata that match each row of time_series_masses
+    :type metadata: array-like
+
+    :return: dataframe of the integrated counts/concentration
+    :rtype: pd.Dataframe
+    """
+    timestamps = kwargs.pop('timestamps', None)
+    metadata = kwargs.pop('metadata', None)
+
+    names = list(names)
+    time_series_masses = list(time_series_masses.T)
 
     if timestamps is not None:
         names.insert(0, "timestamp")
@@ -141,8 +189,11 @@ def time_series_df_from_yaml(tof_data, mass_axis, **kwargs):
                 t = number of snapshots that were taken during the experiment, or in other words the number of 
                     timesteps (typically seconds) that the experiment was running
                 n = number of TOF bins that the mass spec is equipped to observe
-    :type tof_data: np.ndarray
+                or the path to a Vocus hdf5 file, see `time_series_df_from_h5`,
+                or to a spectral cube, see `time_series_df_from_cube`
+    :type tof_data: np.ndarray or str
     :param mass_axis: array of m/Q values that characterize the TOF bins of the mass spec
+                (ignored when tof_data is a path)
     :type mass_axis: array-like
 
     Optional Arguments
@@ -153,6 +204,9 @@ def time_series_df_from_yaml(tof_data, mass_axis, **kwargs):
     :type timestamps: array-like
     :param metadata: array of metadata that match the observations
     :type metadata: array-like
+    :param cache: reuse the compiled integration plan of this peak list and mass axis from the
+                    on-disk cache (default = True)
+    :type cache: boolean
 
     Output
     ------
@@ -160,25 +214,158 @@ def time_series_df_from_yaml(tof_data, mass_axis, **kwargs):
     :rtype: pd.Dataframe
 
     """
+    if isinstance(tof_data, (str, Path)):
+        if is_cube(tof_data):
+            return time_series_df_from_cube(tof_data, **kwargs)
+        return time_series_df_from_h5(tof_data, **kwargs)
+
     timestamps = kwargs.pop('timestamps', None)
     metadata = kwargs.pop('metadata', None)
     peak_list = kwargs.pop('peak_list', 'config/peak-list.yml')
     columns = kwargs.pop('columns', 'smiles')
-    voc_dict = read_yaml(peak_list)
-    mf, smiles, min, max = peak_list_from_dict(voc_dict)
-    if columns == 'mf':
-        cols = mf
-    else:
-        cols = smiles
-    masses = [list(x) for x in zip(min, max)]
+    cache = kwargs.pop('cache', True)
+
+    plan = get_integration_plan(mass_axis, peak_list, cache=cache)
 
-    time_series_df = get_time_series_df(tof_data, mass_axis, masses, names=cols, mass_range=True, timestamps=timestamps, metadata=metadata)
+    time_series_df = assemble_time_series_df(plan.integrate(tof_data), plan.names(columns), timestamps=timestamps, metadata=metadata)
     
     time_series_df = time_series_df.sort_index()
 
     return time_series_df
 
 
+def time_series_df_from_h5(file, **kwargs):
+    """
+    Integrate the peaks of a peak list directly from a Vocus hdf5 file, or from a campaign store written
+    by `tofspec load --append`. The file is read block by block, restricted to the TOF bins that the peak
+    list covers, and every block is integrated as soon as it is read, so the full matrix of TOF data is
+    never held in memory.
+
+    Inputs
+    ------
+    :param file: hdf5 filepath
+    :type file: str
+
+    Optional Arguments
+    ------------------
+    :param peak_list: path to configuration yml file
+    :type peak_list: str
+    :param columns: the column names can either be SMILES strings ('smiles') or molecular formulas ('mf') 
+                    of different compounds. default = 'smiles'
+    :type columns: str
+    :param metadata: include the metadata of the file as a column (default = False)
+    :type metadata: boolean
+    :param cache: reuse the compiled integration plan from the on-disk cache (default = True)
+    :type cache: boolean
+    :param max_memory: max number of bytes of TOF data held in memory at once (default = 2**28)
+    :type max_memory: int
+    :param average: average the spectra to this cadence (e.g. '10s') before they are integrated, see
+                    `resample_blocks`. (default = None, every spectrum)
+    :type average: str
+    :param drift: move the windows of the peak list with the mass calibration drift that it measures in
+                    every block as it is read, see `DriftCorrectedPlan`. (default = None, fixed windows)
+    :type drift: DriftCorrection
+
+    Output
+    ------
+    :return: dataframe of the integrated counts/concentration for the specified m/Q values
+    :rtype: pd.Dataframe
+    """
+    peak_list = kwargs.pop('peak_list', 'config/peak-list.yml')
+    columns = kwargs.pop('columns', 'smiles')
+    metadata_ = kwargs.pop('metadata', False)
+    cache = kwargs.pop('cache', True)
+    max_memory = kwargs.pop('max_memory', 2**28)
+    average = kwargs.pop('average', None)
+    drift = kwargs.pop('drift', None)
+
+    timestamps, time_series, metadata = [], [], []
+    with h5py.File(file, "r") as f:
+        # a campaign store written by `tofspec load --append`, or a Vocus file
+        mass_axis = f['mass_axis'][:] if is_store(f) else get_mass_axis(f)
+        plan = get_integration_plan(mass_axis, peak_list, cache=cache)
+        if drift is not None:
+            plan = DriftCorrectedPlan(plan, mass_axis, drift)
+
+        if is_store(f):
+            blocks = iter_store_chunks(f, max_memory=max_memory, metadata=metadata_, columns=plan.columns)
+        else:
+            blocks = iter_vocus_chunks(f, max_memory=max_memory, metadata=metadata_, columns=plan.columns)
+
+        if average is not None:
+            blocks = resample_blocks(blocks, average, metadata=metadata_)
+
+        # only the TOF bins covered by the peak list are read from the file
+        for block in blocks:
+            timestamps.append(block[0])
+            time_series.append(plan.integrate(block[1]))
+            if metadata_:
+                metadata.append(block[2])
+
+    if not time_series:
+        # a file without a single complete write
+        timestamps, time_series, metadata = [np.array([], dtype='datetime64[ns]')], [np.zeros((0, plan.n_peaks))], [np.array([])]
+
+    time_series_df = assemble_time_series_df(np.concatenate(time_series), plan.names(columns),
+                                            timestamps=np.concatenate(timestamps),
+                                            metadata=np.concatenate(metadata) if metadata_ else None)
+
+    time_series_df = time_series_df.sort_index()
+
+    return time_series_df
+
+
+def time_series_df_from_cube(file, **kwargs):
+    """
+    Integrate the peaks of a peak list from a spectral cube written by `tofspec load`. The TOF data
+    is memory-mapped, so only the pages holding the TOF bins that the peak list covers are read.
+
+    Inputs
+    ------
+    :param file: path of the .tofcube directory
+    :type file: str
+
+    Optional Arguments
+    ------------------
+    :param peak_list: path to configuration yml file
+    :type peak_list: str
+    :param columns: the column names can either be SMILES strings ('smiles') or molecular formulas ('mf') 
+                    of different compounds. default = 'smiles'
+    :type columns: str
+    :param metadata: include the metadata of the cube as a column (default = False)
+    :type metadata: boolean
+    :param cache: reuse the compiled integration plan from the on-disk cache (default = True)
+    :type cache: boolean
+    :param drift: move the windows of the peak list with the mass calibration drift, see
+                    `time_series_df_from_h5`. (default = None, fixed windows)
+    :type drift: DriftCorrection
+
+    Output
+    ------
+    :return: dataframe of the integrated counts/concentration for the specified m/Q values
+    :rtype: pd.Dataframe
+    """
+    peak_list = kwargs.pop('peak_list', 'config/peak-list.yml')
+    columns = kwargs.pop('columns', 'smiles')
+    metadata_ = kwargs.pop('metadata', False)
+    cache = kwargs.pop('cache', True)
+    drift = kwargs.pop('drift', None)
+
+    cube = read_cube(file, metadata=metadata_)
+    timestamps, mass_axis, tof_data = cube[:3]
+
+    plan = get_integration_plan(mass_axis, peak_list, cache=cache)
+    if drift is not None:
+        plan = DriftCorrectedPlan(plan, mass_axis, drift)
+
+    time_series_df = assemble_time_series_df(plan.integrate(tof_data), plan.names(columns),
+                                            timestamps=timestamps, metadata=cube[3] if metadata_ else None)
+
+    time_series_df = time_series_df.sort_index()
+
+    return time_series_df
+
+
 def group_time_series_df(time_series_df, **kwargs):
     """
     Based on the groups listed in the config/voc-db.yml file,
@@ -212,32 +399,18 @@ def group_time_series_df(time_series_df, **kwargs):
     else: 
         raise Exception("Only `mf` and `smiles` are accepted inputs for columns")
 
-    #load functional group lookup table
-    fx_df = pd.read_feather(lookup_table)
-    group_list = list(fx_df.columns)
-    group_list.remove('mf')
-    group_list.remove('smiles')
+    #functional group lookup table, indexed once per process
+    db = get_functional_group_db(lookup_table)
 
-    #isolate only the columns which are in time_series_df
-    if columns == 'mf':
-        mf = time_series_df.columns.to_numpy()
-        subset_df = fx_df.loc[fx_df[columns].isin(mf)]
-    else:
-        smiles = time_series_df.columns.to_numpy()
-        subset_df = fx_df.loc[fx_df[columns].isin(smiles)]
-
-    #get all of the compounds in each group
-    groups_smiles_dict = {} 
-    for g in group_list:
-        subset_g = subset_df.loc[subset_df[g] == 1][columns].to_list()
-        groups_smiles_dict[g] = {columns: list(set(subset_g)),}
-
-    #build grouped dataframe
-    grouped_df = pd.DataFrame()
-    grouped_df.index = time_series_df.index
-    # grouped_df['metadata'] = time_series_df['metadata']
-
-    for group in groups_smiles_dict.keys():
-        grouped_df[group] = time_series_df[groups_smiles_dict[group][columns]].sum(axis=1)
+    #membership matrix (columns of time_series_df x groups)
+    member = db.membership(time_series_df.columns.to_numpy(), columns).astype(np.float64)
+
+    #only the columns that belong to a group are summed, the others (e.g. ignored columns) may not be numeric
+    used = member.any(axis=1)
+
+    #sum every group in a single matrix product, with missing values counted as 0 like pd.DataFrame.sum
+    values = np.nan_to_num(time_series_df.loc[:, used].to_numpy(dtype=np.float64), copy=False)
+
+    grouped_df = pd.DataFrame(values @ member[used], index=time_series_df.index, columns=db.groups)
 
     return grouped_df
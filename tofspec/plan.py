@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+import numpy as np
+from pathlib import Path
+from collections import OrderedDict
+
+from .integrate import find_indices, peak_bounds
+from .utils import read_yaml, peak_list_from_dict
+
+
+class IntegrationPlan(object):
+    """
+    A peak list compiled against a mass axis. Every peak is reduced to a [start, stop) range of
+    TOF bins and the trapezoid weights of those bins, stored as a sparse (n_bins x n_peaks) matrix
+    in compressed sparse column form over the subset of bins that the peak list covers. Integrating
+    a matrix of TOF data against the plan gives the same result as `integrate_peak` for every peak.
+
+    :param mass_axis: array of m/Q values that characterize the TOF bins of the mass spec
+    :type mass_axis: array-like
+    :param lower: lower m/Q bound of every peak
+    :type lower: array-like
+    :param upper: upper m/Q bound of every peak
+    :type upper: array-like
+
+    Optional Arguments
+    ------------------
+    :param mf: molecular formula of every peak
+    :type mf: array-like
+    :param smiles: SMILES string of every peak
+    :type smiles: array-like
+    """
+    def __init__(self, mass_axis, lower, upper, **kwargs):
+        mf = kwargs.pop('mf', None)
+        smiles = kwargs.pop('smiles', None)
+
+        x = np.asarray(mass_axis, dtype=np.float64)
+        indices = [find_indices(mass_axis, lo, hi) for lo, hi in zip(lower, upper)]
+        start, stop = peak_bounds(indices, x.shape[0])
+        # trapz over fewer than two points is zero
+        stop = np.where((stop - start) < 2, start, stop)
+
+        self.n_bins = x.shape[0]
+        self.mf = np.asarray(mf if mf is not None else [], dtype=str)
+        self.smiles = np.asarray(smiles if smiles is not None else [], dtype=str)
+        self.start = start
+        self.stop = stop
+        # the m/Q bounds themselves, to move the windows with the mass calibration drift
+        self.lower = np.asarray(lower, dtype=np.float64)
+        self.upper = np.asarray(upper, dtype=np.float64)
+
+        # bins that fall inside at least one peak window
+        edges = np.zeros(self.n_bins + 1, dtype=np.int64)
+        np.add.at(edges, start, 1)
+        np.add.at(edges, stop, -1)
+        self.columns = np.flatnonzero(np.cumsum(edges[:-1]) > 0)
+
+        # CSC layout: the weights of peak p are data[indptr[p]:indptr[p+1]], and they apply to the
+        # contiguous block of compact columns that starts at offsets[p]
+        self.offsets = np.searchsorted(self.columns, start)
+        self.indptr = np.concatenate(([0], np.cumsum(stop - start)))
+        self.data = np.zeros(self.indptr[-1], dtype=np.float64)
+        for p, (s, e) in enumerate(zip(start, stop)):
+            if e > s:
+                d = np.diff(x[s:e]) / 2.0
+                w = self.data[self.indptr[p]:self.indptr[p + 1]]
+                w[:-1] += d
+                w[1:] += d
+
+    @property
+    def n_peaks(self):
+        return self.start.shape[0]
+
+    def names(self, columns='smiles'):
+        """
+        Return the identifiers of the peaks, either molecular formulas ('mf') or SMILES ('smiles')
+        """
+        return list(self.mf) if columns == 'mf' else list(self.smiles)
+
+    def matrix(self):
+        """
+        Return the weights as a dense (len(columns) x n_peaks) matrix W, such that
+        ``tof_data[:, plan.columns] @ W`` integrates every peak.
+        """
+        W = np.zeros((self.columns.shape[0], self.n_peaks), dtype=np.float64)
+        for p in range(self.n_peaks):
+            n = self.indptr[p + 1] - self.indptr[p]
+            W[self.offsets[p]:self.offsets[p] + n, p] = self.data[self.indptr[p]:self.indptr[p + 1]]
+        return W
+
+    def integrate(self, tof_data, **kwargs):
+        """
+        Integrate every peak of the plan in a matrix of TOF data
+
+        :param tof_data: matrix of TOF mass spec data. shape = (t,n), where n must match the mass axis
+                        the plan was compiled against. A matrix that only holds `columns` is accepted too.
+        :type tof_data: np.ndarray
+
+        Optional Arguments
+        ------------------
+        :param block_size: max number of bytes of TOF data gathered at once. (default = 2**26)
+        :type block_size: int
+
+        :return: integrated peaks, shape = (t, n_peaks)
+        :rtype: np.ndarray
+        """
+        block_size = kwargs.pop('block_size', 2**26)
+
+        tof_data = np.asarray(tof_data)
+        if tof_data.shape[1] == self.n_bins:
+            columns = self.columns
+        elif tof_data.shape[1] == self.columns.shape[0]:
+            columns = None
+        else:
+            raise ValueError("tof_data has {} bins but the plan was compiled for {}".format(tof_data.shape[1], self.n_bins))
+
+        dtype = np.result_type(tof_data.dtype, np.float32)
+        data = self.data.astype(dtype)
+        out = np.zeros((tof_data.shape[0], self.n_peaks), dtype=dtype)
+
+        rows = max(1, block_size // (tof_data.itemsize * max(self.columns.shape[0], 1)))
+        for i in range(0, tof_data.shape[0], rows):
+            y = tof_data[i:i + rows] if columns is None else tof_data[i:i + rows, columns]
+            for p in range(self.n_peaks):
+                a, b = self.indptr[p], self.indptr[p + 1]
+                if b > a:
+                    out[i:i + rows, p] = y[:, self.offsets[p]:self.offsets[p] + (b - a)] @ data[a:b]
+
+        return out
+
+    def save(self, fpath):
+        """Save the plan to a .npz file"""
+        np.savez(fpath, n_bins=self.n_bins, mf=self.mf, smiles=self.smiles, start=self.start, stop=self.stop,
+                    lower=self.lower, upper=self.upper, columns=self.columns, offsets=self.offsets,
+                    indptr=self.indptr, data=self.data)
+
+    @classmethod
+    def load(cls, fpath):
+        """Load a plan saved with `IntegrationPlan.save`"""
+        plan = cls.__new__(cls)
+        with np.load(fpath, allow_pickle=False) as f:
+            plan.n_bins = int(f['n_bins'])
+            for k in ('mf', 'smiles', 'start', 'stop', 'lower', 'upper', 'columns', 'offsets', 'indptr', 'data'):
+                setattr(plan, k, f[k])
+        return plan
+
+    @classmethod
+    def from_yaml(cls, mass_axis, peak_list):
+        """Compile a peak list .yml file against a mass axis"""
+        mf, smiles, min, max = peak_list_from_dict(read_yaml(peak_list))
+        return cls(mass_axis, min, max, mf=mf, smiles=smiles)
+
+
+## on-disk cache of compiled plans
+
+# part of the cache key, so that plans saved by an older version are compiled again
+PLAN_VERSION = 2
+
+# plans last used by this process, keyed by the same hash as the files on disk, least recently used first
+_plans = OrderedDict()
+_MAX_PLANS = 8
+
+def plan_cache_dir():
+    """
+    Return the directory where compiled integration plans are cached. Defaults to
+    ~/.cache/tofspec/plans and can be overridden with the TOFSPEC_CACHE_DIR environment variable.
+    """
+    root = os.environ.get('TOFSPEC_CACHE_DIR', os.path.join(Path.home(), '.cache', 'tofspec'))
+    return Path(root) / 'plans'
+
+def plan_key(mass_axis, peak_list):
+    """
+    Hash a mass axis together with the contents of a peak list .yml file
+    """
+    h = hashlib.sha1()
+    h.update(str(PLAN_VERSION).encode())
+    h.update(np.ascontiguousarray(mass_axis, dtype='<f8').tobytes())
+    with open(peak_list, 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+def get_integration_plan(mass_axis, peak_list, **kwargs):
+    """
+    Return the `IntegrationPlan` for a peak list and mass axis, compiling it only if it is not already
+    cached. Cached plans are evicted least recently used first.
+
+    :param mass_axis: array of m/Q values that characterize the TOF bins of the mass spec
+    :type mass_axis: array-like
+    :param peak_list: path to configuration yml file
+    :type peak_list: str
+
+    Optional Arguments
+    ------------------
+    :param cache: whether to read/write the on-disk cache (default = True)
+    :type cache: boolean
+    :param cache_dir: directory of the on-disk cache (default = `plan_cache_dir()`)
+    :type cache_dir: str
+    :param max_entries: max number of plans kept on disk (default = 64)
+    :type max_entries: int
+
+    :return: the compiled plan
+    :rtype: IntegrationPlan
+    """
+    cache = kwargs.pop('cache', True)
+    cache_dir = kwargs.pop('cache_dir', None)
+    max_entries = kwargs.pop('max_entries', 64)
+
+    if not cache:
+        return IntegrationPlan.from_yaml(mass_axis, peak_list)
+
+    key = plan_key(mass_axis, peak_list)
+    cache_dir = Path(cache_dir) if cache_dir is not None else plan_cache_dir()
+    fpath = cache_dir / "{}.npz".format(key)
+
+    if key in _plans:
+        plan = _plans[key]
+    elif fpath.exists():
+        plan = IntegrationPlan.load(fpath)
+    else:
+        plan = IntegrationPlan.from_yaml(mass_axis, peak_list)
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp = fpath.with_suffix('.{}.tmp.npz'.format(os.getpid()))
+            plan.save(tmp)
+            os.replace(tmp, fpath)
+            evict_plans(cache_dir, max_entries)
+        except OSError:
+            # a read-only or full cache should never stop the integration
+            pass
+
+    # mark as most recently used
+    if fpath.exists():
+        try:
+            os.utime(fpath)
+        except OSError:
+            pass
+
+    _plans[key] = plan
+    _plans.move_to_end(key)
+    while len(_plans) > _MAX_PLANS:
+        _plans.popitem(last=False)
+
+    return plan
+
+def evict_plans(cache_dir, max_entries):
+    """
+    Delete the least recently used plans in cache_dir until at most max_entries are left
+    """
+    plans = sorted(Path(cache_dir).glob('*.npz'), key=lambda p: p.stat().st_mtime, reverse=True)
+    for p in plans[max_entries:]:
+        try:
+            p.unlink()
+        except OSError:
+            pass
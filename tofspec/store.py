@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import h5py
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from .exceptions import InvalidArgument
+
+## campaign store: one chunked, compressed hdf5 file that spectra of many raw files are appended to
+##
+##     mass_axis    (n,)      m/Q value of every TOF bin, stored once
+##     tof_data     (t, n)    TOF data, resizable along t
+##     timestamps   (t,)      int64 nanoseconds since the epoch (NaT as the smallest int64)
+##     metadata     (t,)      metadata of every spectrum (only if the first append had metadata)
+##     sources      (k,)      names of the appended files
+##     source_rows  (k, 2)    [start, stop) rows of every appended file
+##     source_times (k, 2)    first and last valid timestamp of every appended file, the index used to
+##                            find the rows of a time window without reading the whole store
+
+STORE_FORMAT = 'tofspec-store'
+STORE_VERSION = 1
+
+NAT = np.iinfo(np.int64).min
+
+def is_store(f):
+    """
+    Return whether f, an open hdf5 file or a path, is a campaign store
+    """
+    if isinstance(f, h5py.File):
+        return f.attrs.get('format') == STORE_FORMAT
+
+    try:
+        with h5py.File(f, "r") as h:
+            return h.attrs.get('format') == STORE_FORMAT
+    except OSError:
+        return False
+
+def store_sources(store):
+    """
+    Return the names of the files appended to a campaign store, in the order they were appended
+    """
+    if not Path(store).exists():
+        return []
+
+    with h5py.File(store, "r") as f:
+        return [s.decode() if isinstance(s, bytes) else s for s in f['sources'][:]]
+
+def _create_store(f, mass_axis, tof_dtype, metadata_dtype=None, chunk_bins=2**14, chunk_size=2**20, compression='gzip'):
+    n = mass_axis.shape[0]
+    bins = min(n, chunk_bins)
+    rows = max(1, chunk_size // (np.dtype(tof_dtype).itemsize * bins))
+    options = dict(compression=compression, shuffle=compression is not None)
+
+    f.attrs['format'] = STORE_FORMAT
+    f.attrs['version'] = STORE_VERSION
+
+    f.create_dataset('mass_axis', data=mass_axis)
+    f.create_dataset('tof_data', shape=(0, n), maxshape=(None, n), dtype=tof_dtype, chunks=(rows, bins), **options)
+    f.create_dataset('timestamps', shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(2**14,))
+    if metadata_dtype is not None:
+        f.create_dataset('metadata', shape=(0,), maxshape=(None,), dtype=metadata_dtype, chunks=(2**14,))
+    f.create_dataset('sources', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(), chunks=(256,))
+    f.create_dataset('source_rows', shape=(0, 2), maxshape=(None, 2), dtype=np.int64, chunks=(256, 2))
+    f.create_dataset('source_times', shape=(0, 2), maxshape=(None, 2), dtype=np.int64, chunks=(256, 2))
+
+def append_to_store(store, timestamps, mass_axis, tof_data, metadata=None, **kwargs):
+    """
+    Append spectra to a campaign store, creating it if it does not exist. Only the new rows are
+    written (and compressed), whatever the size of the store.
+
+    :param store: path of the hdf5 campaign store
+    :type store: str
+    :param timestamps: timestamp of every spectrum, shape = (t,)
+    :type timestamps: np.ndarray
+    :param mass_axis: m/Q value of every TOF bin, shape = (n,). must match the mass axis of the store
+    :type mass_axis: np.ndarray
+    :param tof_data: matrix of TOF mass spec data, shape = (t,n)
+    :type tof_data: np.ndarray
+
+    Optional Arguments
+    ------------------
+    :param metadata: metadata of every spectrum, shape = (t,). must be given if and only if the store has metadata
+    :type metadata: np.ndarray
+    :param source: name of the file the spectra come from, recorded in the store
+    :type source: str
+    :param compression: hdf5 compression filter of a new store, or None. (default = 'gzip')
+    :type compression: str
+    :param block_size: max number of bytes of TOF data written at once. (default = 2**26)
+    :type block_size: int
+
+    :return: [start, stop) rows of the appended spectra in the store
+    :rtype: tuple
+    """
+    source = kwargs.pop('source', '')
+    compression = kwargs.pop('compression', 'gzip')
+    block_size = kwargs.pop('block_size', 2**26)
+
+    mass_axis = np.asarray(mass_axis)
+    tof_data = np.asarray(tof_data)
+    t = np.asarray(timestamps, dtype='datetime64[ns]').view(np.int64)
+
+    with h5py.File(store, "a") as f:
+        if len(f.keys()) == 0 and len(f.attrs.keys()) == 0:
+            _create_store(f, mass_axis, tof_data.dtype, None if metadata is None else np.asarray(metadata).dtype,
+                            compression=compression)
+        elif not is_store(f):
+            # never write into some other hdf5 file, e.g. a raw Vocus file
+            raise InvalidArgument("{} is not a tofspec campaign store".format(store))
+
+        if not np.array_equal(f['mass_axis'][:], mass_axis):
+            raise InvalidArgument("The mass axis does not match the mass axis of the store")
+        if f['tof_data'].dtype != tof_data.dtype:
+            # e.g. averaged (float32) spectra can not go into a store of raw (uint16) spectra
+            raise InvalidArgument("The TOF data ({}) does not match the data type of the store ({})".format(tof_data.dtype, f['tof_data'].dtype))
+        if ('metadata' in f) != (metadata is not None):
+            raise InvalidArgument("The store was created {} metadata".format("with" if 'metadata' in f else "without"))
+
+        ds = f['tof_data']
+        start = ds.shape[0]
+        stop = start + tof_data.shape[0]
+
+        ds.resize(stop, axis=0)
+        rows = max(1, block_size // max(tof_data.itemsize * tof_data.shape[1], 1))
+        for i in range(0, tof_data.shape[0], rows):
+            ds[start + i:start + i + rows] = tof_data[i:i + rows]
+
+        f['timestamps'].resize(stop, axis=0)
+        f['timestamps'][start:stop] = t
+        if metadata is not None:
+            f['metadata'].resize(stop, axis=0)
+            f['metadata'][start:stop] = metadata
+
+        k = f['sources'].shape[0]
+        f['sources'].resize(k + 1, axis=0)
+        f['sources'][k] = str(source)
+        f['source_rows'].resize(k + 1, axis=0)
+        f['source_rows'][k] = (start, stop)
+        valid = t[t != NAT]
+        f['source_times'].resize(k + 1, axis=0)
+        f['source_times'][k] = (valid.min(), valid.max()) if valid.shape[0] else (NAT, NAT)
+
+    return start, stop
+
+def store_rows(f, start=None, end=None):
+    """
+    Return the rows of an open campaign store with a timestamp in [start, end), as a slice if there
+    are no bounds and as a sorted array of row indices otherwise. Only the timestamps of the appended
+    files that overlap the window are read.
+    """
+    if start is None and end is None:
+        return slice(0, f['timestamps'].shape[0])
+
+    lo = NAT + 1 if start is None else pd.Timestamp(start).value
+    hi = np.iinfo(np.int64).max if end is None else pd.Timestamp(end).value
+
+    source_rows = f['source_rows'][:]
+    source_times = f['source_times'][:]
+    overlap = (source_times[:, 1] >= lo) & (source_times[:, 0] < hi) & (source_times[:, 0] != NAT)
+
+    rows = [np.array([], dtype=np.int64)]
+    for a, b in source_rows[overlap]:
+        t = f['timestamps'][a:b]
+        rows.append(a + np.flatnonzero((t >= lo) & (t < hi)))
+
+    return np.concatenate(rows)
+
+def iter_store_chunks(f, **kwargs):
+    """
+    Generator over a campaign store, one block of rows at a time. Only the compressed chunks that hold
+    the requested rows (and columns) are read and decompressed.
+
+    :param f: open campaign store
+    :type f: h5py.File
+
+    Optional Arguments
+    ------------------
+    :param start: only read spectra at or after start
+    :type start: str or datetime
+    :param end: only read spectra before end
+    :type end: str or datetime
+    :param columns: only read these TOF bins (sorted column indices)
+    :type columns: np.ndarray
+    :param metadata: also yield the metadata of every row (default = False)
+    :type metadata: boolean
+    :param max_memory: max number of bytes of TOF data held in memory at once (default = 2**28)
+    :type max_memory: int
+
+    :return: generator of (timestamps, tof_data) or (timestamps, tof_data, metadata) tuples
+    :rtype: generator
+    """
+    start = kwargs.pop('start', None)
+    end = kwargs.pop('end', None)
+    columns = kwargs.pop('columns', None)
+    metadata_ = kwargs.pop('metadata', False)
+    max_memory = kwargs.pop('max_memory', 2**28)
+
+    ds = f['tof_data']
+    rows = store_rows(f, start, end)
+    if isinstance(rows, slice):
+        rows = np.arange(rows.start, rows.stop)
+
+    n = ds.shape[1] if columns is None else len(columns)
+    # whole chunks of rows at a time, so that no chunk is decompressed twice
+    step = max(1, max_memory // max(ds.dtype.itemsize * n, 1))
+    step = max(ds.chunks[0], step - step % ds.chunks[0])
+
+    i = 0
+    while i < rows.shape[0]:
+        # rows that fall in the same chunk-aligned window of the store
+        window = (rows[i] // ds.chunks[0]) * ds.chunks[0] + step
+        j = int(np.searchsorted(rows, window, side='left'))
+        block_rows = rows[i:j]
+        lo, hi = int(block_rows[0]), int(block_rows[-1]) + 1
+
+        tof_data = ds[lo:hi] if columns is None else ds[lo:hi, np.asarray(columns)]
+        timestamps = f['timestamps'][lo:hi]
+        keep = block_rows - lo
+        if keep.shape[0] != hi - lo:
+            tof_data, timestamps = tof_data[keep], timestamps[keep]
+
+        block = (timestamps.view('datetime64[ns]'), tof_data)
+        if metadata_:
+            block += (f['metadata'][lo:hi][keep],)
+        yield block
+
+        i = j
+
+def read_store(store, **kwargs):
+    """
+    Read a time window of a campaign store written by `append_to_store` (or `tofspec load --append`).
+
+    :param store: path of the hdf5 campaign store
+    :type store: str
+
+    Optional Arguments
+    ------------------
+    :param start: only read spectra at or after start
+    :type start: str or datetime
+    :param end: only read spectra before end
+    :type end: str or datetime
+    :param columns: only read these TOF bins (sorted column indices)
+    :type columns: np.ndarray
+    :param metadata: also return the metadata of every row (default = False)
+    :type metadata: boolean
+
+    :return: timestamps, mass_axis, tof_data (and metadata). The mass axis only holds `columns`, if given.
+    :rtype: tuple
+    """
+    columns = kwargs.get('columns', None)
+    metadata_ = kwargs.get('metadata', False)
+
+    with h5py.File(store, "r") as f:
+        if not is_store(f):
+            raise InvalidArgument("{} is not a tofspec campaign store".format(store))
+
+        mass_axis = f['mass_axis'][:]
+        if columns is not None:
+            mass_axis = mass_axis[np.asarray(columns)]
+
+        blocks = list(iter_store_chunks(f, **kwargs))
+        if not blocks:
+            blocks = [(np.array([], dtype='datetime64[ns]'), np.zeros((0, mass_axis.shape[0]), dtype=f['tof_data'].dtype),
+                        np.array([], dtype=f['metadata'].dtype if 'metadata' in f else float))]
+
+    timestamps = np.concatenate([b[0] for b in blocks])
+    tof_data = np.concatenate([b[1] for b in blocks])
+
+    if metadata_:
+        return timestamps, mass_axis, tof_data, np.concatenate([b[2] for b in blocks])
+
+    return timestamps, mass_axis, tof_data
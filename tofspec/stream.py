@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+from pathlib import Path
+
+from .utils import csv_read_options, read_feather_schema
+from .exceptions import InvalidFileExtension
+
+## out-of-core processing of .csv / .feather tables, one block of rows at a time
+
+# sort key of rows without a timestamp, which go last
+_NAT_KEY = np.iinfo(np.int64).max
+
+def iter_blocks(fpath, **kwargs):
+    """
+    Read a .csv or .feather file one block of rows at a time, as Arrow tables. A file without any rows
+    yields one empty table, so that its columns are known.
+
+    :param fpath: path of the file
+    :type fpath: str
+
+    Optional Arguments
+    ------------------
+    :param block_size: number of bytes of .csv parsed at once. (default = 2**24)
+                        .feather files are read one record batch at a time, memory-mapped.
+    :type block_size: int
+
+    :return: generator of pa.Table
+    :rtype: generator
+    """
+    block_size = kwargs.pop('block_size', 2**24)
+
+    p = Path(fpath)
+    if p.suffix == ".csv":
+        read_options, convert_options = csv_read_options(fpath, block_size=block_size)
+        convert_options.column_types = dict(convert_options.column_types, **_csv_column_types(fpath, read_options, convert_options))
+        with pacsv.open_csv(fpath, read_options=read_options, convert_options=convert_options) as reader:
+            empty = True
+            for batch in reader:
+                empty = False
+                yield pa.Table.from_batches([batch])
+            if empty:
+                yield reader.schema.empty_table()
+    elif p.suffix == ".feather" and read_feather_schema(fpath) is None:
+        # a Feather V1 file has no record batches: it is read whole
+        yield feather.read_table(str(fpath))
+    elif p.suffix == ".feather":
+        with pa.memory_map(str(fpath)) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                yield pa.Table.from_batches([reader.get_batch(i)])
+            if reader.num_record_batches == 0:
+                yield reader.schema.empty_table()
+    else:
+        raise InvalidFileExtension("Invalid file extension")
+
+def _csv_column_types(fpath, read_options, convert_options):
+    # the streaming csv reader takes the type of every column from the first block, and fails on the first
+    # later value that does not fit. Columns that are empty or only hold integers in the first block are
+    # scanned as text over the whole file to find the type that fits all of their values.
+    if os.path.getsize(fpath) <= read_options.block_size:
+        return {}
+
+    with pacsv.open_csv(fpath, read_options=read_options, convert_options=convert_options) as reader:
+        uncertain = [f.name for f in reader.schema if pa.types.is_null(f.type) or pa.types.is_integer(f.type)]
+    if not uncertain:
+        return {}
+
+    scan_options = pacsv.ConvertOptions(column_types={n: pa.string() for n in uncertain}, include_columns=uncertain,
+                                        strings_can_be_null=True)
+    # 0: no values, 1: integers, 2: numbers, 3: text
+    kinds = {n: 0 for n in uncertain}
+    with pacsv.open_csv(fpath, read_options=read_options, convert_options=scan_options) as reader:
+        for batch in reader:
+            for i, n in enumerate(batch.schema.names):
+                values = batch.column(i).drop_null()
+                if kinds[n] == 3 or len(values) == 0:
+                    continue
+                kind = 3
+                for k, t in ((1, pa.int64()), (2, pa.float64())):
+                    if k < kinds[n]:
+                        continue
+                    try:
+                        pc.cast(values, t)
+                        kind = k
+                        break
+                    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                        pass
+                kinds[n] = max(kinds[n], kind)
+
+    types = {0: pa.float64(), 1: pa.int64(), 2: pa.float64(), 3: pa.string()}
+    return {n: types[k] for n, k in kinds.items()}
+
+def _normalize(table, tscol):
+    # parse the timestamps, downcast floats like `safe_load` and drop the index written by pandas
+    if "Unnamed: 0" in table.column_names:
+        table = table.drop(["Unnamed: 0"])
+
+    if tscol not in table.column_names:
+        raise Exception("Time column {} was not found".format(tscol))
+
+    i = table.column_names.index(tscol)
+    t = table.column(tscol)
+    if pa.types.is_timestamp(t.type):
+        t = t.cast(pa.timestamp('ns', tz=t.type.tz))
+    else:
+        t = pa.array(pd.to_datetime(t.to_pandas(), errors='coerce'))
+    table = table.set_column(i, tscol, t)
+
+    schema = pa.schema([f.with_type(pa.float32()) if pa.types.is_float64(f.type) else f for f in table.schema])
+    return table.cast(schema)
+
+def _keys(table, tscol):
+    t = table.column(tscol).to_numpy()
+    keys = t.view(np.int64).copy()
+    keys[np.isnat(t)] = _NAT_KEY
+    return keys
+
+def _conform(table, schema):
+    # columns of schema, in its order and types, with nulls for the columns that table lacks
+    columns = []
+    for field in schema:
+        if field.name in table.column_names:
+            columns.append(table.column(field.name).cast(field.type))
+        else:
+            columns.append(pa.nulls(table.num_rows, field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+def _common_type(a, b):
+    # type that both a and b are cast to when the files (or blocks) of a merge disagree
+    if a.equals(b) or pa.types.is_null(b):
+        return a
+    if pa.types.is_null(a):
+        return b
+    numeric = lambda t: pa.types.is_integer(t) or pa.types.is_floating(t)
+    if numeric(a) and numeric(b):
+        return pa.float32() if a.equals(pa.float32()) and b.equals(pa.float32()) else pa.float64()
+    if pa.types.is_string(a) or pa.types.is_string(b):
+        return pa.string()
+    raise Exception("Columns of type {} and {} can not be merged".format(a, b))
+
+def _unify(schemas):
+    # union of the fields of every schema, in order of appearance, with a common type for every field
+    # (unify_schemas only promotes types from pyarrow 14 on)
+    fields = {}
+    for schema in schemas:
+        for field in schema:
+            fields[field.name] = field.type if field.name not in fields else _common_type(fields[field.name], field.type)
+    return pa.schema([pa.field(name, t) for name, t in fields.items()])
+
+class _Source(object):
+    # one time-sorted input of the merge, with the rows read but not yet merged
+    def __init__(self, fpath, tscol, block_size):
+        self.fpath = fpath
+        self.tscol = tscol
+        self.blocks = iter_blocks(fpath, block_size=block_size)
+        self.table = None
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.last = np.iinfo(np.int64).min
+        self.exhausted = False
+
+    def read(self):
+        """Append the next block to the buffer"""
+        try:
+            table = _normalize(next(self.blocks), self.tscol)
+        except StopIteration:
+            self.exhausted = True
+            return
+
+        keys = _keys(table, self.tscol)
+        if keys.shape[0] and np.any(np.diff(keys) < 0):
+            # a block of a file that is not quite sorted is put in order
+            order = np.argsort(keys, kind='stable')
+            table, keys = table.take(order), keys[order]
+        if keys.shape[0] and keys[0] < self.last:
+            raise Exception("{} is not sorted by {}".format(self.fpath, self.tscol))
+        if keys.shape[0]:
+            self.last = keys[-1]
+
+        if self.table is None:
+            self.table = table
+        else:
+            schema = _unify([self.table.schema, table.schema])
+            self.table = pa.concat_tables([_conform(self.table, schema), _conform(table, schema)])
+        self.keys = np.concatenate([self.keys, keys])
+
+    def take(self, n):
+        """Remove and return the first n buffered rows"""
+        head = self.table.slice(0, n)
+        self.table = self.table.slice(n)
+        self.keys = self.keys[n:]
+        return head
+
+def merge_sorted(files, **kwargs):
+    """
+    k-way merge of files that are each sorted by time, in blocks. At any time, only about one block of
+    each file is held in memory: rows are merged up to the smallest timestamp that every unfinished
+    file has reached (the watermark), and the rest waits for the next blocks.
+
+    :param files: .csv and/or .feather files, each sorted by tscol
+    :type files: list
+
+    Optional Arguments
+    ------------------
+    :param tscol: column holding the timestamps. (default = 'timestamp')
+    :type tscol: str
+    :param dedupe: keep only the first row of every timestamp, in the order files are given. (default = False)
+    :type dedupe: boolean
+    :param block_size: number of bytes of .csv parsed at once. (default = 2**24)
+    :type block_size: int
+
+    :return: the schema of the output (the union of the columns of every file, tscol first) and a
+            generator of merged pa.Table blocks in that schema
+    :rtype: tuple
+    """
+    tscol = kwargs.pop('tscol', 'timestamp')
+    dedupe = kwargs.pop('dedupe', False)
+    block_size = kwargs.pop('block_size', 2**24)
+
+    sources = [_Source(f, tscol, block_size) for f in files]
+    for s in sources:
+        s.read()
+
+    schemas = [s.table.schema for s in sources if s.table is not None]
+    if not schemas:
+        raise Exception("No data")
+    schema = _unify(schemas)
+    ts_field = schema.field(tscol)
+    schema = pa.schema([ts_field] + [f for f in schema if f.name != tscol])
+
+    def blocks():
+        while True:
+            for s in sources:
+                # every unfinished file needs rows to set the watermark
+                while not s.exhausted and s.keys.shape[0] == 0:
+                    s.read()
+
+            pending = [s for s in sources if s.keys.shape[0]]
+            if not pending:
+                return
+
+            running = [s.keys[-1] for s in sources if not s.exhausted]
+            watermark = min(running) if running else None
+
+            # rows before the watermark can not be preceded by anything still unread
+            pieces = []
+            for s in pending:
+                n = s.keys.shape[0] if watermark is None else int(np.searchsorted(s.keys, watermark, side='left'))
+                if n:
+                    pieces.append((s.keys[:n], _conform(s.take(n), schema)))
+
+            # the file(s) holding the watermark read their next block
+            for s in sources:
+                if not s.exhausted and (s.keys.shape[0] == 0 or s.keys[-1] == watermark):
+                    s.read()
+
+            if not pieces:
+                continue
+
+            keys = np.concatenate([p[0] for p in pieces])
+            table = pa.concat_tables([p[1] for p in pieces])
+
+            order = np.argsort(keys, kind='stable')
+            keys = keys[order]
+            if dedupe:
+                keep = np.ones(keys.shape[0], dtype=bool)
+                keep[1:] = (keys[1:] != keys[:-1]) | (keys[1:] == _NAT_KEY)
+                order = order[keep]
+
+            yield table.take(order)
+
+    return schema, blocks()
+
+def concat_files(files, output, **kwargs):
+    """
+    Concatenate .csv and/or .feather files that are each sorted by time into one time-sorted .csv or
+    .feather output, without ever loading a whole file (see `merge_sorted`). The output holds the union
+    of the columns of all files, with the timestamp column first.
+
+    :param files: .csv and/or .feather files, each sorted by tscol
+    :type files: list
+    :param output: path of the .csv or .feather output
+    :type output: str
+
+    Optional Arguments
+    ------------------
+    :param tscol: column holding the timestamps. (default = 'timestamp')
+    :type tscol: str
+    :param dedupe: keep only the first row of every timestamp, in the order files are given. (default = False)
+    :type dedupe: boolean
+    :param block_size: number of bytes of .csv parsed at once. (default = 2**24)
+    :type block_size: int
+
+    :return: number of rows written
+    :rtype: int
+    """
+    output = Path(output)
+    if output.suffix not in (".csv", ".feather"):
+        raise InvalidFileExtension("Invalid file extension")
+
+    schema, blocks = merge_sorted(files, **kwargs)
+
+    # written next to the output and moved in place once complete, so that a failed merge leaves nothing behind
+    tmp = output.with_name(".{}.{}.tmp".format(output.name, os.getpid()))
+    rows = 0
+    try:
+        if output.suffix == ".csv":
+            # header only, then every block is appended
+            schema.empty_table().to_pandas().to_csv(tmp, index=False)
+            for table in blocks:
+                table.to_pandas().to_csv(tmp, mode='a', header=False, index=False)
+                rows += table.num_rows
+        else:
+            with pa.OSFile(str(tmp), 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+                for table in blocks:
+                    writer.write_table(table)
+                    rows += table.num_rows
+        os.replace(tmp, output)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+    return rows
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from pathlib import Path
+
+from .batch import run_batch
+from .formula import protonated_mz
+from .utils import read_yaml, safe_load
+from .exceptions import InvalidArgument
+
+## build of the SMILES / functional groups lookup table (db/database.feather) with RDKit
+
+# the SMARTS every substructure column was computed with, in the schema metadata of the table
+SUBSTRUCTURES_KEY = b'tofspec.substructures'
+
+BTEX_FORMULAS = ['C6H6', 'C7H8', 'C8H10']
+
+def _rdkit():
+    # RDKit is only needed to build the database, not to use it
+    try:
+        from rdkit import Chem, RDLogger
+    except ImportError:
+        raise ImportError("Building the database needs RDKit, which is not installed: pip install rdkit")
+    RDLogger.DisableLog('rdApp.*')
+    return Chem
+
+def read_substructures(fpath):
+    """
+    Read the substructures of a substructures.yml file
+
+    :return: SMARTS string of every substructure, by name, in the order of the file
+    :rtype: dict
+    """
+    return {s['name']: s['smarts'] for s in read_yaml(fpath)['substructures']}
+
+# SMARTS patterns compiled once per worker process, see `_compile_patterns`
+_PATTERNS = []
+
+def _compile_patterns(smarts):
+    global _PATTERNS
+    Chem = _rdkit()
+
+    patterns = []
+    for name, s in smarts.items():
+        p = Chem.MolFromSmarts(s)
+        if p is None:
+            raise InvalidArgument("Invalid SMARTS for substructure {}: {}".format(name, s))
+        patterns.append(p)
+    _PATTERNS = patterns
+
+def _match_shard(smiles):
+    Chem = _rdkit()
+
+    matches = np.zeros((len(smiles), len(_PATTERNS)), dtype=np.int64)
+    for i, s in enumerate(smiles):
+        # compounds whose SMILES RDKit can not parse have no substructure
+        mol = Chem.MolFromSmiles(s) if isinstance(s, str) else None
+        if mol is None:
+            continue
+        for j, p in enumerate(_PATTERNS):
+            matches[i, j] = mol.HasSubstructMatch(p)
+    return matches
+
+def match_substructures(smiles, smarts, **kwargs):
+    """
+    Match substructures against compounds. Every SMARTS is compiled once per worker process and the
+    compounds are split into shards that the workers match in parallel.
+
+    :param smiles: SMILES string of every compound
+    :type smiles: array-like
+    :param smarts: SMARTS string of every substructure, by name
+    :type smarts: dict
+
+    Optional Arguments
+    ------------------
+    :param processes: number of worker processes, 0 for one per CPU. (default = 1)
+    :type processes: int
+    :param shard_size: number of compounds per task. (default = 1000)
+    :type shard_size: int
+
+    :return: matrix of 0/1, shape = (compounds, substructures)
+    :rtype: np.ndarray
+    """
+    processes = kwargs.pop('processes', 1)
+    shard_size = kwargs.pop('shard_size', 1000)
+
+    smiles = list(smiles)
+    if not smiles or not smarts:
+        return np.zeros((len(smiles), len(smarts)), dtype=np.int64)
+
+    # fail on a missing RDKit or a bad SMARTS before starting any worker
+    _compile_patterns(smarts)
+
+    shards = [smiles[i:i + shard_size] for i in range(0, len(smiles), shard_size)]
+    parts = []
+    for _, result, error in run_batch(_match_shard, shards, processes=processes, initializer=_compile_patterns, initargs=(smarts,)):
+        if error is not None:
+            raise error
+        parts.append(result)
+
+    return np.concatenate(parts)
+
+def build_database(database, substructures, **kwargs):
+    """
+    Build or update the lookup table of the functional groups of every compound. Only what is new is
+    computed: substructures that are not in the table yet (or whose SMARTS changed), and compounds that
+    were added. The table is then written atomically, with the m/z of every compound (see `MassIndex`).
+
+    :param database: path of the lookup table (.feather). It does not need to exist yet
+    :type database: str
+    :param substructures: path of the substructures.yml file
+    :type substructures: str
+
+    Optional Arguments
+    ------------------
+    :param output: where to write the table. (default = database)
+    :type output: str
+    :param add: .csv or .feather file of compounds to add, with 'mf' and 'smiles' columns. Compounds
+                whose SMILES is already in the table are skipped
+    :type add: str
+    :param full: match every substructure against every compound again. (default = False)
+    :type full: boolean
+    :param processes: number of worker processes, 0 for one per CPU. (default = 1)
+    :type processes: int
+
+    :return: the names of the substructures matched against every compound and the number of
+            compounds that were matched against the other substructures
+    :rtype: tuple
+    """
+    output = Path(kwargs.pop('output', None) or database)
+    add = kwargs.pop('add', None)
+    full = kwargs.pop('full', False)
+    processes = kwargs.pop('processes', 1)
+
+    smarts = read_substructures(substructures)
+
+    if Path(database).exists():
+        table = feather.read_table(str(database))
+        df = table.to_pandas()
+        meta = table.schema.metadata or {}
+        if SUBSTRUCTURES_KEY in meta:
+            previous = json.loads(meta[SUBSTRUCTURES_KEY].decode())
+        else:
+            # a table built before the SMARTS were recorded: trust the columns it has
+            previous = {name: s for name, s in smarts.items() if name in df.columns}
+    else:
+        df, previous = pd.DataFrame({'mf': pd.Series(dtype=object), 'smiles': pd.Series(dtype=object)}), {}
+
+    # substructures that were removed from substructures.yml
+    df = df.drop([name for name in previous if name not in smarts and name in df.columns], axis=1)
+
+    if add is not None:
+        new = safe_load(add)
+        new.columns = new.columns.str.lower()
+        if not pd.Series(['mf', 'smiles']).isin(new.columns).all():
+            raise InvalidArgument("The compounds to add must have 'mf' and 'smiles' columns")
+        new = new.loc[~new['smiles'].isin(df['smiles']), ['mf', 'smiles']].drop_duplicates(subset='smiles')
+        df = pd.concat([df, new], ignore_index=True, sort=False)
+
+    # whole columns for new or changed substructures, and the rows of new compounds for the others
+    columns = [name for name, s in smarts.items() if full or name not in df.columns or previous.get(name) != s]
+    kept = [name for name in smarts if name not in columns]
+    rows = np.flatnonzero(df[kept].isna().any(axis=1).to_numpy()) if kept else np.zeros(0, dtype=np.int64)
+
+    if columns:
+        matches = match_substructures(df['smiles'], {name: smarts[name] for name in columns}, processes=processes)
+        for j, name in enumerate(columns):
+            df[name] = matches[:, j]
+    if rows.shape[0]:
+        matches = match_substructures(df['smiles'].iloc[rows], {name: smarts[name] for name in kept}, processes=processes)
+        for j, name in enumerate(kept):
+            values = df[name].to_numpy(dtype=np.float64)
+            values[rows] = matches[:, j]
+            df[name] = values
+    for name in smarts:
+        df[name] = df[name].astype(np.int64)
+
+    # add BTEX column based on molecular formulas
+    df['BTEX'] = np.where(df['mf'].isin(BTEX_FORMULAS), 1, 0)
+
+    # m/z of the protonated ion of every compound, with the table sorted by it for `MassIndex`
+    # (a stable sort keeps the isomers of a formula in their order)
+    df['mz'] = protonated_mz(df['mf'].to_numpy())
+    df = df[[c for c in df.columns if c != 'mz'] + ['mz']]
+    df = df.sort_values('mz', kind='mergesort', na_position='last').reset_index(drop=True)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), SUBSTRUCTURES_KEY: json.dumps(smarts).encode()})
+
+    # never leave a half-written table behind, e.g. for `label` to read
+    output.parent.mkdir(parents=True, exist_ok=True)
+    tmp = output.with_name(".{}.{}.tmp".format(output.name, os.getpid()))
+    try:
+        feather.write_feather(table, str(tmp))
+        os.replace(tmp, output)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+    return columns, int(rows.shape[0])
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import pandas as pd
+import h5py
+from pathlib import Path
+from functools import partial
+
+from .batch import run_batch
+from .cube import is_cube, read_cube
+from .store import is_store, iter_store_chunks, NAT
+from .load import iter_vocus_chunks, get_mass_axis
+from .utils import expand_files
+
+## time-averaged (summary) mass spectra, accumulated one block of spectra at a time
+
+SUMMARY_SUFFIX = ".summary.npz"
+SUMMARY_VERSION = 2
+
+
+class SpectrumSummary(object):
+    """
+    Per TOF bin sum, max, min and count of a set of spectra, to get their mean spectrum in a single pass
+    without holding them in memory. Summaries of different files (or processes) are merged with `merge`
+    or `+`, in any order, into the summary of all of their spectra.
+
+    :param mass_axis: array of m/Q values that characterize the TOF bins of the mass spec
+    :type mass_axis: array-like
+    """
+    def __init__(self, mass_axis):
+        self.mass_axis = np.asarray(mass_axis, dtype=np.float64)
+
+        n = self.mass_axis.shape[0]
+        self.sum = np.zeros(n, dtype=np.float64)
+        self.max = np.full(n, -np.inf, dtype=np.float64)
+        self.min = np.full(n, np.inf, dtype=np.float64)
+        self.count = np.zeros(n, dtype=np.int64)
+
+        # number of spectra and the first / last of their timestamps, as int64 ns (NAT if unknown)
+        self.n_spectra = 0
+        self.start = NAT
+        self.end = NAT
+
+    @property
+    def n_bins(self):
+        return self.mass_axis.shape[0]
+
+    @property
+    def mean(self):
+        """The mean spectrum, NaN in the bins without any value"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0, self.sum / np.maximum(self.count, 1), np.nan)
+
+    def update(self, tof_data, timestamps=None):
+        """
+        Add a block of spectra to the summary. NaN values are left out, and so are the spectra whose
+        timestamp is NaT (e.g. the empty buffers at the end of a Vocus file).
+
+        :param tof_data: matrix of TOF mass spec data, shape = (t, n_bins)
+        :type tof_data: np.ndarray
+        :param timestamps: timestamps of the spectra
+        :type timestamps: np.ndarray
+
+        :return: the summary itself
+        :rtype: SpectrumSummary
+        """
+        tof_data = np.asarray(tof_data)
+        if tof_data.ndim != 2 or tof_data.shape[1] != self.n_bins:
+            raise ValueError("tof_data has shape {} but the summary has {} bins".format(tof_data.shape, self.n_bins))
+
+        if timestamps is not None:
+            t = np.asarray(timestamps).astype('datetime64[ns]').view(np.int64)
+            valid = t != NAT
+            if not valid.all():
+                t, tof_data = t[valid], tof_data[valid]
+            if t.shape[0]:
+                self._extend(t.min(), t.max())
+
+        if tof_data.shape[0] == 0:
+            return self
+
+        if np.issubdtype(tof_data.dtype, np.floating):
+            self.sum += np.nansum(tof_data, axis=0, dtype=np.float64)
+            self.count += tof_data.shape[0] - np.isnan(tof_data).sum(axis=0)
+        else:
+            self.sum += tof_data.sum(axis=0, dtype=np.float64)
+            self.count += tof_data.shape[0]
+        # fmax / fmin ignore NaN
+        self.max = np.fmax(self.max, np.fmax.reduce(tof_data, axis=0))
+        self.min = np.fmin(self.min, np.fmin.reduce(tof_data, axis=0))
+
+        self.n_spectra += tof_data.shape[0]
+        return self
+
+    def _extend(self, start, end):
+        self.start = start if self.start == NAT else min(self.start, start)
+        self.end = end if self.end == NAT else max(self.end, end)
+
+    def merge(self, other):
+        """
+        Add the spectra of another summary, which must have the same mass axis
+
+        :return: the summary itself
+        :rtype: SpectrumSummary
+        """
+        if not np.array_equal(other.mass_axis, self.mass_axis):
+            raise ValueError("Summaries with different mass axes can not be merged")
+
+        self.sum += other.sum
+        self.count += other.count
+        self.max = np.fmax(self.max, other.max)
+        self.min = np.fmin(self.min, other.min)
+
+        self.n_spectra += other.n_spectra
+        if other.start != NAT:
+            self._extend(other.start, other.end)
+        return self
+
+    def copy(self):
+        summary = SpectrumSummary(self.mass_axis)
+        return summary.merge(self)
+
+    def __add__(self, other):
+        return self.copy().merge(other)
+
+    def to_frame(self):
+        """
+        Return the summary as a dataframe with one row per TOF bin and the columns mass, mean, sum, max,
+        min and count. Bins without any value have a NaN max and min.
+        """
+        empty = self.count == 0
+        return pd.DataFrame({
+            'mass': self.mass_axis,
+            'mean': self.mean,
+            'sum': self.sum,
+            'max': np.where(empty, np.nan, self.max),
+            'min': np.where(empty, np.nan, self.min),
+            'count': self.count,
+        })
+
+    def save(self, fpath, **info):
+        """Save the summary to a .npz file, along with any extra (scalar) info"""
+        np.savez(fpath, version=SUMMARY_VERSION, mass_axis=self.mass_axis, sum=self.sum, max=self.max,
+                    min=self.min, count=self.count, n_spectra=self.n_spectra, start=self.start, end=self.end,
+                    **info)
+
+    @classmethod
+    def load(cls, fpath):
+        """Load a summary saved with `SpectrumSummary.save`"""
+        summary = cls.__new__(cls)
+        with np.load(fpath, allow_pickle=False) as f:
+            if int(f['version']) > SUMMARY_VERSION:
+                raise Exception("Unsupported summary: {}".format(fpath))
+            for k in ('mass_axis', 'sum', 'max', 'min', 'count'):
+                setattr(summary, k, f[k])
+            for k in ('n_spectra', 'start', 'end'):
+                setattr(summary, k, int(f[k]))
+        return summary
+
+    @classmethod
+    def from_blocks(cls, mass_axis, blocks):
+        """
+        Summarize an iterable of (timestamps, tof_data, ...) blocks, e.g. from `iter_vocus_chunks`
+        """
+        summary = cls(mass_axis)
+        for block in blocks:
+            summary.update(block[1], block[0])
+        return summary
+
+
+def summary_path(file):
+    """
+    Return the path of the sidecar summary of a file, next to it: <file>.summary.npz
+    """
+    file = Path(file)
+    return file.with_name(file.name + SUMMARY_SUFFIX)
+
+def _source_stat(file):
+    # a cube is a directory: its TOF data is what the summary depends on
+    st = os.stat(Path(file) / "tof_data.npy" if is_cube(file) else file)
+    return st.st_size, st.st_mtime_ns
+
+def read_sidecar(file):
+    """
+    Return the sidecar summary of a file, or None if there is none or the file changed since it was written
+    """
+    fpath = summary_path(file)
+    if not fpath.exists():
+        return None
+
+    try:
+        with np.load(fpath, allow_pickle=False) as f:
+            source = (int(f['source_size']), int(f['source_mtime']))
+            version = int(f['version'])
+        # sidecars of an older version may have been summarized differently
+        if source != _source_stat(file) or version != SUMMARY_VERSION:
+            return None
+        return SpectrumSummary.load(fpath)
+    except Exception:
+        # an unreadable sidecar is as good as none
+        return None
+
+def write_sidecar(file, summary):
+    """
+    Save the summary of a file next to it, see `summary_path`. The sidecar is written atomically, and a
+    read-only directory is not an error: the summary is then simply computed again next time.
+    """
+    fpath = summary_path(file)
+    size, mtime = _source_stat(file)
+    tmp = fpath.with_name(".{}.{}.tmp.npz".format(fpath.name, os.getpid()))
+    try:
+        summary.save(tmp, source_size=size, source_mtime=mtime)
+        os.replace(tmp, fpath)
+    except OSError:
+        if tmp.exists():
+            tmp.unlink()
+
+def summarize_file(file, **kwargs):
+    """
+    Summarize the spectra of a Vocus hdf5 file, a campaign store or a spectral cube in a single pass,
+    one block of spectra at a time. A .npz file is taken to be a summary saved with `SpectrumSummary.save`.
+
+    :param file: path of the file
+    :type file: str
+
+    Optional Arguments
+    ------------------
+    :param cache: read the sidecar summary of the file if it is up to date, and write it otherwise,
+                    see `summary_path`. (default = True)
+    :type cache: boolean
+    :param max_memory: max number of bytes of TOF data held in memory at once (default = 2**28)
+    :type max_memory: int
+
+    :return: the summary of every spectrum of the file
+    :rtype: SpectrumSummary
+    """
+    cache = kwargs.pop('cache', True)
+    max_memory = kwargs.pop('max_memory', 2**28)
+
+    if Path(file).suffix == ".npz":
+        # a summary saved earlier, e.g. by `tofspec summary`
+        return SpectrumSummary.load(file)
+
+    if cache:
+        summary = read_sidecar(file)
+        if summary is not None:
+            return summary
+
+    if is_cube(file):
+        timestamps, mass_axis, tof_data = read_cube(file)
+        # the cube is memory-mapped: only one block of it is paged in at a time
+        step = max(1, max_memory // max(tof_data.dtype.itemsize * tof_data.shape[1], 1))
+        summary = SpectrumSummary.from_blocks(mass_axis, ((timestamps[i:i + step], tof_data[i:i + step])
+                                                            for i in range(0, tof_data.shape[0], step)))
+    else:
+        with h5py.File(file, "r") as f:
+            if is_store(f):
+                summary = SpectrumSummary.from_blocks(f['mass_axis'][:], iter_store_chunks(f, max_memory=max_memory))
+            else:
+                summary = SpectrumSummary.from_blocks(get_mass_axis(f), iter_vocus_chunks(f, max_memory=max_memory))
+
+    if cache:
+        write_sidecar(file, summary)
+
+    return summary
+
+def _summarize_shard(files, errors='raise', **kwargs):
+    summary, skipped = None, []
+    for f in files:
+        try:
+            result = summarize_file(f, **kwargs)
+            summary = result if summary is None else summary.merge(result)
+        except Exception as e:
+            if errors == 'raise':
+                raise
+            skipped.append((f, str(e)))
+    return summary, skipped
+
+def summarize_files(files, **kwargs):
+    """
+    Summarize the spectra of many files (see `summarize_file`) in a pool of worker processes. The files
+    are split into a few shards per process, and every worker merges the summaries of its shard as it
+    goes, so that memory does not grow with the number of files. All files must share the same mass axis.
+
+    :param files: filepaths or glob patterns
+    :type files: list
+
+    Optional Arguments
+    ------------------
+    :param processes: number of worker processes, 0 for one per CPU. (default = 1)
+    :type processes: int
+    :param errors: 'raise' to stop at the first file that fails, 'skip' to leave it out. (default = 'raise')
+    :type errors: str
+
+    The other optional arguments are those of `summarize_file`.
+
+    :return: the merged summary and the list of (file, error message) of the files that were skipped
+    :rtype: tuple
+    """
+    processes = kwargs.pop('processes', 1)
+    errors = kwargs.pop('errors', 'raise')
+
+    files = expand_files(files)
+    # the sidecars of files that are summarized anyway, e.g. when FILES is a whole directory
+    names = set(files)
+    files = [f for f in files if not (f.endswith(SUMMARY_SUFFIX) and f[:-len(SUMMARY_SUFFIX)] in names)]
+
+    workers = processes or os.cpu_count() or 1
+    shards = [list(s) for s in np.array_split(np.array(files, dtype=object), min(len(files), workers * 4)) if len(s)] if files else []
+
+    summary, skipped = None, []
+    for _, result, error in run_batch(partial(_summarize_shard, errors=errors, **kwargs), shards, processes=processes):
+        if error is not None:
+            raise error
+        skipped.extend(result[1])
+        if result[0] is not None:
+            summary = result[0] if summary is None else summary.merge(result[0])
+
+    if summary is None:
+        raise Exception("No data")
+
+    return summary, skipped
@@ -5,13 +5,48 @@ import pandas as pd
 import numpy as np
 import yaml
 import re
+import glob
+import csv
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.feather as feather
 from pathlib import Path
 
 from .exceptions import InvalidFileExtension
 
 def safe_load(fpath, **kwargs):
-    """Load and return a file
+    """Load and return a .csv or .feather file, reading it only once. Float columns are
+    downcast to float32.
+
+    Optional Arguments
+    ------------------
+    :param columns: only load these columns
+    :type columns: list
+    :param nrows: only load the first nrows rows
+    :type nrows: int
+    :param start: only keep rows whose timestamp (in tscol) is at or after start
+    :type start: str or datetime
+    :param end: only keep rows whose timestamp (in tscol) is before end
+    :type end: str or datetime
+    :param tscol: column holding the timestamps used by start/end. (default = 'timestamp')
+    :type tscol: str
+    :param memory_map: memory-map .feather files rather than reading them into memory. (default = True)
+    :type memory_map: boolean
+    :param engine: parser for .csv files, either 'arrow' (multithreaded) or 'pandas'. (default = 'arrow')
+    :type engine: str
+    :param block_size: number of bytes of .csv processed at once by each thread of the 'arrow' engine.
+                        (default = 2**24)
+    :type block_size: int
     """
+    columns = kwargs.pop('columns', None)
+    nrows = kwargs.pop('nrows', None)
+    start = kwargs.pop('start', None)
+    end = kwargs.pop('end', None)
+    tscol = kwargs.pop('tscol', 'timestamp')
+    memory_map = kwargs.pop('memory_map', True)
+    engine = kwargs.pop('engine', 'arrow')
+    block_size = kwargs.pop('block_size', 2**24)
+
     p = Path(fpath)
 
     if p.suffix == ".csv":
@@ -21,19 +56,68 @@ def safe_load(fpath, **kwargs):
     else:
         raise InvalidFileExtension
 
-    sample = pd.read_csv(fpath, nrows=1) if as_csv else pd.read_feather(fpath)
-    dtypes = sample.dtypes # Get the dtypes
-    cols = sample.columns # Get the columns
+    filter_time = start is not None or end is not None
+
+    # the timestamp column is needed to filter on, even if it is not asked for
+    read_columns = None
+    if columns is not None:
+        read_columns = list(columns)
+        if filter_time and tscol not in read_columns:
+            read_columns.append(tscol)
+
+    # Feather V1 files are not Arrow IPC files: they are read by pandas
+    if not as_csv and read_feather_schema(fpath) is None:
+        tmp = pd.read_feather(fpath, columns=read_columns)
+        if nrows is not None:
+            tmp = tmp.iloc[:nrows]
+        tmp = tmp.astype({c: 'float32' for c in tmp.columns if tmp[c].dtype == np.float64})
+
+        if filter_time:
+            tmp = tmp.loc[time_mask(tmp[tscol], start, end)].reset_index(drop=True)
+    elif as_csv and engine == 'pandas':
+        sample = pd.read_csv(fpath, nrows=1, usecols=read_columns)
+        dtypes = sample.dtypes # Get the dtypes
+        cols = sample.columns # Get the columns
 
-    dtype_dictionary = {} 
-    for c in cols:
-        if str(dtypes[c]) == 'float64':
-            dtype_dictionary[c] = 'float32'
+        dtype_dictionary = {} 
+        for c in cols:
+            if str(dtypes[c]) == 'float64':
+                dtype_dictionary[c] = 'float32'
+            else:
+                dtype_dictionary[c] = str(dtypes[c])
+
+        tmp = pd.read_csv(fpath, dtype=dtype_dictionary, usecols=read_columns, nrows=nrows)
+
+        if filter_time:
+            tmp = tmp.loc[time_mask(tmp[tscol], start, end)].reset_index(drop=True)
+    else:
+        if as_csv:
+            table = read_csv_table(fpath, columns=read_columns, nrows=nrows, block_size=block_size)
         else:
-            dtype_dictionary[c] = str(dtypes[c])
+            table = feather.read_table(fpath, columns=read_columns, memory_map=memory_map)
 
-    tmp = pd.read_csv(fpath, dtype=dtype_dictionary) if as_csv else pd.read_feather(fpath)
-    
+        if nrows is not None:
+            table = table.slice(0, nrows)
+
+        if filter_time:
+            table = table.filter(pa.array(time_mask(table.column(tscol).to_pandas(), start, end)))
+
+        # downcast on the Arrow side, straight from the (memory-mapped) float64 buffers
+        schema = pa.schema([f.with_type(pa.float32()) if pa.types.is_float64(f.type) else f for f in table.schema],
+                            metadata=table.schema.metadata)
+        table = table.cast(schema)
+
+        tmp = table.to_pandas(self_destruct=True)
+        del table
+
+        if not as_csv:
+            # exact m/Q of the columns of spectra saved by `tofspec load`
+            masses = read_mass_axis(fpath)
+            if masses is not None:
+                tmp.attrs['mass_axis'] = masses[masses.index.isin(tmp.columns)]
+
+    if columns is not None and filter_time and tscol not in columns:
+        del tmp[tscol]
 
     # drop the extra column if it was added
     if "Unnamed: 0" in tmp.columns:
@@ -41,6 +125,284 @@ def safe_load(fpath, **kwargs):
 
     return tmp
 
+def csv_read_options(fpath, **kwargs):
+    """Return the Arrow (ReadOptions, ConvertOptions) of a .csv file. Columns whose name is a number
+    (the m/Q bins of a raw spectra file) are parsed straight to float32, the types of the other columns
+    are inferred. Columns without a name are named like pandas does ('Unnamed: i').
+
+    Optional Arguments
+    ------------------
+    :param columns: only read these columns
+    :type columns: list
+    :param block_size: number of bytes processed at once by each thread. (default = 2**24)
+    :type block_size: int
+    """
+    columns = kwargs.pop('columns', None)
+    block_size = kwargs.pop('block_size', 2**24)
+
+    # utf-8-sig drops the byte order mark written by Excel
+    with open(fpath, newline='', encoding='utf-8-sig') as f:
+        line = f.readline()
+    header = next(csv.reader([line])) if line else []
+    names = [h if h != "" else "Unnamed: {}".format(i) for i, h in enumerate(header)]
+
+    column_types = {}
+    for n in names:
+        try:
+            float(n)
+            column_types[n] = pa.float32()
+        except ValueError:
+            pass
+
+    # a block must hold at least the header line
+    read_options = pacsv.ReadOptions(use_threads=True, block_size=max(block_size, 2 * len(line.encode())),
+                                        column_names=names, skip_rows=1)
+    convert_options = pacsv.ConvertOptions(column_types=column_types, include_columns=columns or [])
+
+    return read_options, convert_options
+
+def read_csv_table(fpath, **kwargs):
+    """Read a .csv file into an Arrow table with the multithreaded Arrow CSV parser (see `csv_read_options`).
+
+    Optional Arguments
+    ------------------
+    :param columns: only read these columns
+    :type columns: list
+    :param nrows: stop reading once at least nrows rows have been read
+    :type nrows: int
+    :param block_size: number of bytes processed at once by each thread. (default = 2**24)
+    :type block_size: int
+    """
+    columns = kwargs.pop('columns', None)
+    nrows = kwargs.pop('nrows', None)
+    block_size = kwargs.pop('block_size', 2**24)
+
+    read_options, convert_options = csv_read_options(fpath, columns=columns, block_size=block_size)
+
+    if nrows is None:
+        return pacsv.read_csv(fpath, read_options=read_options, convert_options=convert_options)
+
+    batches = []
+    with pacsv.open_csv(fpath, read_options=read_options, convert_options=convert_options) as reader:
+        for batch in reader:
+            batches.append(batch)
+            nrows -= batch.num_rows
+            if nrows <= 0:
+                break
+        return pa.Table.from_batches(batches, schema=reader.schema)
+
+def time_mask(timestamps, start=None, end=None):
+    """Return a boolean mask of the timestamps that are within [start, end)
+    """
+    timestamps = pd.to_datetime(pd.Series(timestamps))
+    mask = np.ones(len(timestamps), dtype=bool)
+
+    for bound, keep in ((start, timestamps.__ge__), (end, timestamps.__lt__)):
+        if bound is None:
+            continue
+        bound = pd.Timestamp(bound)
+        # compare naive bounds against tz-aware timestamps in the timestamps' timezone
+        if timestamps.dt.tz is not None and bound.tzinfo is None:
+            bound = bound.tz_localize(timestamps.dt.tz)
+        mask &= keep(bound).to_numpy()
+
+    return mask
+
+def utc_timestamps(values):
+    """Parse timestamps (strings or datetimes) in one vectorized pass. Timestamps without a timezone
+    are taken to be UTC, the others are converted to UTC; values that can not be parsed become NaT
+    """
+    return pd.to_datetime(values, errors='coerce', utc=True)
+
+def join_time_series(frames, **kwargs):
+    """Join dataframes indexed by time into one dataframe.
+
+    By default, this is an outer join on the index: the result holds every timestamp of every frame,
+    sorted. The frames are aligned all at once, unless a timestamp appears more than once in a frame or
+    a column name appears in more than one frame, in which case they are merged one after the other
+    (suffixing the repeated columns with _x, _y) to keep the behavior of `pd.merge`.
+
+    With a tolerance, the result holds the timestamps of the first frame only, and every other frame
+    contributes its row nearest in time, if it is within tolerance (see `pd.merge_asof`).
+
+    :param frames: dataframes with a DatetimeIndex
+    :type frames: list
+
+    Optional Arguments
+    ------------------
+    :param tolerance: join to the nearest row within this time, e.g. '5s'. (default = None, exact outer join)
+    :type tolerance: str or pd.Timedelta
+
+    :return: joined dataframe
+    :rtype: pd.DataFrame
+    """
+    tolerance = kwargs.pop('tolerance', None)
+
+    if not frames:
+        return pd.DataFrame()
+
+    if tolerance is not None:
+        tolerance = pd.Timedelta(tolerance)
+        df = frames[0].sort_index(kind='mergesort')
+        for tmp in frames[1:]:
+            df = pd.merge_asof(df, tmp.sort_index(kind='mergesort'), left_index=True, right_index=True,
+                                direction='nearest', tolerance=tolerance)
+        return df
+
+    columns = [c for tmp in frames for c in tmp.columns]
+    if len(set(columns)) == len(columns) and all(tmp.index.is_unique for tmp in frames):
+        return pd.concat(frames, axis=1, join='outer', sort=True)
+
+    df = frames[0]
+    for tmp in frames[1:]:
+        df = pd.merge(df, tmp, left_index=True, right_index=True, how='outer')
+    return df
+
+def write_df(df, output):
+    """Save a dataframe, including its index, to a .csv or .feather file
+    """
+    output = Path(output)
+    if output.suffix == ".csv":
+        df.to_csv(output)
+    elif output.suffix == ".feather":
+        df = df.reset_index()
+        df.columns = df.columns.astype(str)
+        df.to_feather(output)
+    else:
+        raise InvalidFileExtension("Invalid output file extension")
+
+def read_df(fpath):
+    """Read back a dataframe saved with `write_df`, including its index. Values are not downcast.
+    """
+    fpath = Path(fpath)
+    if fpath.suffix == ".csv":
+        df = pd.read_csv(fpath, index_col=0)
+    elif fpath.suffix == ".feather":
+        df = pd.read_feather(fpath)
+        df = df.set_index(df.columns[0])
+    else:
+        raise InvalidFileExtension("Invalid file extension")
+
+    if df.index.name == "index":
+        df.index.name = None
+
+    return df
+
+# schema metadata of the .feather spectra written by `tofspec load`
+MASS_AXIS_KEY = b'tofspec.mass_axis'
+MASS_AXIS_DTYPE_KEY = b'tofspec.mass_axis.dtype'
+
+def write_spectra(output, timestamps, mass_axis, tof_data, metadata=None, **kwargs):
+    """Save a matrix of TOF spectra to a .feather (Arrow IPC) file, streamed one block of rows at a time.
+    Every m/Q bin is a column of the native dtype of tof_data (e.g. uint16), named after its m/Q value, and
+    followed by a 'timestamp' column and, if given, a 'metadata' column. The exact mass axis is stored in
+    the schema metadata and can be recovered with `read_mass_axis`.
+
+    :param output: path of the .feather file
+    :type output: str
+    :param timestamps: timestamp of every spectrum, shape = (t,)
+    :type timestamps: np.ndarray
+    :param mass_axis: m/Q value of every TOF bin, shape = (n,)
+    :type mass_axis: np.ndarray
+    :param tof_data: matrix of TOF mass spec data, shape = (t,n)
+    :type tof_data: np.ndarray
+
+    Optional Arguments
+    ------------------
+    :param metadata: metadata of every spectrum, shape = (t,)
+    :type metadata: np.ndarray
+    :param block_size: max number of bytes of TOF data per record batch. (default = 2**26)
+    :type block_size: int
+    """
+    block_size = kwargs.pop('block_size', 2**26)
+
+    mass_axis = np.asarray(mass_axis)
+    tof_data = np.asarray(tof_data)
+    timestamps = np.asarray(timestamps, dtype='datetime64[ns]')
+
+    fields = [pa.field(str(m), pa.from_numpy_dtype(tof_data.dtype)) for m in mass_axis]
+    fields.append(pa.field('timestamp', pa.timestamp('ns')))
+    if metadata is not None:
+        metadata = np.asarray(metadata)
+        fields.append(pa.field('metadata', pa.from_numpy_dtype(metadata.dtype)))
+
+    schema = pa.schema(fields, metadata={MASS_AXIS_KEY: mass_axis.tobytes(),
+                                            MASS_AXIS_DTYPE_KEY: mass_axis.dtype.str.encode()})
+
+    rows = max(1, block_size // max(tof_data.itemsize * tof_data.shape[1], 1))
+
+    # uncompressed, so that readers can memory-map the file
+    with pa.OSFile(str(output), 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+        for i in range(0, tof_data.shape[0], rows):
+            # one bin per row, so that every column is a contiguous buffer that Arrow wraps without copying
+            block = np.ascontiguousarray(tof_data[i:i + rows].T)
+            arrays = [pa.array(b) for b in block]
+            arrays.append(pa.array(timestamps[i:i + rows], from_pandas=True))
+            if metadata is not None:
+                arrays.append(pa.array(metadata[i:i + rows]))
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+            del arrays, block
+
+def mass_axis_from_schema(schema):
+    """Return the mass axis stored in the metadata of an Arrow schema written by `write_spectra` as a
+    pd.Series of m/Q values indexed by column name, or None if there is none
+    """
+    meta = schema.metadata or {}
+    if MASS_AXIS_KEY not in meta:
+        return None
+
+    mass_axis = np.frombuffer(meta[MASS_AXIS_KEY], dtype=meta[MASS_AXIS_DTYPE_KEY].decode())
+
+    return pd.Series(mass_axis, index=schema.names[:mass_axis.shape[0]])
+
+def read_feather_schema(fpath):
+    """Return the Arrow schema of a .feather file, or None if it is not an Arrow IPC file (e.g. a
+    Feather V1 file). Only the footer is read.
+    """
+    try:
+        with pa.memory_map(str(fpath)) as source:
+            return pa.ipc.open_file(source).schema
+    except pa.ArrowInvalid:
+        return None
+
+def read_mass_axis(fpath):
+    """Return the exact mass axis of a .feather file written by `tofspec load` as a pd.Series of m/Q
+    values indexed by column name, or None if the file has none. Only the schema is read.
+    """
+    schema = read_feather_schema(fpath)
+    if schema is None:
+        return None
+
+    return mass_axis_from_schema(schema)
+
+def df_mass_axis(df):
+    """Return the m/Q values of the columns of df. The exact values are used if df was read by
+    `safe_load` from a file written by `tofspec load`, otherwise the column names are parsed as float32.
+    """
+    masses = df.attrs.get('mass_axis')
+    if masses is not None and df.columns.isin(masses.index).all():
+        return masses.reindex(df.columns).to_numpy()
+
+    return df.columns.to_numpy(dtype=np.float32)
+
+def expand_files(files):
+    """Expand a path, a glob pattern or a list of them into a sorted-per-pattern list of files,
+    keeping the order in which they were given and dropping duplicates
+    """
+    if isinstance(files, (str, Path)):
+        files = [files]
+
+    out, seen = [], set()
+    for f in files:
+        f = str(f)
+        matches = sorted(glob.glob(f)) if glob.has_magic(f) else [f]
+        for m in matches:
+            if m not in seen:
+                seen.add(m)
+                out.append(m)
+
+    return out
+
 
 ## reading YAML config files
 
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import h5py
+import numpy as np
+
+from .load import read_vocus_writes, get_start_time
+
+
+def open_vocus_swmr(file):
+    """
+    Open a Vocus hdf5 file that may still be written to. The file is opened read-only in SWMR
+    (single writer, multiple readers) mode when its format allows it.
+
+    :return: the open file and whether it is in SWMR mode
+    :rtype: tuple
+    """
+    try:
+        return h5py.File(file, "r", libver='latest', swmr=True), True
+    except (OSError, ValueError):
+        # written without SWMR; the file is reopened on every poll instead
+        return h5py.File(file, "r"), False
+
+def complete_writes(f, done=0, metadata=False):
+    """
+    Return the number of writes of an open Vocus file whose spectra are complete: the TOF data,
+    buffer times (and metadata) of every write before it have been written. Writes are complete once
+    the time of their last buffer differs from the time of the very first buffer of the file.
+
+    :param done: number of writes that are already known to be complete
+    :type done: int
+    """
+    buftimes = f['TimingData']['BufTimes']
+    shapes = [buftimes.shape[0], f['FullSpectra']['TofData'].shape[0]]
+    if metadata:
+        shapes.append(f['TPS2']['TwData'].shape[0])
+    n = min(shapes)
+
+    if n <= done:
+        return done
+
+    first = buftimes[0, 0]
+    filled = buftimes[done:n, -1] != first
+    if done == 0 and buftimes.shape[1] == 1:
+        filled[0] = True
+
+    return done + (int(np.argmin(filled)) if not filled.all() else filled.shape[0])
+
+def follow_vocus_file(file, **kwargs):
+    """
+    Follow a Vocus hdf5 file while the instrument is acquiring, like `tail -f`. The file is polled
+    for new writes and the spectra of every newly completed write are yielded as soon as they are
+    found, so that nothing is read twice. Once the file stops growing for `timeout` seconds, the
+    remaining (partial) writes are yielded, with the empty buffers masked as in `get_times`.
+
+    :param file: hdf5 filepath
+    :type file: str
+
+    Optional Arguments
+    ------------------
+    :param columns: sorted indices of the TOF bins to read. (default = all bins)
+    :type columns: array-like
+    :param metadata: also yield the metadata of each row. (default = False)
+    :type metadata: boolean
+    :param poll: number of seconds between two looks at the file. (default = 1)
+    :type poll: float
+    :param timeout: stop once the file has not grown for this many seconds. (default = None, never stop)
+    :type timeout: float
+    :param start: number of writes to skip, e.g. those already processed. (default = 0)
+    :type start: int
+
+    :return: generator of (timestamps, tof_block) or (timestamps, tof_block, metadata) tuples
+    :rtype: generator
+    """
+    columns = kwargs.pop('columns', None)
+    metadata_ = kwargs.pop('metadata', False)
+    poll = kwargs.pop('poll', 1.0)
+    timeout = kwargs.pop('timeout', None)
+    w = kwargs.pop('start', 0)
+
+    f, swmr = open_vocus_swmr(file)
+    start_time, first = None, None
+    last_growth = time.monotonic()
+
+    try:
+        while True:
+            try:
+                if swmr:
+                    for name in ('TimingData/BufTimes', 'FullSpectra/TofData', 'TPS2/TwData', 'AcquisitionLog/Log'):
+                        if name in f:
+                            f[name].refresh()
+                else:
+                    f.close()
+                    f = h5py.File(file, "r")
+
+                if start_time is None and f['AcquisitionLog']['Log'].shape[0] and f['TimingData']['BufTimes'].shape[0]:
+                    start_time = get_start_time(f)
+                    first = f['TimingData']['BufTimes'][0, 0]
+
+                done = complete_writes(f, w, metadata_) if start_time is not None else w
+            except OSError:
+                # the file is locked or in the middle of a write; look again on the next poll
+                done = w
+            if done > w:
+                yield read_vocus_writes(f, w, done, start_time=start_time, first=first, metadata=metadata_, columns=columns)
+                w = done
+                last_growth = time.monotonic()
+                continue
+
+            if timeout is not None and time.monotonic() - last_growth >= timeout:
+                break
+
+            time.sleep(poll)
+
+        if not swmr:
+            f.close()
+            f = h5py.File(file, "r")
+
+        # the instrument finishes its last write with empty buffers
+        n = min(f['TimingData']['BufTimes'].shape[0], f['FullSpectra']['TofData'].shape[0])
+        if metadata_:
+            n = min(n, f['TPS2']['TwData'].shape[0])
+        if start_time is not None and n > w:
+            yield read_vocus_writes(f, w, n, start_time=start_time, first=first, metadata=metadata_, columns=columns)
+    finally:
+        f.close()